@@ -0,0 +1,19 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN BENCHMARKS
+#################################################################################
+# File:       __init__.py
+#
+#             Performance benchmarks for layman
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''
+Times the overlay list handling against synthetic catalogs and
+add/sync/delete against local stand-ins for overlay servers.
+
+Run from the layman root directory:
+
+ PYTHONPATH="." python -m benchmarks.run --output results.json
+'''
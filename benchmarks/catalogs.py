@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN CATALOG BENCHMARKS
+#################################################################################
+# File:       catalogs.py
+#
+#             Times the overlay list handling on synthetic catalogs
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''
+Generates repositories.xml catalogs of any size and times reading,
+listing and writing them.
+'''
+
+from __future__ import unicode_literals
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tempfile
+
+from layman.api import LaymanAPI
+from layman.compatibility import fileopen
+from layman.dbbase import DbBase
+from layman.remotedb import RemoteDB
+
+from benchmarks.utils import make_config, timed
+
+# the catalog sizes benchmarked by default
+SIZES = [1000, 10000, 50000]
+
+# cycled through so every overlay type is represented
+SOURCES = [
+    ('git', 'https://github.com/example/%s.git'),
+    ('rsync', 'rsync://rsync.example.org/%s'),
+    ('svn', 'https://svn.example.org/repos/%s'),
+    ('mercurial', 'https://hg.example.org/%s'),
+    ('tar', 'https://www.example.org/%s.tar.bz2'),
+    ]
+
+REPO = '''  <repo quality="experimental" status="%(status)s">
+    <name>%(name)s</name>
+    <description lang="en">Synthetic overlay number %(index)d, \
+generated to benchmark layman.</description>
+    <homepage>https://www.example.org/%(name)s</homepage>
+    <owner type="person">
+      <email>%(name)s@example.org</email>
+      <name>Owner %(index)d</name>
+    </owner>
+    <source type="%(type)s">%(src)s</source>
+    <feed>https://www.example.org/%(name)s/atom.xml</feed>
+  </repo>
+'''
+
+#===============================================================================
+#
+# Helper functions
+#
+#-------------------------------------------------------------------------------
+
+def write_catalog(path, size):
+    '''
+    Writes a repositories.xml catalog listing size overlays.
+
+    >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+    >>> catalog = write_catalog(os.path.join(tmpdir, 'repositories.xml'), 5)
+    >>> from layman.output import Message
+    >>> a = DbBase({'output': Message()}, [catalog])
+    >>> a.list_ids()
+    ['bench-00000', 'bench-00001', 'bench-00002', 'bench-00003', 'bench-00004']
+    >>> a.select('bench-00001').sources[0].type
+    'Rsync'
+    >>> shutil.rmtree(tmpdir)
+    '''
+    with fileopen(path, 'w') as catalog:
+        catalog.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!DOCTYPE repositories SYSTEM '
+            '"http://www.gentoo.org/dtd/repositories.dtd">\n'
+            '<repositories xmlns="" version="1.0">\n')
+        for index in range(size):
+            name = 'bench-%05d' % index
+            source_type, src = SOURCES[index % len(SOURCES)]
+            catalog.write(REPO % {'name': name, 'index': index,
+                'status': 'official' if index % 3 else 'unofficial',
+                'type': source_type, 'src': src % name})
+        catalog.write('</repositories>\n')
+    return path
+
+
+def _read(config, path):
+    db = DbBase(config, [])
+    with open(path, 'rb') as catalog:
+        db.read(catalog.read(), origin=path)
+    return db
+
+
+def run(results, sizes=None, repeat=3):
+    '''Times the overlay list handling for every catalog size.'''
+    for size in sizes or SIZES:
+        tmpdir = tempfile.mkdtemp(prefix='layman-bench-')
+        try:
+            _run_size(results, size, repeat, tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def _run_size(results, size, repeat, tmpdir):
+    catalog = write_catalog(os.path.join(tmpdir, 'repositories.xml'), size)
+    storage = os.path.join(tmpdir, 'storage')
+    config = make_config(storage, overlays=['file://' + catalog])
+
+    with open(catalog, 'rb') as catalog_file:
+        text = catalog_file.read()
+
+    results.add('DbBase.read', timed(
+        lambda db: db.read(text, origin=catalog),
+        setup=lambda: DbBase(config, []), repeat=repeat), size=size)
+
+    # list() creates the Overlay objects read() left pending, so
+    # every run needs a freshly read catalog
+    results.add('DbBase.list', timed(
+        lambda db: db.list(width=80),
+        setup=lambda: _read(config, catalog), repeat=repeat), size=size)
+    results.add('DbBase.list', timed(
+        lambda db: db.list(verbose=True),
+        setup=lambda: _read(config, catalog), repeat=repeat),
+        size=size, verbose=True)
+
+    target = os.path.join(tmpdir, 'written.xml')
+    results.add('DbBase.write', timed(
+        lambda db: db.write(target),
+        setup=lambda: _read(config, catalog), repeat=repeat), size=size)
+
+    db = _read(config, catalog)
+    db.write(target)
+    def change_one():
+        db.overlays['bench-00000'].priority += 1
+        return db
+    results.add('DbBase.write', timed(
+        lambda db: db.write(target),
+        setup=change_one, repeat=repeat), size=size, changed=1)
+
+    # fill the cache RemoteDB reads from
+    RemoteDB(config, ignore_init_read_errors=True).cache()
+    cached = RemoteDB(config).filepath('file://' + catalog) + '.xml'
+    def drop_compiled():
+        compiled = DbBase.compiled_path(cached)
+        if os.path.exists(compiled):
+            os.unlink(compiled)
+    results.add('RemoteDB.__init__', timed(
+        lambda arg: RemoteDB(config),
+        setup=drop_compiled, repeat=repeat), size=size, compiled=False)
+    RemoteDB(config)
+    results.add('RemoteDB.__init__', timed(
+        lambda: RemoteDB(config), repeat=repeat), size=size, compiled=True)
+
+    results.add('LaymanAPI.get_info_list', timed(
+        lambda api: api.get_info_list(local=False, width=80),
+        setup=lambda: LaymanAPI(config), repeat=repeat),
+        size=size, local=False)
+
+    # the same catalog as the installed overlays
+    shutil.copy(catalog, config['installed'])
+    LaymanAPI(config).get_installed()
+    results.add('LaymanAPI.get_info_list', timed(
+        lambda api: api.get_info_list(local=True, width=80),
+        setup=lambda: LaymanAPI(config), repeat=repeat),
+        size=size, local=True)
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
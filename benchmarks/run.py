@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN BENCHMARK RUNNER
+#################################################################################
+# File:       run.py
+#
+#             Runs the benchmarks and stores the results
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''
+Runs the benchmarks and writes the results as json, so they can be
+compared between releases:
+
+ PYTHONPATH="." python -m benchmarks.run --sizes 1000 10000 \\
+     --output layman-$(git describe).json
+'''
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import sys
+
+from argparse import ArgumentParser
+
+from layman.compatibility import fileopen
+
+from benchmarks import catalogs, sources
+from benchmarks.utils import Results
+
+#===============================================================================
+#
+# Main
+#
+#-------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark layman.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+        default=catalogs.SIZES,
+        help='Catalog sizes to benchmark [default: %(default)s].')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='Runs per catalog benchmark [default: %(default)s].')
+    parser.add_argument('-k', '--kinds', nargs='+', default=sources.KINDS,
+        choices=sources.KINDS,
+        help='Overlay sources to add, sync and delete '
+        '[default: %(default)s].')
+    parser.add_argument('-n', '--overlays', type=int, default=4,
+        help='Overlays of every kind [default: %(default)s].')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='Parallel jobs for add and sync [default: %(default)s].')
+    parser.add_argument('--no-catalogs', action='store_true',
+        help='Skip the catalog benchmarks.')
+    parser.add_argument('--no-sources', action='store_true',
+        help='Skip the add, sync and delete benchmarks.')
+    parser.add_argument('-o', '--output',
+        help='Write the json results to this file instead of stdout.')
+    options = parser.parse_args(argv)
+
+    results = Results()
+    if not options.no_catalogs:
+        catalogs.run(results, sizes=options.sizes, repeat=options.repeat)
+    if not options.no_sources:
+        sources.run(results, kinds=options.kinds,
+            overlays=options.overlays, jobs=options.jobs)
+
+    if options.output:
+        with fileopen(options.output, 'w') as output:
+            results.write(output)
+        print(results.summary())
+    else:
+        results.write(sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SOURCE BENCHMARKS
+#################################################################################
+# File:       sources.py
+#
+#             Times add, sync and delete against local overlay servers
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''
+Creates local stand-ins for overlay servers (bare git and mercurial
+repositories, a subversion repository, tar packages reached through
+file:// and a local HTTP server) and times LaymanAPI.add_repos(),
+sync() and delete_repos() against them end to end.
+'''
+
+from __future__ import unicode_literals
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import time
+import threading
+import subprocess
+
+from contextlib import closing
+
+#Py3
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+from layman.api import LaymanAPI
+from layman.compatibility import fileopen
+from layman.overlays.source import BINARIES
+
+from benchmarks.utils import make_config, timed
+
+# the upstream kinds benchmarked by default
+KINDS = ['git', 'mercurial', 'svn', 'tar', 'tar-http']
+
+# commands a kind needs, it is skipped without them
+COMMANDS = {'git': ['git'], 'mercurial': ['hg'], 'svn': ['svn', 'svnadmin'],
+    'tar': [], 'tar-http': []}
+
+# files in a fresh upstream, every change adds one more
+FILES = 50
+EBUILD = 'app-misc/bench-%(index)d/bench-%(index)d-1.ebuild'
+
+REPO = '''  <repo quality="experimental" status="unofficial">
+    <name>%(name)s</name>
+    <description>Benchmark overlay</description>
+    <owner><email>layman@localhost</email></owner>
+    <source type="%(type)s">%(src)s</source>
+  </repo>
+'''
+
+#===============================================================================
+#
+# Helper functions
+#
+#-------------------------------------------------------------------------------
+
+def _call(args, cwd=None):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(args, cwd=cwd, stdout=devnull,
+            stderr=subprocess.STDOUT)
+
+
+def _git(*args):
+    _call(['git', '-c', 'user.name=layman',
+        '-c', 'user.email=layman@localhost'] + list(args))
+
+
+def _write_files(work, start, count):
+    '''Writes count ebuild look-alikes into work.'''
+    names = []
+    for index in range(start, start + count):
+        name = EBUILD % {'index': index}
+        target = os.path.join(work, name)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        with fileopen(target, 'w') as ebuild:
+            ebuild.write('EAPI=5\nDESCRIPTION="Benchmark package %d"\n'
+                'SLOT="0"\nKEYWORDS="~amd64"\n' % index)
+        names.append(name)
+    return names
+
+
+def missing_commands(kind):
+    '''Returns the commands needed for kind that are not installed.'''
+    return [command for command in COMMANDS[kind]
+        if BINARIES.resolve(command)[1] is None]
+
+#===============================================================================
+#
+# Upstream classes
+#
+#-------------------------------------------------------------------------------
+
+class Upstream(object):
+    '''
+    A local stand-in for the server an overlay is fetched from.
+    create() sets it up, change() publishes a new revision.
+    '''
+
+    # the source type written to the catalog
+    type = None
+
+    def __init__(self, base, name):
+        self.base = base
+        self.name = name
+        self.work = os.path.join(base, name + '-work')
+        self.files = 0
+
+    def create(self):
+        if not os.path.isdir(self.work):
+            os.makedirs(self.work)
+        self._publish(_write_files(self.work, 0, FILES))
+        self.files = FILES
+
+    def change(self):
+        self._publish(_write_files(self.work, self.files, 1))
+        self.files += 1
+
+    def _publish(self, names):
+        raise NotImplementedError
+
+    def src(self):
+        raise NotImplementedError
+
+    def synced(self, storage):
+        '''Checks that the checkout below storage has the last change.'''
+        return os.path.exists(os.path.join(storage, self.name,
+            EBUILD % {'index': self.files - 1}))
+
+    def catalog_entry(self):
+        return REPO % {'name': self.name, 'type': self.type,
+            'src': self.src()}
+
+    def stop(self):
+        pass
+
+
+class GitUpstream(Upstream):
+    '''A bare git repository pushed to from a work tree.'''
+
+    type = 'git'
+
+    def create(self):
+        self.bare = os.path.join(self.base, self.name + '.git')
+        _git('init', '-q', '--bare', self.bare)
+        _git('init', '-q', self.work)
+        Upstream.create(self)
+
+    def _publish(self, names):
+        _git('-C', self.work, 'add', '-A')
+        _git('-C', self.work, 'commit', '-q', '-m', 'revision %d' % self.files)
+        _git('-C', self.work, 'push', '-q', self.bare, 'HEAD:refs/heads/master')
+        _git('--git-dir', self.bare, 'symbolic-ref', 'HEAD',
+            'refs/heads/master')
+
+    def src(self):
+        return 'file://' + pathname2url(self.bare)
+
+
+class MercurialUpstream(Upstream):
+    '''A mercurial repository without a working copy.'''
+
+    type = 'mercurial'
+
+    def create(self):
+        self.bare = os.path.join(self.base, self.name + '.hg')
+        _call(['hg', 'init', self.work])
+        Upstream.create(self)
+
+    def _publish(self, names):
+        _call(['hg', '--cwd', self.work, 'commit', '-q', '-A',
+            '-u', 'layman', '-m', 'revision %d' % self.files])
+        if not os.path.isdir(self.bare):
+            _call(['hg', 'clone', '-q', '-U', self.work, self.bare])
+        else:
+            _call(['hg', '--cwd', self.work, 'push', '-q', self.bare])
+
+    def src(self):
+        return 'file://' + pathname2url(self.bare)
+
+
+class SvnUpstream(Upstream):
+    '''A subversion repository committed to from a working copy.'''
+
+    type = 'svn'
+
+    def create(self):
+        self.repository = os.path.join(self.base, self.name + '.svn')
+        _call(['svnadmin', 'create', self.repository])
+        _call(['svn', 'checkout', '-q', self.src(), self.work])
+        self._publish(_write_files(self.work, 0, FILES))
+        self.files = FILES
+
+    def _publish(self, names):
+        _call(['svn', 'add', '-q', '--force', '.'], cwd=self.work)
+        _call(['svn', 'commit', '-q', '-m', 'revision %d' % self.files],
+            cwd=self.work)
+
+    def src(self):
+        return 'file://' + pathname2url(self.repository)
+
+
+class TarUpstream(Upstream):
+    '''A tar package rewritten on every change.'''
+
+    type = 'tar'
+
+    def create(self):
+        self.package = os.path.join(self.base, self.name + '.tar.bz2')
+        Upstream.create(self)
+
+    def _publish(self, names):
+        temp_path = self.package + '.tmp'
+        with closing(tarfile.open(temp_path, 'w:bz2')) as package:
+            for name in sorted(os.listdir(self.work)):
+                package.add(os.path.join(self.work, name), arcname=name)
+        # Last-Modified only has a resolution of seconds, a change
+        # within the same second would look unchanged over HTTP
+        self.mtime = max(int(time.time()), getattr(self, 'mtime', 0) + 1)
+        os.utime(temp_path, (self.mtime, self.mtime))
+        os.rename(temp_path, self.package)
+
+    def src(self):
+        return 'file://' + pathname2url(self.package)
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    '''Serves the files below root, without logging every request.'''
+
+    root = None
+
+    def translate_path(self, path):
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.root, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpTarUpstream(TarUpstream):
+    '''A tar package served by a local HTTP server.'''
+
+    def create(self):
+        TarUpstream.create(self)
+        handler = type(str('Handler'), (_QuietHandler,), {'root': self.base})
+        self.server = HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def src(self):
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_port,
+            os.path.basename(self.package))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+UPSTREAMS = {'git': GitUpstream, 'mercurial': MercurialUpstream,
+    'svn': SvnUpstream, 'tar': TarUpstream, 'tar-http': HttpTarUpstream}
+
+#===============================================================================
+#
+# Benchmarks
+#
+#-------------------------------------------------------------------------------
+
+def run(results, kinds=None, overlays=4, jobs=1):
+    '''
+    Times adding, syncing and deleting "overlays" overlays of every
+    kind, using up to jobs parallel jobs.
+    '''
+    for kind in kinds or KINDS:
+        params = {'kind': kind, 'overlays': overlays, 'jobs': jobs}
+        missing = missing_commands(kind)
+        if missing:
+            for name in ('LaymanAPI.add_repos', 'LaymanAPI.sync',
+                    'LaymanAPI.delete_repos'):
+                results.skip(name, 'missing ' + ', '.join(missing), **params)
+            continue
+        tmpdir = tempfile.mkdtemp(prefix='layman-bench-')
+        try:
+            _run_kind(results, kind, overlays, jobs, tmpdir, params)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def _run_kind(results, kind, overlays, jobs, tmpdir, params):
+    upstream_dir = os.path.join(tmpdir, 'upstream')
+    os.mkdir(upstream_dir)
+    upstreams = [UPSTREAMS[kind](upstream_dir, 'bench-%s-%d' % (kind, index))
+        for index in range(overlays)]
+    try:
+        for upstream in upstreams:
+            upstream.create()
+
+        catalog = os.path.join(tmpdir, 'repositories.xml')
+        with fileopen(catalog, 'w') as catalog_file:
+            catalog_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<repositories xmlns="" version="1.0">\n')
+            for upstream in upstreams:
+                catalog_file.write(upstream.catalog_entry())
+            catalog_file.write('</repositories>\n')
+
+        config = make_config(os.path.join(tmpdir, 'storage'),
+            overlays=['file://' + catalog])
+        api = LaymanAPI(config)
+        api.fetch_remote_list()
+        names = [upstream.name for upstream in upstreams]
+
+        def check(result, action):
+            errors = api.get_errors()
+            if not result or errors:
+                raise RuntimeError('%s failed for %s: %s'
+                    % (action, kind, '\n'.join(errors)))
+
+        results.add('LaymanAPI.add_repos', timed(
+            lambda: check(api.add_repos(names, jobs=jobs), 'add'),
+            repeat=1), **params)
+
+        for upstream in upstreams:
+            upstream.change()
+        results.add('LaymanAPI.sync', timed(
+            lambda: check(api.sync(names, output_results=False, jobs=jobs),
+                'sync'), repeat=1), changed=True, **params)
+        for upstream in upstreams:
+            if not upstream.synced(config['storage']):
+                raise RuntimeError('sync missed the change to ' + upstream.name)
+        results.add('LaymanAPI.sync', timed(
+            lambda: check(api.sync(names, output_results=False, jobs=jobs),
+                'sync'), repeat=1), changed=False, **params)
+
+        results.add('LaymanAPI.delete_repos', timed(
+            lambda: check(api.delete_repos(names), 'delete'),
+            repeat=1), **params)
+    finally:
+        for upstream in upstreams:
+            upstream.stop()
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN BENCHMARK UTILITIES
+#################################################################################
+# File:       utils.py
+#
+#             Timing, configuration and result helpers
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''Helpers shared by the benchmarks.'''
+
+from __future__ import unicode_literals
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import platform
+
+from layman.config import BareConfig
+from layman.version import VERSION
+from layman.compatibility import encode, fileopen
+
+# the most precise clock available, time.time() on python 2
+clock = getattr(time, 'perf_counter', time.time)
+
+# bump whenever the layout of the results file changes
+RESULTS_FORMAT = 1
+
+#===============================================================================
+#
+# Helper functions
+#
+#-------------------------------------------------------------------------------
+
+def timed(func, setup=None, repeat=3):
+    '''
+    Calls func repeat times and returns the sorted run times in
+    seconds.  setup, if given, is called before every run, outside
+    of the timing, and its result is passed to func.
+
+    >>> len(timed(lambda: None, repeat=2))
+    2
+    >>> timed(lambda x: x, setup=lambda: 1, repeat=1)[0] >= 0
+    True
+    '''
+    times = []
+    for i in range(repeat):
+        if setup is None:
+            start = clock()
+            func()
+        else:
+            arg = setup()
+            start = clock()
+            func(arg)
+        times.append(clock() - start)
+    return sorted(times)
+
+
+def make_config(storage, overlays=None, quiet=True):
+    '''
+    Returns a BareConfig keeping everything below storage, the
+    config file and /var/lib/layman are never touched.
+    '''
+    config = BareConfig(read_configfile=False)
+    config.set_option('storage', storage)
+    # the %(storage)s defaults only know the default storage
+    for key, name in (('cache', 'cache'), ('local_list', 'overlays.xml'),
+            ('installed', 'installed.xml'), ('make_conf', 'make.conf'),
+            ('repos_conf', 'repos.conf'), ('ssh_control_dir', '.ssh'),
+            ('sync_state', 'sync-state.json'), ('lock_dir', '.locks')):
+        config.set_option(key, os.path.join(storage, name))
+    config.set_option('conf_type', 'repos.conf')
+    config.set_option('nocheck', 'yes')
+    if overlays:
+        config.set_option('overlays', list(overlays))
+    if quiet:
+        config.set_option('quiet', True)
+    if not os.path.isdir(storage):
+        os.makedirs(storage)
+    # repos.conf handling warns about a missing file
+    fileopen(config['repos_conf'], 'a').close()
+    return config
+
+#===============================================================================
+#
+# Class Results
+#
+#-------------------------------------------------------------------------------
+
+class Results(object):
+    '''
+    Collects the timings of a benchmark run and stores them as json,
+    one entry per benchmark and parameter set.
+
+    >>> results = Results()
+    >>> entry = results.add('DbBase.read', [0.25, 0.5, 1.0], size=10)
+    >>> entry['best'], entry['median']
+    (0.25, 0.5)
+    >>> results.data()['results'][0]['params']
+    {'size': 10}
+    '''
+
+    def __init__(self):
+        self.entries = []
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+    def add(self, name, times, **params):
+        '''Records the sorted run times of benchmark name.'''
+        entry = {'name': name,
+            'params': params,
+            'runs': len(times),
+            'best': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'times': times,
+            }
+        self.entries.append(entry)
+        return entry
+
+
+    def skip(self, name, reason, **params):
+        '''Records a benchmark that could not run here.'''
+        self.entries.append({'name': name, 'params': params,
+            'skipped': reason})
+
+
+    def data(self):
+        return {'format': RESULTS_FORMAT,
+            'layman_version': VERSION,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'started': self.started,
+            'results': self.entries,
+            }
+
+
+    def write(self, stream):
+        stream.write(encode(json.dumps(self.data(), indent=1,
+            sort_keys=True)) + '\n')
+
+
+    def summary(self):
+        '''Returns a human readable table of the results.'''
+        lines = []
+        for entry in self.entries:
+            params = ', '.join('%s=%s' % (key, entry['params'][key])
+                for key in sorted(entry['params']))
+            label = '%s (%s)' % (entry['name'], params) if params \
+                else entry['name']
+            if 'skipped' in entry:
+                lines.append('%-60s skipped: %s' % (label, entry['skipped']))
+            else:
+                lines.append('%-60s %10.4fs best %10.4fs median'
+                    % (label, entry['best'], entry['median']))
+        return '\n'.join(lines)
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
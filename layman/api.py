@@ -18,12 +18,16 @@ from __future__ import print_function
 
 import os
 import sys
+import threading
 
 from layman.config          import BareConfig
 from layman.dbbase          import UnknownOverlayException, UnknownOverlayMessage
 from layman.db              import DB
 from layman.remotedb        import RemoteDB
-from layman.overlays.source import require_supported
+from layman.metrics         import Metrics
+from layman.scheduler       import SyncScheduler, source_key
+from layman.syncreport      import OverlayTiming, SyncResults, recording, clock
+from layman.overlays.source import BINARIES, require_supported
 #from layman.utils import path, delete_empty_directory
 from layman.compatibility   import encode
 from layman.utils           import verify_overlay_src
@@ -66,7 +70,11 @@ class LaymanAPI(object):
         self._available_db = None
         self._available_ids = None
         self._error_messages = []
+        # SyncResults of the last sync(), per overlay timing in .report
         self.sync_results = []
+        # serializes installed db and repo config changes made
+        # by parallel sync() workers
+        self._sync_lock = threading.RLock()
 
 
     def is_repo(self, ovl):
@@ -101,46 +109,56 @@ class LaymanAPI(object):
         return [encode(i) for i in repos]
 
 
-    def delete_repos(self, repos):
+    def delete_repos(self, repos, jobs=None):
         """delete the selected repo from the system
 
         @type repos: list of strings or string
         @param repos: ['repo-id1', ...] or 'repo-id'
         @param output: method to handle output if desired
+        @param jobs: int, number of checkouts to remove in parallel,
+                     defaults to the delete_jobs config setting
         @rtype dict
         """
         repos = self._check_repo_type(repos, "delete_repo")
         results = []
+        selected = []
         for ovl in repos:
             if not self.is_installed(ovl):
                 self.output.error("Repository '"+ovl+"' was not installed")
                 results.append(False)
                 continue
-            success = False
+            selected.append(self._get_installed_db().select(ovl))
+        if jobs is None:
+            jobs = self._get_jobs_setting('delete_jobs')
+        if selected:
             try:
-                success = self._get_installed_db().delete(
-                    self._get_installed_db().select(ovl))
+                results.extend(self._get_installed_db().delete_many(selected,
+                    jobs))
             except Exception as e:
                 self._error(
-                        "Exception caught disabling repository '"+ovl+
-                            "':\n"+str(e))
-            results.append(success)
-            self.get_installed(dbreload=True)
+                        "Exception caught disabling repositories '"+
+                        "', '".join(o.name for o in selected)+"':\n"+str(e))
+                results.append(False)
+            # the db was updated in place, refresh the list of ids
+            self._installed_ids = None
         if False in results:
             return False
         return True
 
 
-    def add_repos(self, repos, update_news=False):
+    def add_repos(self, repos, update_news=False, jobs=None):
         """installs the seleted repo id
 
         @type repos: list of strings or string
         @param repos: ['repo-id', ...] or 'repo-id'
         @param update_news: bool, defaults to False
+        @param jobs: int, number of repos to check out in parallel,
+                     defaults to the sync_jobs config setting
         @rtype dict
         """
         repos = self._check_repo_type(repos, "add_repo")
         results = []
+        selected = []
         for ovl in repos:
             if self.is_installed(ovl):
                 self.output.error("Repository '"+ovl+"' was already installed")
@@ -150,15 +168,19 @@ class LaymanAPI(object):
                 self.output.error(UnknownOverlayMessage(ovl))
                 results.append(False)
                 continue
-            success = False
+            selected.append(self._get_remote_db().select(ovl))
+        if jobs is None:
+            jobs = self.get_sync_jobs()
+        if selected:
             try:
-                success = self._get_installed_db().add(
-                    self._get_remote_db().select(ovl))
+                results.extend(self._get_installed_db().add_many(selected,
+                    jobs))
             except Exception as e:
-                self._error("Exception caught enabling repository '"+ovl+
-                    "' : "+str(e))
-            results.append(success)
-            self.get_installed(dbreload=True)
+                self._error("Exception caught enabling repositories '"+
+                    "', '".join(o.name for o in selected)+"' : "+str(e))
+                results.append(False)
+            # the db was updated in place, refresh the list of ids
+            self._installed_ids = None
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -213,12 +235,15 @@ class LaymanAPI(object):
         result = {}
 
         if local:
+            # installed.xml alone, the remote lists are never loaded
             db = self._get_installed_db()
+            known = self.is_installed
         else:
             db = self._get_remote_db()
+            known = self.is_repo
 
         for ovl in repos:
-            if not self.is_repo(ovl):
+            if not known(ovl):
                 self.output.error(UnknownOverlayMessage(ovl))
                 result[ovl] = ('', False, False)
                 continue
@@ -265,12 +290,15 @@ class LaymanAPI(object):
         result = {}
 
         if local:
+            # installed.xml alone, the remote lists are never loaded
             db = self._get_installed_db()
+            known = self.is_installed
         else:
             db = self._get_remote_db()
+            known = self.is_repo
 
         for ovl in repos:
-            if not self.is_repo(ovl):
+            if not known(ovl):
                 self.output.error(UnknownOverlayMessage(ovl))
                 result[ovl] = ('', False, False)
                 continue
@@ -385,74 +413,58 @@ class LaymanAPI(object):
             return True, msg
         return False, ''
 
-    def sync(self, repos, output_results=True, update_news=False):
+    def sync(self, repos, output_results=True, update_news=False, jobs=None):
         """syncs the specified repo(s) specified by repos
 
         @type repos: list of strings or string
         @param repos: ['repo-id1', ...] or 'repo-id'
         @param output_results: bool, defaults to True
         @param update_news: bool, defaults to False
+        @param jobs: int, number of repos to sync in parallel,
+                     defaults to the sync_jobs config setting
         @rtype bool or {'repo-id': bool,...}
         """
         self.output.debug("API.sync(); repos to sync = %s" % ', '.join((x.decode() if isinstance(x, bytes) else x) for x in repos), 5)
         fatals = []
         warnings = []
         success  = []
+        started = clock()
         repos = self._check_repo_type(repos, "sync")
         db = self._get_installed_db()
-
-        self.output.debug("API.sync(); starting ovl loop", 5)
-        for ovl in repos:
-            update_url = False
-            self.output.debug("API.sync(); starting ovl = %s" %ovl, 5)
-            try:
-                #self.output.debug("API.sync(); selecting %s, db = %s" % (ovl, str(db)), 5)
-                odb = db.select(ovl)
-                self.output.debug("API.sync(); %s now selected" %ovl, 5)
-            except UnknownOverlayException as error:
-                #self.output.debug("API.sync(); UnknownOverlayException selecting %s" %ovl, 5)
-                #self._error(str(error))
-                fatals.append((ovl,
-                    'Failed to select overlay "' + ovl + '".\nError was: '
-                    + str(error)))
-                self.output.debug("API.sync(); UnknownOverlayException "
-                    "selecting %s.   continuing to next ovl..." %ovl, 5)
-                continue
-
-            try:
-                self.output.debug("API.sync(); try: self._get_remote_db().select(ovl)", 5)
-                ordb = self._get_remote_db().select(ovl)
-            except UnknownOverlayException:
-                message = 'Overlay "%s" could not be found in the remote lists.\n' \
-                        'Please check if it has been renamed and re-add if necessary.' % ovl
-                warnings.append((ovl, message))
-            else:
-                self.output.debug("API.sync(); else: self._get_remote_db().select(ovl)", 5)
-
-                (diff_type, type_msg) = self._verify_overlay_type(odb, ordb)
-                (update_url, url_msg) = self._verify_overlay_source(odb, ordb)
-
-            try:
-                if diff_type:
-                    self.output.debug("API.sync(); starting API.readd_repos(ovl)", 5)
-                    warnings.append((ovl, type_msg))
-                    self.readd_repos(ovl)
-                    success.append((ovl, 'Successfully readded overlay "' + ovl + '".'))
-                else:
-                    if update_url:
-                        self.output.debug("API.sync() starting db.update(ovl)", 5)
-                        warnings.append((ovl, url_msg))
-                        update_success = db.update(ordb, available_srcs)
-                        if not update_success:
-                            self.output.warn('Failed to update repo...readding', 2)
-                            self.readd_repos(ovl)
-                    self.output.debug("API.sync(); starting db.sync(ovl)", 5)
-                    db.sync(ovl)
-                    success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
-            except Exception as error:
-                fatals.append((ovl,
-                    'Failed to sync overlay "' + ovl + '".\nError was: '
-                    + str(error)))
+        # load the remote db up front so the workers share a single instance
+        self._get_remote_db()
+        if jobs is None:
+            jobs = self.get_sync_jobs()
+
+        revisions = self._probe_repos(repos, db)
+        timings = dict((ovl, OverlayTiming(ovl, *self._sync_key(ovl, db)))
+            for ovl in repos)
+        stale = set(ovl for ovl in repos
+            if not db.is_current(ovl, revisions.get(ovl)))
+        self.output.debug("API.sync(); %d of %d repos changed upstream"
+            % (len(stale), len(repos)), 5)
+
+        def sync_key(ovl):
+            # repos known to be unchanged only check the remote lists
+            # for a new source and need no host or type slot
+            if ovl in stale:
+                return self._sync_key(ovl, db)
+            return ('', None)
+
+        self.output.debug("API.sync(); starting ovl loop, jobs = %s"
+            % str(jobs), 5)
+        scheduler = SyncScheduler(self.config, jobs)
+        # the sync state is saved once, not after every repo
+        with db.state.batch():
+            results = scheduler.run(
+                lambda ovl: self._sync_repo(ovl, db, revisions.get(ovl),
+                    timings[ovl]),
+                repos, sync_key)
+
+        for _success, _warnings, _fatals in results:
+            success.extend(_success)
+            warnings.extend(_warnings)
+            fatals.extend(_fatals)
 
         if output_results:
             if success:
@@ -473,7 +485,10 @@ class LaymanAPI(object):
                     message += result + '\n'
                 self.output.error(message)
 
-        self.sync_results = (success, warnings, fatals)
+        self.sync_results = SyncResults(success, warnings, fatals,
+            [timings[ovl] for ovl in repos], duration=clock() - started,
+            jobs=jobs)
+        Metrics(self.config).record_sync(self.sync_results, db.list_ids())
 
         if update_news:
             self.update_news(repos)
@@ -481,6 +496,154 @@ class LaymanAPI(object):
         return fatals == []
 
 
+    def _probe_repos(self, repos, db):
+        """asks upstream for the current revision of all repos at once
+
+        @param repos: list of repo ids
+        @param db: the installed db
+        @rtype dict {'repo-id': revision or None, ...}
+        """
+        def probe(ovl):
+            try:
+                return db.probe(ovl)
+            except UnknownOverlayException:
+                return None
+
+        if not self.config.get_option('sync_probe'):
+            return {}
+        jobs = self._get_jobs_setting('probe_jobs')
+        self.output.debug("API._probe_repos(); probing %d repos, jobs = %d"
+            % (len(repos), jobs), 5)
+        scheduler = SyncScheduler(self.config, jobs)
+        return dict(zip(repos, scheduler.run(probe, repos,
+            lambda ovl: self._sync_key(ovl, db))))
+
+
+    def _sync_repo(self, ovl, db, revision=None, timing=None):
+        """syncs a single repo, safe to run from several threads at once
+
+        @param ovl: repo id
+        @param db: the installed db
+        @param revision: the upstream revision found by _probe_repos()
+        @param timing: OverlayTiming recording how long the sync took
+        @rtype tuple of lists (success, warnings, fatals)
+        """
+        if timing is None:
+            timing = OverlayTiming(ovl)
+        timing.start()
+        with recording(timing):
+            result = self._sync_overlay(ovl, db, revision, timing)
+        timing.finish(*result)
+        return result
+
+
+    def _sync_overlay(self, ovl, db, revision, timing):
+        """does the work of _sync_repo()"""
+        fatals = []
+        warnings = []
+        success  = []
+        diff_type = False
+        update_url = False
+        self.output.debug("API.sync(); starting ovl = %s" %ovl, 5)
+        try:
+            #self.output.debug("API.sync(); selecting %s, db = %s" % (ovl, str(db)), 5)
+            odb = db.select(ovl)
+            self.output.debug("API.sync(); %s now selected" %ovl, 5)
+        except UnknownOverlayException as error:
+            #self.output.debug("API.sync(); UnknownOverlayException selecting %s" %ovl, 5)
+            #self._error(str(error))
+            fatals.append((ovl,
+                'Failed to select overlay "' + ovl + '".\nError was: '
+                + str(error)))
+            self.output.debug("API.sync(); UnknownOverlayException "
+                "selecting %s.   continuing to next ovl..." %ovl, 5)
+            return success, warnings, fatals
+
+        try:
+            self.output.debug("API.sync(); try: self._get_remote_db().select(ovl)", 5)
+            with timing.phase('remote_lookup'):
+                ordb = self._get_remote_db().select(ovl)
+        except UnknownOverlayException:
+            message = 'Overlay "%s" could not be found in the remote lists.\n' \
+                    'Please check if it has been renamed and re-add if necessary.' % ovl
+            warnings.append((ovl, message))
+        else:
+            self.output.debug("API.sync(); else: self._get_remote_db().select(ovl)", 5)
+
+            with timing.phase('verify'):
+                (diff_type, type_msg) = self._verify_overlay_type(odb, ordb)
+                (update_url, url_msg) = self._verify_overlay_source(odb, ordb)
+                available_srcs = set(e.src for e in ordb.sources)
+
+        try:
+            if diff_type:
+                self.output.debug("API.sync(); starting API.readd_repos(ovl)", 5)
+                warnings.append((ovl, type_msg))
+                timing.readd = True
+                # waiting for another readd is not vcs time
+                with self._sync_lock:
+                    with timing.phase('vcs'):
+                        self.readd_repos(ovl)
+                success.append((ovl, 'Successfully readded overlay "' + ovl + '".'))
+            else:
+                if update_url:
+                    self.output.debug("API.sync() starting db.update(ovl)", 5)
+                    warnings.append((ovl, url_msg))
+                    with self._sync_lock:
+                        with timing.phase('vcs'):
+                            update_success = db.update(ordb, available_srcs)
+                            if not update_success:
+                                self.output.warn('Failed to update repo...readding', 2)
+                                timing.readd = True
+                                self.readd_repos(ovl)
+                if not update_url and db.is_current(ovl, revision):
+                    success.append((ovl, 'Overlay "' + ovl +
+                        '" is already up to date.'))
+                    timing.status = 'current'
+                    return success, warnings, fatals
+                self.output.debug("API.sync(); starting db.sync(ovl)", 5)
+                with timing.phase('vcs'):
+                    db.sync(ovl, revision)
+                success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
+        except Exception as error:
+            fatals.append((ovl,
+                'Failed to sync overlay "' + ovl + '".\nError was: '
+                + str(error)))
+
+        return success, warnings, fatals
+
+
+    @staticmethod
+    def _sync_key(ovl, db):
+        """returns the (host, type_key) a repo is synced from,
+        used by the scheduler to group the work"""
+        try:
+            source = db.select(ovl).sources[0]
+        except (UnknownOverlayException, IndexError):
+            return ('', None)
+        return source_key(source)
+
+
+    def get_sync_jobs(self):
+        """returns the number of repos to sync in parallel
+        as set by the sync_jobs config setting
+
+        @rtype int
+        """
+        return self._get_jobs_setting('sync_jobs')
+
+
+    def _get_jobs_setting(self, option):
+        """reads a number of parallel jobs from the config"""
+        try:
+            jobs = int(self.config[option])
+        except (TypeError, ValueError):
+            self.output.warn('Invalid %s setting "%s", running one '
+                'job at a time' % (option, self.config[option]), 2)
+            jobs = 1
+        return max(jobs, 1)
+
+
     def fetch_remote_list(self):
         """Fetches the latest remote overlay list
 
@@ -546,6 +709,9 @@ class LaymanAPI(object):
             self.output.error('Failed to fetch overlay list!\n Original Error was: '
                     + str(error))
             return False
+        finally:
+            if self._available_db is not None:
+                Metrics(self.config).record_fetch(self._available_db)
         self.get_available(dbreload)
         return succeeded
 
@@ -560,7 +726,8 @@ class LaymanAPI(object):
 
 
     def get_installed(self, dbreload=False):
-        """returns the list of installed overlays"""
+        """returns the list of installed overlays, reading only the
+        installed db (never the remote lists)"""
         if self._installed_ids is None or dbreload:
             self._installed_ids = self._get_installed_db(dbreload).list_ids()
         return self._installed_ids[:]
@@ -616,7 +783,8 @@ class LaymanAPI(object):
 
     def supported_types(self):
         """returns a dictionary of all repository types,
-        with boolean values"""
+        with boolean values.  The commands are resolved only once per
+        process, see get_binaries()."""
         cmds = [x for x in self.config.keys() if '_command' in x]
         supported = {}
         for cmd in cmds:
@@ -626,6 +794,30 @@ class LaymanAPI(object):
         return supported
 
 
+    def get_binaries(self, versions=False, refresh=False):
+        """returns a dictionary of all repository types with the
+        command configured, the binary it resolves to (None if it is
+        missing) and, if versions is True, the first line of its
+        --version output.
+
+        @param versions: boolean, run each binary once to get its version.
+        @param refresh: boolean, look for the binaries again, e.g. after
+            installing a missing tool.
+        @rtype dict
+        """
+        if refresh:
+            BINARIES.clear()
+        binaries = {}
+        for cmd in [x for x in self.config.keys() if '_command' in x]:
+            command = self.config[cmd]
+            binaries[cmd.split('_')[0]] = {
+                'command': command,
+                'path': BINARIES.resolve(command)[1],
+                'version': BINARIES.version(command) if versions else None,
+                }
+        return binaries
+
+
     def update_news(self, repos=None):
         try:
             if self.config['news_reporter'] == 'portage':
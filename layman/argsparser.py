@@ -32,7 +32,7 @@ __version__ = "$Id: config.py 286 2007-01-09 17:48:23Z wrobel $"
 
 import sys
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, SUPPRESS
 
 from layman.config import BareConfig
 from layman.constants import OFF
@@ -121,6 +121,17 @@ class ArgsParser(BareConfig):
                              help = 'Display information about the specified overlay'
                              '.')
 
+        actions.add_argument('-j',
+                             '--jobs',
+                             action = 'store',
+                             dest = 'sync_jobs',
+                             type = int,
+                             default = SUPPRESS,
+                             help = 'Use this with the --sync, --sync-all or --add s'
+                             'witch to synchronize or add up to this many overlays '
+                             'in parallel. Overrides the sync_jobs setting of the c'
+                             'onfig file.')
+
         actions.add_argument('-L',
                              '--list',
                              action = 'store_true',
@@ -131,6 +142,13 @@ class ArgsParser(BareConfig):
                              action = 'store_true',
                              help = 'List the locally installed overlays.')
 
+        actions.add_argument('--local',
+                             action = 'store_true',
+                             help = 'Use this with the --info switch to show what is'
+                             ' recorded for your locally installed overlays. Only t'
+                             'he installed overlays list is read, the remote lists '
+                             'are left alone.')
+
         actions.add_argument('-n',
                              '--nofetch',
                              action = 'store_true',
@@ -239,6 +257,13 @@ class ArgsParser(BareConfig):
                               ' you set this below 2 the same warning as given for --'
                               'quiet applies!')
 
+        out_opts.add_argument('--report-json',
+                              action = 'store',
+                              metavar = 'FILE',
+                              help = 'Use this with the --sync or --sync-all switc'
+                              'h to write how long every overlay took to sync, br'
+                              'oken down into its phases, as json to FILE.')
+
         out_opts.add_argument('-v',
                               '--verbose',
                               action = 'store_true',
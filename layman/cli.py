@@ -278,6 +278,13 @@ class Main(object):
             selection = self.api.get_installed()
         self.output.debug('Updating selected overlays', 6)
         result = self.api.sync(selection, update_news=True)
+        if self.config['report_json']:
+            try:
+                self.api.sync_results.write_json(self.config['report_json'])
+            except (IOError, OSError) as error:
+                self.output.error('Failed to write the sync report to "%s".'
+                    '\nError was: %s' % (self.config['report_json'],
+                    str(error)))
         # blank newline  -- no " *"
         self.output.notice('')
         return result
@@ -304,13 +311,18 @@ class Main(object):
         ''' Print information about the specified overlays.
         '''
         selection = decode_selection(self.config['info'])
+        # --local never needs the remote lists
+        local = bool(self.config['local'])
         if ALL_KEYWORD in selection:
-            selection = self.api.get_available()
+            if local:
+                selection = self.api.get_installed()
+            else:
+                selection = self.api.get_available()
 
         list_printer = ListPrinter(self.config)
         _complain = self.config['nocheck'] or self.config['verbose']
 
-        info = self.api.get_info_str(selection, local=False,
+        info = self.api.get_info_str(selection, local=local,
             verbose=True, width=list_printer.width)
         list_printer.print_shortdict(info, complain=_complain)
         # blank newline  -- no " *"
@@ -108,6 +108,7 @@ class BareConfig(object):
             'conf_type': 'make.conf',
             'require_repoconfig': 'Yes',
             'clean_tar': 'yes',
+            'tar_native': 'yes',
             'make_conf' : '%(storage)s/make.conf',
             'repos_conf': '/etc/portage/repos.conf/layman.conf',
             'conf_module': ['make_conf', 'repos_conf'],
@@ -133,7 +134,8 @@ class BareConfig(object):
             'rsync_command': path([self.root, EPREFIX,'/usr/bin/rsync']),
             'svn_command': path([self.root, EPREFIX,'/usr/bin/svn']),
             'tar_command': path([self.root, EPREFIX,'/bin/tar']),
-            't/f_options': ['clean_tar', 'nocheck', 'require_repoconfig'],
+            't/f_options': ['clean_tar', 'tar_native', 'nocheck', 'require_repoconfig',
+                'sync_probe', 'git_shared_objects'],
             'bzr_addopts' : '',
             'bzr_syncopts' : '',
             'cvs_addopts' : '',
@@ -163,7 +165,23 @@ class BareConfig(object):
             'g-sorcery_postsync' : '',
             'git_user': 'layman',
             'git_email': 'layman@localhost',
+            'git_clone_mode': 'full',
+            'git_shared_objects': 'no',
             'support_url_updates': ['Bzr', 'cvs', 'Git', 'Mercurial', 'Subversion'],
+            'fetch_jobs': '4',
+            'delete_jobs': '4',
+            'sync_jobs': '1',
+            'sync_host_jobs': '4',
+            'sync_host_limits': '',
+            'sync_type_limits': '',
+            'ssh_control_dir': '%(storage)s/.ssh',
+            'ssh_control_persist': '60',
+            'sync_probe': 'yes',
+            'probe_jobs': '8',
+            'sync_state': '%(storage)s/sync-state.json',
+            'lock_dir': '%(storage)s/.locks',
+            'metrics_textfile': '',
+            'metrics_state': '%(storage)s/metrics.json',
             }
         self._options = {
             'config': config if config else self._defaults['config'],
@@ -29,9 +29,14 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 
 import os, os.path
 
-from   layman.utils             import path, delete_empty_directory
+from   layman.utils             import path, delete_empty_directory, run_jobs
 from   layman.dbbase            import DbBase
 from   layman.repoconfmanager   import RepoConfManager
+from   layman.scheduler         import SyncScheduler, source_key
+from   layman.syncstate         import get_sync_state
+from   layman.syncreport        import set_exit_code
+from   layman.lock              import INSTALLED_LOCK, get_lock_manager, \
+                                       overlay_lock
 
 #===============================================================================
 #
@@ -42,6 +47,8 @@ from   layman.repoconfmanager   import RepoConfManager
 class DB(DbBase):
     ''' Handle the list of installed overlays.'''
 
+    lock_name = INSTALLED_LOCK
+
     def __init__(self, config):
 
         self.config = config
@@ -50,19 +57,28 @@ class DB(DbBase):
         self.path = config['installed']
         self.output.debug("DB.__init__(): config['installed'] = %s" % self.path, 3)
 
+        # installed.pickle lets local queries skip parsing installed.xml,
+        # it is only kept beside an installed.xml in layman's storage
+        self.compile_cache = (os.path.dirname(os.path.abspath(self.path))
+            == os.path.abspath(config['storage']))
+
         if config['nocheck']:
             ignore = 2
         else:
             ignore = 1
 
 
-        DbBase.__init__(self,
-                          config,
-                          paths=[config['installed'], ],
-                          ignore=ignore,
-                          )
+        with get_lock_manager(config).lock(INSTALLED_LOCK, shared=True):
+            DbBase.__init__(self,
+                              config,
+                              paths=[config['installed'], ],
+                              ignore=ignore,
+                              )
+            # what installed.xml looked like when it was read
+            self._signature = self._installed_signature()
 
         self.repo_conf = RepoConfManager(self.config, self.overlays)
+        self.state = get_sync_state(self.config)
 
         self.output.debug('DB handler initiated', 6)
 
@@ -77,6 +93,40 @@ class DB(DbBase):
     def _broken_catalog_hint(self):
         return ''
 
+
+    def _installed_signature(self):
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size, info.st_ino)
+
+
+    def _refresh(self):
+        '''
+        Re-reads installed.xml if another layman process changed it
+        since it was read, so committing does not undo those changes.
+        Must be called holding the INSTALLED_LOCK exclusive.
+        '''
+        signature = self._installed_signature()
+        if signature == self._signature:
+            return
+        self.output.debug('DB._refresh(): %s changed, re-reading it'
+            % self.path, 4)
+        self.overlays.clear()
+        if signature is not None:
+            self.read_file(self.path)
+        self._signature = signature
+
+
+    def _commit(self):
+        '''Writes installed.xml.  Must be called holding the
+        INSTALLED_LOCK exclusive.'''
+        self.write(self.path)
+        self._signature = self._installed_signature()
+        if self.compile_cache:
+            self.write_compiled(self.path, list(self.overlays))
+
     def add(self, overlay):
         '''
         Add an overlay to the local list of overlays.
@@ -126,33 +176,90 @@ class DB(DbBase):
         >>> shutil.rmtree(tmpdir)
         '''
 
-        if overlay.name not in self.overlays.keys():
-            result = overlay.add(self.config['storage'])
+        return self.add_many([overlay])[0]
+
+
+    def add_many(self, overlays, jobs=1):
+        '''
+        Adds several overlays at once.  Up to jobs checkouts run in
+        parallel, then all overlays that were checked out successfully
+        are written to the local list and the repo config files in
+        one go.
+
+        @param overlays: list of layman.overlay.Overlay instances.
+        @param jobs: int, number of overlays to check out in parallel.
+        @rtype list of booleans, one per overlay.
+        '''
+        results = [False] * len(overlays)
+        pending = []
+        for index, overlay in enumerate(overlays):
+            if overlay.name in self.overlays or \
+                    overlay.name in [overlays[i].name for i in pending]:
+                self.output.error('Repository "' + overlay.name +
+                    '" already in the local (installed) list!')
+            else:
+                pending.append(index)
+
+        def checkout(index):
+            overlay = overlays[index]
+            overlay.state = self.state
+            # asked before the checkout, a change upstream in between
+            # only costs the next sync a needless pull
+            revision = None
+            if self.config.get_option('sync_probe') and \
+                    len(overlay.sources) == 1:
+                revision = self._probe(overlay)
+            try:
+                with self.locks.lock(overlay_lock(overlay.name)):
+                    return overlay.add(self.config['storage']), revision
+            except Exception as error:
+                self.output.error('Adding repository "%s" failed!'
+                    '\nError was: %s' % (overlay.name, str(error)))
+                return 1, revision
+
+        scheduler = SyncScheduler(self.config, jobs)
+        checkouts = scheduler.run(checkout, pending,
+            lambda index: source_key(overlays[index].sources[0]))
+
+        added = []
+        revisions = {}
+        for index, (result, revision) in zip(pending, checkouts):
+            overlay = overlays[index]
             if result == 0:
                 if 'priority' in self.config.keys():
                     overlay.set_priority(self.config['priority'])
-                self.overlays[overlay.name] = overlay
-                self.write(self.path)
-                repo_ok = self.repo_conf.add(overlay)
-                return repo_ok
+                added.append(index)
+                revisions[index] = revision
+                continue
+            mdir = path([self.config['storage'], overlay.name])
+            delete_empty_directory(mdir, self.output)
+            if os.path.exists(mdir):
+                self.output.error('Adding repository "%s" failed!'
+                            ' Possible remains of the operation have NOT'
+                            ' been removed and may be left at "%s".'
+                            ' Please remove them manually if required.' \
+                            % (overlay.name, mdir))
             else:
-                mdir = path([self.config['storage'], overlay.name])
-                delete_empty_directory(mdir, self.output)
-                if os.path.exists(mdir):
-                    self.output.error('Adding repository "%s" failed!'
-                                ' Possible remains of the operation have NOT'
-                                ' been removed and may be left at "%s".'
-                                ' Please remove them manually if required.' \
-                                % (overlay.name, mdir))
-                    return False
-                else:
-                    self.output.error(
-                        'Adding repository "%s" failed!' % overlay.name)
-                    return False
-        else:
-            self.output.error('Repository "' + overlay.name +
-                '" already in the local (installed) list!')
-            return False
+                self.output.error(
+                    'Adding repository "%s" failed!' % overlay.name)
+
+        if added:
+            with self.locks.lock(INSTALLED_LOCK):
+                self._refresh()
+                for index in added:
+                    self.overlays[overlays[index].name] = overlays[index]
+                self._commit()
+                repo_ok = self.repo_conf.add_all([overlays[i] for i in added])
+            for index in added:
+                results[index] = repo_ok
+                # the first sync may skip an overlay unchanged since
+                if revisions[index]:
+                    self.state.set(overlays[index].name, 'revision',
+                        revisions[index])
+                    self.state.set(overlays[index].name, 'source',
+                        overlays[index].sources[0].src)
+            self.state.write()
+        return results
 
 
     def delete(self, overlay):
@@ -212,15 +319,57 @@ class DB(DbBase):
         >>> shutil.rmtree(tmpdir)
         '''
 
-        if overlay.name in self.overlays.keys():
-            overlay.delete(self.config['storage'])
-            self.repo_conf.delete(overlay)
-            del self.overlays[overlay.name]
-            self.write(self.path)
-        else:
-            self.output.error('No local overlay named "' + overlay.name + '"!')
-            return False
-        return True
+        return self.delete_many([overlay])[0]
+
+
+    def delete_many(self, overlays, jobs=None):
+        '''
+        Deletes several overlays at once.  The checkouts are removed
+        in parallel, then the local list and the repo config files are
+        written once for all overlays removed.
+
+        @param overlays: list of layman.overlay.Overlay instances.
+        @param jobs: int, number of checkouts to remove in parallel,
+                     defaults to the delete_jobs config setting.
+        @rtype list of booleans, one per overlay.
+        '''
+        if jobs is None:
+            jobs = self.config['delete_jobs']
+        results = [False] * len(overlays)
+        pending = []
+        for index, overlay in enumerate(overlays):
+            if overlay.name in self.overlays.keys():
+                pending.append(index)
+            else:
+                self.output.error('No local overlay named "' + overlay.name + '"!')
+
+        def remove(index):
+            overlay = overlays[index]
+            overlay.state = self.state
+            try:
+                with self.locks.lock(overlay_lock(overlay.name)):
+                    overlay.delete(self.config['storage'])
+            except Exception as error:
+                self.output.error('Deleting repository "%s" failed!'
+                    '\nError was: %s' % (overlay.name, str(error)))
+                return False
+            return True
+
+        removed = [index for index, result
+            in zip(pending, run_jobs(remove, pending, jobs)) if result]
+
+        if removed:
+            with self.locks.lock(INSTALLED_LOCK):
+                self._refresh()
+                self.repo_conf.delete_all([overlays[i] for i in removed])
+                for index in removed:
+                    if overlays[index].name in self.overlays:
+                        del self.overlays[overlays[index].name]
+                    self.state.forget(overlays[index].name)
+                    results[index] = True
+                self._commit()
+            self.state.write()
+        return results
 
 
     def update(self, overlay, available_srcs):
@@ -231,23 +380,83 @@ class DB(DbBase):
         @params available_srcs: set of available source URLs.
         '''
 
-        source, result = self.overlays[overlay.name].update(self.config['storage'],
-                                                    available_srcs)
-        self.overlays[overlay.name].sources = source
-        self.repo_conf.update(self.overlays[overlay.name])
-        self.write(self.path)
+        with self.locks.lock(overlay_lock(overlay.name)):
+            self.overlays[overlay.name].state = self.state
+            source, result = self.overlays[overlay.name].update(
+                self.config['storage'], available_srcs)
+        with self.locks.lock(INSTALLED_LOCK):
+            self._refresh()
+            if overlay.name in self.overlays:
+                installed = self.overlays[overlay.name]
+                installed.sources = source
+                # stored again so write() serializes it anew
+                self.overlays[overlay.name] = installed
+                self.repo_conf.update(installed)
+                self._commit()
 
         return result
 
-    def sync(self, overlay_name):
-        '''Synchronize the given overlay.'''
+    def probe(self, overlay_name):
+        '''
+        Asks upstream for the current revision of the given overlay
+        without syncing it.  Returns None if probing is disabled, the
+        overlay is not checked out or the source type cannot tell.
+        '''
+        if not self.config.get_option('sync_probe'):
+            return None
+        overlay = self.select(overlay_name)
+        if not os.path.exists(path([self.config['storage'], overlay_name])):
+            return None
+        return self._probe(overlay)
+
+
+    def _probe(self, overlay):
+        '''Does the work of probe() for an Overlay object.'''
+        overlay.state = self.state
+        try:
+            revision = overlay.probe(self.config['storage'])
+        except Exception as error:
+            self.output.debug('DB.probe(): probing "%s" failed: %s'
+                % (overlay.name, str(error)), 4)
+            return None
+        self.output.debug('DB.probe(): %s is at %s'
+            % (overlay.name, str(revision)), 4)
+        return revision
+
+
+    def is_current(self, overlay_name, revision):
+        '''
+        Checks whether revision is the one recorded at the last
+        successful sync of the given overlay from its current source.
+        '''
+        if not revision:
+            return False
+        overlay = self.select(overlay_name)
+        return (self.state.get(overlay_name, 'revision') == revision and
+            self.state.get(overlay_name, 'source') == overlay.sources[0].src)
+
+
+    def sync(self, overlay_name, revision=None):
+        '''Synchronize the given overlay.  If revision is given it is
+        recorded as the one synced on success.'''
 
         overlay = self.select(overlay_name)
-        result = overlay.sync(self.config['storage'])
+        overlay.state = self.state
+        with self.locks.lock(overlay_lock(overlay_name)):
+            result = overlay.sync(self.config['storage'])
+        set_exit_code(result)
         if result:
+            self.state.forget(overlay_name)
+            self.state.write()
             raise Exception('Syncing overlay "' + overlay_name +
                             '" returned status ' + str(result) + '!' +
                             '\ndb.sync()')
+        if revision:
+            self.state.set(overlay_name, 'revision', revision)
+            self.state.set(overlay_name, 'source', overlay.sources[0].src)
+        else:
+            self.state.forget(overlay_name, 'revision')
+        self.state.write()
 
 
 #===============================================================================
@@ -31,12 +31,28 @@ __version__ = "$Id: overlay.py 273 2006-12-30 15:54:50Z wrobel $"
 #-------------------------------------------------------------------------------
 
 import sys, os, os.path
+import io
+import stat
+import threading
 import xml
+import xml.parsers.expat
 import xml.etree.ElementTree as ET # Python 2.5
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 #from   layman.debug              import OUT
 from   layman.utils              import indent
-from   layman.compatibility      import fileopen
+from   layman.compatibility      import encode, fileopen
+from   layman.lock               import get_lock_manager
 from   layman.overlays.overlay   import Overlay
 
 
@@ -47,6 +63,16 @@ else:
     _UNICODE = 'UTF-8'
 
 
+# bump when the layout of Overlay.to_cache() changes
+COMPILED_CACHE_VERSION = 1
+
+# size of the pieces xml text is parsed in
+PARSE_CHUNK_SIZE = 64 * 1024
+
+# ElementTree reports syntax errors as ParseError since Python 2.7
+PARSE_ERRORS = (getattr(ET, 'ParseError', xml.parsers.expat.ExpatError),
+    xml.parsers.expat.ExpatError)
+
 #===============================================================================
 #
 # Class UnknownOverlayException
@@ -75,9 +101,163 @@ class BrokenOverlayCatalog(ValueError):
         else:
             hint = '\nHint: %s' % hint
 
+        if hasattr(expat_error, 'position'):
+            # ElementTree.ParseError
+            line, offset = expat_error.position
+        else:
+            line, offset = expat_error.lineno, expat_error.offset
+
         super(BrokenOverlayCatalog, self).__init__(
             'XML parsing failed for "%(origin)s" (line %(line)d, column %(column)d)%(hint)s' % \
-            {'line':expat_error.lineno, 'column':expat_error.offset + 1, 'origin':origin, 'hint':hint})
+            {'line':line, 'column':offset + 1, 'origin':origin, 'hint':hint})
+
+
+#===============================================================================
+#
+# Class OverlayMapping
+#
+#-------------------------------------------------------------------------------
+
+class _PendingOverlay(object):
+    '''An overlay definition not turned into an Overlay yet, either
+    its <repo> element or an Overlay.to_cache() result.'''
+
+    __slots__ = ('xml', 'cached')
+
+    def __init__(self, xml=None, cached=None):
+        self.xml = xml
+        self.cached = cached
+
+
+class OverlayMapping(MutableMapping):
+    '''
+    Maps overlay names to Overlay objects, creating each object from
+    its definition only when it is accessed for the first time.
+    Overlays stored or deleted are remembered until take_dirty(), an
+    Overlay changed in place must be stored again to be noticed.
+
+    >>> from layman.output import Message
+    >>> a = OverlayMapping({'output': Message()})
+    >>> repo = ET.fromstring('<repo><name>foo</name><description>d'
+    ...     '</description><owner><email>a@b</email></owner>'
+    ...     '<source type="rsync">rsync://x/foo</source></repo>')
+    >>> a.add_xml(repo)
+    'foo'
+    >>> 'foo' in a, a.is_loaded('foo')
+    (True, False)
+    >>> a['foo'].sources[0].src
+    'rsync://x/foo'
+    >>> a.is_loaded('foo')
+    True
+    >>> len(a.take_dirty())
+    0
+    >>> a['foo'] = a['foo']
+    >>> sorted(a.take_dirty()), len(a.take_dirty())
+    (['foo'], 0)
+    '''
+
+    def __init__(self, config, ignore=0):
+        self.config = config
+        self.ignore = ignore
+        self._entries = {}
+        # names stored or deleted since the last take_dirty()
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+
+    @staticmethod
+    def _xml_name(xml):
+        '''Reads the overlay name like Overlay.from_xml() does.'''
+        _name = xml.find('name')
+        if _name is not None:
+            return encode((_name.text or '').strip())
+        if 'name' in xml.attrib:
+            return encode(xml.attrib['name'])
+        return None
+
+
+    def add_xml(self, xml):
+        '''Adds the overlay defined by a <repo> element and returns
+        its name.'''
+        name = self._xml_name(xml)
+        if name is None:
+            # let Overlay report the broken definition right away
+            ovl = Overlay(config=self.config, xml=xml, ignore=self.ignore)
+            name = ovl.name
+            self[name] = ovl
+        else:
+            with self._lock:
+                self._entries[name] = _PendingOverlay(xml=xml)
+        return name
+
+
+    def add_cached(self, cached):
+        '''Adds the overlay defined by an Overlay.to_cache() result and
+        returns its name.'''
+        with self._lock:
+            self._entries[cached['name']] = _PendingOverlay(cached=cached)
+        return cached['name']
+
+
+    def is_loaded(self, name):
+        '''Checks whether the Overlay object for name exists already.'''
+        return not isinstance(self._entries[name], _PendingOverlay)
+
+
+    def definition(self, name):
+        '''Returns the Overlay.to_cache() form of overlay name, without
+        creating the Overlay object if it was read from a compiled cache.'''
+        with self._lock:
+            entry = self._entries[name]
+            if isinstance(entry, _PendingOverlay) and entry.cached is not None:
+                return entry.cached
+        return self[name].to_cache()
+
+
+    def __getitem__(self, name):
+        with self._lock:
+            entry = self._entries[name]
+            if isinstance(entry, _PendingOverlay):
+                entry = Overlay(config=self.config, xml=entry.xml,
+                    cached=entry.cached, ignore=self.ignore)
+                self._entries[name] = entry
+            return entry
+
+
+    def take_dirty(self):
+        '''Returns the names stored or deleted since the last call.'''
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+
+    def __setitem__(self, name, overlay):
+        with self._lock:
+            self._entries[name] = overlay
+            self._dirty.add(name)
+
+
+    def __delitem__(self, name):
+        with self._lock:
+            del self._entries[name]
+            self._dirty.add(name)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def __contains__(self, name):
+        return name in self._entries
+
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+
+    def __len__(self):
+        return len(self._entries)
 
 
 #===============================================================================
@@ -89,6 +269,12 @@ class BrokenOverlayCatalog(ValueError):
 class DbBase(object):
     ''' Handle a list of overlays.'''
 
+    # write a pre-parsed copy next to the xml files read
+    compile_cache = False
+
+    # the layman.lock name guarding the files read, if any
+    lock_name = None
+
     def __init__(self, config, paths=None, ignore = 0,
         ignore_init_read_errors=False
         ):
@@ -99,17 +285,23 @@ class DbBase(object):
         self.output = config['output']
         self.ignore_init_read_errors = ignore_init_read_errors
 
-        self.overlays = {}
+        self.overlays = OverlayMapping(config, ignore)
+        # overlay name -> its xml text as of the last write(), for
+        # the overlays not stored again since
+        self._fragments = {}
 
         self.output.debug('Initializing overlay list handler', 8)
 
+        self.locks = get_lock_manager(config)
+
         path_found = False
-        for path in self.paths:
-            if not os.path.exists(path):
-                continue
+        with self.locks.lock(self.lock_name, shared=True):
+            for path in self.paths:
+                if not os.path.exists(path):
+                    continue
 
-            self.read_file(path)
-            path_found = True
+                self.read_file(path)
+                path_found = True
 
         if not path_found:
             self.output.warn("Warning: an installed db file was not found at: %s"
@@ -130,17 +322,114 @@ class DbBase(object):
     def read_file(self, path):
         '''Read the overlay definition file.'''
 
+        if self.read_compiled(path):
+            return
+
         try:
-            with fileopen(path, 'r') as df:
-                document = df.read()
+            df = open(path, 'rb')
 
         except Exception as error:
             if not self.ignore_init_read_errors:
                 self.output.error('Failed to read the overlay list at ("'
                     + path + '")')
                 raise error
+            return
+
+        # parse while reading, the file is never held in memory as a whole
+        with df:
+            names = self._read_events(self._parse_events(df), origin=path)
+        if self.compile_cache:
+            self.write_compiled(path, names)
+
+
+    @staticmethod
+    def compiled_path(path):
+        '''Returns the path of the pre-parsed copy of an xml file.'''
+        return os.path.splitext(path)[0] + '.pickle'
+
+
+    def _compiled_key(self, path):
+        '''Identifies the xml file's content and how it was parsed.'''
+        info = os.stat(path)
+        mtime = getattr(info, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(info.st_mtime * 1000000000)
+        return (COMPILED_CACHE_VERSION, sys.version_info[0], mtime,
+            info.st_size, info.st_ino, self.ignore)
 
-        self.read(document, origin=path)
+
+    def read_compiled(self, path):
+        '''
+        Loads the overlays from the pre-parsed copy of the xml file at
+        path.  Returns False if there is none or it is outdated.
+
+        >>> import tempfile, shutil
+        >>> here = os.path.dirname(os.path.realpath(__file__))
+        >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+        >>> write = os.path.join(tmpdir, 'overlays.xml')
+        >>> write = shutil.copy(here + '/tests/testfiles/global-overlays.xml', write) or write
+        >>> from layman.output import Message
+        >>> a = DbBase({"output": Message()}, [write,])
+        >>> a.read_compiled(write)
+        False
+        >>> a.write_compiled(write, list(a.overlays))
+        True
+        >>> b = DbBase({"output": Message()}, [])
+        >>> b.read_compiled(write)
+        True
+        >>> sorted(b.overlays) == sorted(a.overlays)
+        True
+        >>> b.select('wrobel-stable').sources[0].src
+        'rsync://gunnarwrobel.de/wrobel-stable'
+        >>> shutil.rmtree(tmpdir)
+        '''
+        cpath = self.compiled_path(path)
+        try:
+            key = self._compiled_key(path)
+            with open(cpath, 'rb') as cfile:
+                compiled = pickle.load(cfile)
+        except Exception:
+            return False
+        if not isinstance(compiled, dict) or compiled.get('key') != key:
+            self.output.debug('DbBase.read_compiled(); %s is outdated'
+                % cpath, 6)
+            return False
+
+        self.output.debug('DbBase.read_compiled(); loading %s' % cpath, 8)
+        fragments = compiled.get('fragments', {})
+        for cached in compiled['overlays']:
+            name = self.overlays.add_cached(cached)
+            if name in fragments:
+                self._fragments[name] = fragments[name]
+            else:
+                self._fragments.pop(name, None)
+        return True
+
+
+    def write_compiled(self, path, names, cpath=None):
+        '''Stores a pre-parsed copy of the overlays called names read
+        from the xml file at path, for read_compiled() to load instead.
+        The xml text of those written by write() is kept along.  cpath
+        defaults to compiled_path(path).'''
+        if cpath is None:
+            cpath = self.compiled_path(path)
+        temp_path = '%s.%d.tmp' % (cpath, os.getpid())
+        try:
+            compiled = {'key': self._compiled_key(path),
+                'overlays': [self.overlays.definition(name)
+                    for name in names],
+                'fragments': dict((name, self._fragments[name])
+                    for name in names if name in self._fragments)}
+            with open(temp_path, 'wb') as cfile:
+                pickle.dump(compiled, cfile, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, cpath)
+        except Exception as error:
+            self.output.debug('DbBase.write_compiled(); failed to write %s: %s'
+                % (cpath, str(error)), 4)
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            return False
+        return True
 
 
     def _broken_catalog_hint(self):
@@ -152,6 +441,8 @@ class DbBase(object):
     def read(self, text, origin):
         '''
         Read an xml list of overlays (adding to and potentially overwriting existing entries)
+        and return the names of the overlays read.  The Overlay objects
+        are only created once they are accessed.
 
         >>> here = os.path.dirname(os.path.realpath(__file__))
         >>> from layman.output import Message
@@ -164,20 +455,65 @@ class DbBase(object):
         >>> list(a.overlays['wrobel-stable'].source_uris())
         ['rsync://gunnarwrobel.de/wrobel-stable']
         '''
-        try:
-            document = ET.fromstring(text)
-        except xml.parsers.expat.ExpatError as error:
-            raise BrokenOverlayCatalog(origin, error, self._broken_catalog_hint())
+        return self._read_events(self._parse_events(text), origin)
 
-        overlays = document.findall('overlay') + \
-                document.findall('repo')
 
-        for overlay in overlays:
-            self.output.debug('Parsing overlay: %s' % overlay, 9)
-            ovl = Overlay(config=self.config, xml=overlay,
-                    ignore=self.ignore)
-            self.overlays[ovl.name] = ovl
-        return
+    @staticmethod
+    def _parse_events(source):
+        '''
+        Parses a file object or xml text incrementally, yielding
+        iterparse style ("start"/"end", element) pairs.
+        '''
+        if hasattr(source, 'read'):
+            for item in ET.iterparse(source, events=('start', 'end')):
+                yield item
+            return
+
+        if isinstance(source, bytes) or not hasattr(ET, 'XMLPullParser'):
+            if not isinstance(source, bytes):
+                source = source.encode('UTF-8')
+            for item in ET.iterparse(io.BytesIO(source),
+                    events=('start', 'end')):
+                yield item
+            return
+
+        # decoded text, feed it as is so the encoding declared in
+        # the document does not matter any more
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        for index in range(0, len(source), PARSE_CHUNK_SIZE):
+            parser.feed(source[index:index + PARSE_CHUNK_SIZE])
+            for item in parser.read_events():
+                yield item
+        parser.close()
+        for item in parser.read_events():
+            yield item
+
+
+    def _read_events(self, events, origin):
+        '''Adds the overlays found in the parse events and returns
+        their names.  Every <repo> is detached from the document once
+        it is added, so neither the text nor the whole tree of a large
+        catalog is kept in memory, only the pending <repo> elements.'''
+        result = []
+        root = None
+        depth = 0
+        try:
+            for event, element in events:
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1 and element.tag in ('overlay', 'repo'):
+                    self.output.debug('Parsing overlay: %s' % element, 9)
+                    name = self.overlays.add_xml(element)
+                    self._fragments.pop(name, None)
+                    result.append(name)
+                    root.clear()
+        except PARSE_ERRORS as error:
+            raise BrokenOverlayCatalog(origin, error, self._broken_catalog_hint())
+        return result
 
 
     def add_new(self, xml=None, origin=None, from_dict=None):
@@ -230,18 +566,79 @@ class DbBase(object):
         >>> os.rmdir(tmpdir)
         '''
 
+        dirty = self.overlays.take_dirty()
+        fragments = {}
+        for name in self.overlays:
+            fragment = self._fragments.get(name)
+            if fragment is None or name in dirty:
+                self.output.debug('DbBase.write(); serializing %s' % name, 9)
+                repo = self.overlays[name].to_xml()
+                indent(repo, 1)
+                repo.tail = None
+                fragment = encode(ET.tostring(repo, encoding='utf-8'))
+            fragments[name] = fragment
+        # forget the overlays removed since the last write
+        self._fragments = fragments
+
         tree = ET.Element('repositories', version="1.0", encoding=_UNICODE)
-        tree[:] = [e.to_xml() for e in self.overlays.values()]
-        indent(tree)
-        tree = ET.ElementTree(tree)
+        if fragments:
+            tree.text = '\n'
+            head, tail = encode(ET.tostring(tree, encoding='utf-8')).split('\n')
+            text = head + '\n  ' + '\n  '.join(fragments[name]
+                for name in self.overlays) + '\n' + tail + '\n'
+        else:
+            text = encode(ET.tostring(tree, encoding='utf-8'))
+        if _UNICODE != 'unicode':
+            text = "<?xml version='1.0' encoding='UTF-8'?>\n" + text
+
+        # never truncate the old file before the new one is complete
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
         try:
-            with fileopen(path, 'w') as f:
-                 tree.write(f, encoding=_UNICODE)
+            with open(temp_path, 'wb') as f:
+                f.write(text.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            self._keep_permissions(path, temp_path)
+            os.rename(temp_path, path)
+            self._sync_directory(os.path.dirname(path))
 
         except Exception as error:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
             raise Exception('Failed to write to local overlays file: '
                             + path + '\nError was:\n' + str(error))
 
+
+    @staticmethod
+    def _keep_permissions(path, temp_path):
+        '''Gives temp_path the mode of the file at path and, when
+        running as root, its owner, before it replaces that file.'''
+        try:
+            info = os.stat(path)
+        except OSError:
+            # a new file gets the umask like any other
+            return
+        os.chmod(temp_path, stat.S_IMODE(info.st_mode))
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            os.chown(temp_path, info.st_uid, info.st_gid)
+
+
+    @staticmethod
+    def _sync_directory(path):
+        '''Makes a rename in directory path survive a crash.'''
+        try:
+            fd = os.open(path or os.curdir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            # not supported by every file system
+            pass
+        finally:
+            os.close(fd)
+
+
     def select(self, overlay):
         '''
         Select an overlay from the list.
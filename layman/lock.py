@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN LOCKING
+#################################################################################
+# File:       lock.py
+#
+#             Serializes concurrent layman processes
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''Advisory locks that keep concurrent layman runs from racing.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import errno
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on this platform, locking becomes a no-op
+    fcntl = None
+
+# installed.xml and the repo config files (make.conf, repos.conf)
+INSTALLED_LOCK = 'installed'
+# the cached remote overlay lists
+CACHE_LOCK = 'cache'
+# the sync state file
+STATE_LOCK = 'sync-state'
+# the object cache shared by git overlays
+GIT_OBJECTS_LOCK = 'git-objects'
+# the metrics state and textfile
+METRICS_LOCK = 'metrics'
+
+def overlay_lock(name):
+    '''Returns the name of the lock guarding the checkout of an overlay.'''
+    return 'overlay-' + name
+
+
+SHARED = 'shared'
+EXCLUSIVE = 'exclusive'
+
+#===============================================================================
+#
+# Class LockManager
+#
+#-------------------------------------------------------------------------------
+
+class LockManager(object):
+    '''
+    Hands out fcntl based locks kept as files in the lock_dir.
+
+    Readers take a lock shared, anything changing the files it
+    protects takes it exclusive.  Locks are reentrant per thread; a
+    thread holding a lock shared may take it exclusive and drops back
+    to shared afterwards.  Without fcntl or a usable lock directory
+    every lock is a no-op.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+    >>> from layman.output import Message
+    >>> config = {'output': Message(), 'lock_dir': tmpdir + '/locks'}
+    >>> a = LockManager(config)
+    >>> with a.lock('installed', shared=True):
+    ...     with a.lock('installed'):
+    ...         a.held('installed')
+    ...     a.held('installed')
+    'exclusive'
+    'shared'
+    >>> a.held('installed') is None
+    True
+    >>> sorted(os.listdir(tmpdir + '/locks'))
+    ['installed.lock']
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    '''
+
+    def __init__(self, config):
+
+        self.output = config['output']
+        try:
+            self.lock_dir = config['lock_dir']
+        except KeyError:
+            self.lock_dir = None
+
+        self._local = threading.local()
+
+
+    def _held(self):
+        '''Returns this thread's lock name -> [fd, modes] dict.'''
+        if not hasattr(self._local, 'locks'):
+            self._local.locks = {}
+        return self._local.locks
+
+
+    def held(self, name):
+        '''Returns the mode this thread holds lock name in, or None.'''
+        entry = self._held().get(name)
+        if entry is None:
+            return None
+        return entry[1][-1]
+
+
+    def lock_path(self, name):
+        '''Returns the file backing lock name.'''
+        return os.path.join(self.lock_dir,
+            re.sub('[^A-Za-z0-9._-]', '_', name) + '.lock')
+
+
+    def _open(self, name):
+        if fcntl is None or not self.lock_dir:
+            return None
+        path = self.lock_path(name)
+        try:
+            if not os.path.isdir(self.lock_dir):
+                # only below an existing storage directory
+                os.mkdir(self.lock_dir)
+            return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            pass
+        try:
+            # unprivileged users can still share the lock for reading
+            return os.open(path, os.O_RDONLY)
+        except OSError as error:
+            self.output.debug('LockManager: not locking %s: %s'
+                % (name, str(error)), 6)
+            return None
+
+
+    def _flock(self, fd, name, mode):
+        flag = fcntl.LOCK_SH if mode == SHARED else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, flag | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES,
+                    errno.EWOULDBLOCK):
+                # e.g. ENOLCK on file systems without lock support
+                self.output.debug('LockManager: not locking %s: %s'
+                    % (name, str(error)), 6)
+                return
+        self.output.info('Waiting for another layman process to release '
+            'the %s lock...' % name, 2)
+        fcntl.flock(fd, flag)
+
+
+    @contextmanager
+    def lock(self, name, shared=False):
+        '''
+        Holds lock name for the duration of a with block.
+
+        @param name: string, what to lock, None to lock nothing.
+        @param shared: boolean, True for reading, False for changing.
+        '''
+        if name is None:
+            yield
+            return
+        held = self._held()
+        entry = held.get(name)
+        if entry is None:
+            entry = held[name] = [self._open(name), []]
+        fd, modes = entry
+        previous = modes[-1] if modes else None
+        if shared and previous is not None:
+            # never give up a lock held exclusive further out
+            mode = previous
+        else:
+            mode = SHARED if shared else EXCLUSIVE
+
+        try:
+            if fd is not None and mode != previous:
+                self._flock(fd, name, mode)
+        except BaseException:
+            if not modes:
+                self._release(name)
+            raise
+        modes.append(mode)
+        try:
+            yield
+        finally:
+            modes.pop()
+            if not modes:
+                self._release(name)
+            elif fd is not None and modes[-1] != mode:
+                self._flock(fd, name, modes[-1])
+
+
+    def _release(self, name):
+        fd = self._held().pop(name)[0]
+        if fd is not None:
+            # closing the only descriptor drops the lock
+            os.close(fd)
+
+
+_MANAGERS = {}
+_MANAGERS_LOCK = threading.Lock()
+
+def get_lock_manager(config):
+    '''Returns the LockManager shared by everything using the
+    same lock directory as config.'''
+    try:
+        key = config['lock_dir']
+    except KeyError:
+        key = None
+    with _MANAGERS_LOCK:
+        if key not in _MANAGERS:
+            _MANAGERS[key] = LockManager(config)
+        return _MANAGERS[key]
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -87,9 +87,10 @@ class ConfigHandler:
 
         self.read(True)
 
-    def add(self, overlay):
+    def add(self, overlay, write=True):
         '''
-        Add an overlay to make.conf.
+        Add an overlay to make.conf (written later by the caller if
+        write is False).
 
         >>> import tempfile
         >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
@@ -117,11 +118,14 @@ class ConfigHandler:
         >>> shutil.rmtree(tmpdir)
         '''
         self.overlays.append(overlay)
+        if not write:
+            return True
         return self.write()
 
-    def delete(self, overlay):
+    def delete(self, overlay, write=True):
         '''
-        Delete an overlay from make.conf.
+        Delete an overlay from make.conf (written later by the caller
+        if write is False).
 
         >>> import tempfile
         >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
@@ -151,13 +155,15 @@ class ConfigHandler:
         self.overlays = [i
                          for i in self.overlays
                          if i.name != overlay.name]
+        if not write:
+            return True
         return self.write()
 
-    def update(self, overlay):
+    def update(self, overlay, write=True):
         '''
         Stub function necessary for RepoConfManager class.
         '''
-        pass
+        return True
 
     def read(self, raise_error=False):
         '''
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN METRICS
+#################################################################################
+# File:       metrics.py
+#
+#             Exports sync and fetch metrics for Prometheus
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''Writes a node_exporter textfile with layman's sync and fetch metrics.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+
+from layman.compatibility import encode, fileopen
+from layman.lock import METRICS_LOCK, get_lock_manager
+
+# upper bounds in seconds of the sync duration histogram buckets
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+# name, type, help text of every metric written
+METRICS = [
+    ('layman_last_run_timestamp_seconds', 'gauge',
+        'Time layman last ran the action.'),
+    ('layman_overlay_last_success_timestamp_seconds', 'gauge',
+        'Time of the last successful sync of the overlay.'),
+    ('layman_overlay_last_sync_timestamp_seconds', 'gauge',
+        'Time of the last sync attempt of the overlay.'),
+    ('layman_overlay_sync_duration_seconds', 'histogram',
+        'Time taken by the syncs of the overlay that were not skipped.'),
+    ('layman_overlay_sync_phase_seconds', 'gauge',
+        'Time the last sync of the overlay spent in each phase.'),
+    ('layman_overlay_sync_failures_total', 'counter',
+        'Number of failed syncs of the overlay.'),
+    ('layman_catalog_fetch_duration_seconds', 'gauge',
+        'Time the last fetch of the remote list took.'),
+    ('layman_catalog_size_bytes', 'gauge',
+        'Size of the cached remote list.'),
+    ('layman_catalog_entries', 'gauge',
+        'Number of overlays in the remote list.'),
+    ]
+
+#===============================================================================
+#
+# Helper functions
+#
+#-------------------------------------------------------------------------------
+
+def _escape(value):
+    '''
+    Escapes a label value.
+
+    >>> print(_escape('a "b"\\\\c'))
+    a \\"b\\"\\\\c
+    '''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _sample(name, labels, value):
+    '''
+    Formats one sample line.
+
+    >>> print(_sample('a_total', [('overlay', 'wrobel')], 2))
+    a_total{overlay="wrobel"} 2
+    >>> print(_sample('a_seconds', [], 0.5))
+    a_seconds 0.5
+    '''
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, _escape(label))
+            for key, label in labels)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return '%s %d' % (name, value)
+    return '%s %s' % (name, repr(float(value)))
+
+#===============================================================================
+#
+# Class Metrics
+#
+#-------------------------------------------------------------------------------
+
+class Metrics(object):
+    '''
+    Keeps counters across layman runs in the metrics_state file and
+    rewrites the metrics_textfile from them after every fetch and
+    sync.  Does nothing unless metrics_textfile is set.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+    >>> from layman.output import Message
+    >>> from layman.syncreport import OverlayTiming, SyncResults
+    >>> config = {'output': Message(),
+    ...           'metrics_textfile': os.path.join(tmpdir, 'layman.prom'),
+    ...           'metrics_state': os.path.join(tmpdir, 'metrics.json')}
+    >>> timings = [OverlayTiming('wrobel'), OverlayTiming('broken')]
+    >>> for timing in timings:
+    ...     timing.start()
+    >>> timings[0].finish([('wrobel', 'ok')], [], [])
+    >>> timings[1].finish([], [], [('broken', 'failed')])
+    >>> a = Metrics(config)
+    >>> a.record_sync(SyncResults([], [], [], timings))
+    True
+    >>> a.record_sync(SyncResults([], [], [], timings[1:]))
+    True
+    >>> with fileopen(config['metrics_textfile']) as textfile:
+    ...     lines = textfile.read().splitlines()
+    >>> [l for l in lines if l.startswith('layman_overlay_sync_failures')]
+    ['layman_overlay_sync_failures_total{overlay="broken"} 2', \
+'layman_overlay_sync_failures_total{overlay="wrobel"} 0']
+    >>> [l for l in lines if 'wrobel' in l and '_count' in l]
+    ['layman_overlay_sync_duration_seconds_count{overlay="wrobel"} 1']
+
+    A list that was not downloaded keeps its numbers, one that is
+    no longer configured is dropped:
+
+    >>> class RemoteDB(object):
+    ...     urls, signed_urls, detached_urls = ['a', 'b'], [], []
+    ...     fetch_stats = {'a': {'duration': 0.5, 'path': tmpdir,
+    ...         'entries': 3}, 'b': {'duration': 1.5, 'path': tmpdir,
+    ...         'entries': 5}}
+    >>> a.record_fetch(RemoteDB())
+    True
+    >>> RemoteDB.urls, RemoteDB.fetch_stats = ['b', 'c'], {}
+    >>> a.record_fetch(RemoteDB())
+    True
+    >>> with fileopen(config['metrics_textfile']) as textfile:
+    ...     lines = textfile.read().splitlines()
+    >>> [l for l in lines if l.startswith('layman_catalog_entries')]
+    ['layman_catalog_entries{url="b"} 5']
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    '''
+
+    def __init__(self, config):
+
+        self.config = config
+        self.output = config['output']
+        self.path = config['metrics_textfile']
+        self.state_path = config['metrics_state']
+        self.locks = get_lock_manager(config)
+
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+
+    def _read_state(self):
+        state = {}
+        if self.state_path and os.path.exists(self.state_path):
+            try:
+                with fileopen(self.state_path, 'r') as state_file:
+                    state = json.load(state_file)
+            except (IOError, OSError, ValueError) as error:
+                self.output.warn('Ignoring unreadable metrics state file '
+                    '"%s".\nError was: %s' % (self.state_path, str(error)), 2)
+        for key in ('runs', 'overlays', 'catalogs'):
+            state.setdefault(key, {})
+        return state
+
+
+    @staticmethod
+    def _replace(path, text):
+        '''Writes text to path in one step, node_exporter must never
+        read a half written file.'''
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with fileopen(temp_path, 'w') as out_file:
+                out_file.write(encode(text))
+            os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+
+    def _update(self, action, change):
+        '''Applies change to the state and rewrites both files.'''
+        if not self.enabled:
+            return False
+        try:
+            with self.locks.lock(METRICS_LOCK):
+                state = self._read_state()
+                now = time.time()
+                change(state, now)
+                state['runs'][action] = now
+                if self.state_path:
+                    self._replace(self.state_path, json.dumps(state,
+                        indent=1, sort_keys=True))
+                self._replace(self.path, self.render(state))
+        except (IOError, OSError) as error:
+            self.output.warn('Failed to write the metrics file "%s".'
+                '\nError was: %s' % (self.path, str(error)), 2)
+            return False
+        return True
+
+
+    def record_sync(self, sync_results, installed=None):
+        '''
+        Adds the overlays in the report of a LaymanAPI.sync() run.
+        Overlays not in installed, if given, are dropped.
+        '''
+        def change(state, now):
+            overlays = state['overlays']
+            if installed is not None:
+                for name in list(overlays):
+                    if name not in installed:
+                        del overlays[name]
+            for report in sync_results.report:
+                overlay = overlays.setdefault(report['overlay'], {})
+                if overlay.get('buckets') is None or \
+                        len(overlay['buckets']) != len(DURATION_BUCKETS):
+                    overlay.update({'buckets': [0] * len(DURATION_BUCKETS),
+                        'sum': 0.0, 'count': 0, 'failures': 0})
+                overlay['last_sync'] = now
+                overlay['phases'] = report['phases']
+                if report['status'] == 'failed':
+                    overlay['failures'] += 1
+                else:
+                    overlay['last_success'] = now
+                # skipped syncs would drown the real ones in the
+                # lowest bucket
+                if report['status'] != 'current' and \
+                        report['duration'] is not None:
+                    for index, bound in enumerate(DURATION_BUCKETS):
+                        if report['duration'] <= bound:
+                            overlay['buckets'][index] += 1
+                    overlay['sum'] += report['duration']
+                    overlay['count'] += 1
+        return self._update('sync', change)
+
+
+    def record_fetch(self, remote_db):
+        '''
+        Adds the remote lists downloaded by RemoteDB.cache().  Lists
+        not downloaded this time keep what was recorded before, only
+        those no longer configured are dropped.
+        '''
+        def change(state, now):
+            catalogs = state['catalogs']
+            configured = set(remote_db.urls + remote_db.signed_urls +
+                [url[0] for url in remote_db.detached_urls])
+            for url in list(catalogs):
+                if url not in configured:
+                    del catalogs[url]
+            for url, stats in remote_db.fetch_stats.items():
+                catalog = catalogs.setdefault(url, {})
+                catalog['fetch_duration'] = stats['duration']
+                if os.path.exists(stats['path']):
+                    catalog['size'] = os.path.getsize(stats['path'])
+                # unchanged lists are not parsed, keep the old count
+                if 'entries' in stats:
+                    catalog['entries'] = stats['entries']
+        return self._update('fetch', change)
+
+
+    def render(self, state):
+        '''Returns the textfile for state.'''
+        samples = dict((name, []) for name, kind, text in METRICS)
+
+        for action, timestamp in sorted(state['runs'].items()):
+            samples['layman_last_run_timestamp_seconds'].append(
+                ([('action', action)], timestamp))
+
+        for name, overlay in sorted(state['overlays'].items()):
+            labels = [('overlay', name)]
+            if 'last_success' in overlay:
+                samples['layman_overlay_last_success_timestamp_seconds'] \
+                    .append((labels, overlay['last_success']))
+            samples['layman_overlay_last_sync_timestamp_seconds'].append(
+                (labels, overlay['last_sync']))
+            for phase, duration in sorted(overlay['phases'].items()):
+                samples['layman_overlay_sync_phase_seconds'].append(
+                    (labels + [('phase', phase)], duration))
+            samples['layman_overlay_sync_failures_total'].append(
+                (labels, overlay['failures']))
+            histogram = samples['layman_overlay_sync_duration_seconds']
+            for bound, count in zip(DURATION_BUCKETS, overlay['buckets']):
+                histogram.append(('_bucket', labels + [('le', '%d' % bound)],
+                    count))
+            histogram.append(('_bucket', labels + [('le', '+Inf')],
+                overlay['count']))
+            histogram.append(('_sum', labels, overlay['sum']))
+            histogram.append(('_count', labels, overlay['count']))
+
+        for url, catalog in sorted(state['catalogs'].items()):
+            labels = [('url', url)]
+            for name, key in (
+                    ('layman_catalog_fetch_duration_seconds', 'fetch_duration'),
+                    ('layman_catalog_size_bytes', 'size'),
+                    ('layman_catalog_entries', 'entries')):
+                if key in catalog:
+                    samples[name].append((labels, catalog[key]))
+
+        lines = []
+        for name, kind, text in METRICS:
+            if not samples[name]:
+                continue
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample in samples[name]:
+                if kind == 'histogram':
+                    suffix, labels, value = sample
+                    lines.append(_sample(name + suffix, labels, value))
+                else:
+                    lines.append(_sample(name, sample[0], sample[1]))
+        return '\n'.join(lines) + '\n'
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -26,11 +26,15 @@ __version__ = "$Id: git.py 146 2006-05-27 09:52:36Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
+import os
 import xml.etree.ElementTree as ET
 
+from   layman.lock              import GIT_OBJECTS_LOCK, get_lock_manager
 from   layman.utils             import path
 from   layman.overlays.source   import OverlaySource, require_supported
 
+GIT_CLONE_MODES = ('full', 'shallow', 'partial')
+
 #===============================================================================
 #
 # Class GitOverlay
@@ -61,6 +65,106 @@ class GitOverlay(OverlaySource):
                 return source + '/'
         return source
 
+    def clone_mode(self):
+        '''
+        Returns the configured clone mode: "full" clones the whole
+        history, "shallow" only the latest commit of the branch and
+        "partial" the whole history of the branch but fetches file
+        contents only when they are checked out.
+        '''
+        mode = (self.config['git_clone_mode'] or 'full').lower()
+        if mode not in GIT_CLONE_MODES:
+            self.output.warn('Invalid git_clone_mode "%s", using "full"'
+                % mode, 2)
+            mode = 'full'
+        return mode
+
+    def recorded_mode(self, target):
+        '''Returns the clone mode the checkout in target was made with.
+        The checkout's git config is read directly, running git for
+        it on every sync would cost a process per overlay.'''
+        mode = None
+        section = None
+        try:
+            with open(os.path.join(target, '.git', 'config')) as config:
+                for line in config:
+                    line = line.strip()
+                    if line.startswith('['):
+                        section = line.strip('[]').strip().lower()
+                    elif section == 'layman' and '=' in line:
+                        key, value = line.split('=', 1)
+                        if key.strip().lower() == 'clonemode':
+                            # like git config --get, the last one wins
+                            mode = value.strip().strip('"')
+        except (IOError, OSError):
+            pass
+        if mode not in GIT_CLONE_MODES:
+            # checkouts from before clone modes existed are full clones
+            return 'full'
+        return mode
+
+    def record_mode(self, target, mode):
+        '''Remembers the clone mode in the checkout's git config.'''
+        args = ['config', 'layman.clonemode', mode]
+        return self.run_command(self.command(), args, cmd=self.type,
+            cwd=target)
+
+    def shared_objects(self, base):
+        '''
+        Fetches the overlay into the object cache shared by all git
+        overlays below base and returns the cache's path, or None if
+        the cache is disabled or could not be filled.  The fetched
+        branches are kept as refs/layman/<name>/* so their objects
+        stay available to readds and forks of the overlay.
+        '''
+        if not self.config.get_option('git_shared_objects'):
+            return None
+        cache = path([base, '.git-objects'])
+        quiet = ['-q'] if self.config['quiet'] else []
+
+        # overlays added in parallel all fetch into the same cache
+        with get_lock_manager(self.config).lock(GIT_OBJECTS_LOCK):
+            if not os.path.exists(cache):
+                # git init --bare [-q] CACHE
+                args = ['init', '--bare'] + quiet + [cache]
+                if self.run_command(self.command(), args, cmd=self.type):
+                    self.output.warn('Failed to create the shared git '
+                        'object cache "%s", cloning without it' % cache, 2)
+                    return None
+
+            # git --git-dir=CACHE fetch [-q] SOURCE
+            #     +refs/heads/*:refs/layman/NAME/*
+            args = ['--git-dir=' + cache, 'fetch'] + quiet + \
+                [self._fix_git_source(self.src),
+                 '+refs/heads/*:refs/layman/%s/*' % self.parent.name]
+            if self.run_command(self.command(), args, cmd=self.type,
+                    env=self._ssh_env()):
+                self.output.warn('Failed to fetch into the shared git object '
+                    'cache, cloning without it', 2)
+                return None
+        return cache
+
+    def drop_shared_objects(self, base):
+        '''Removes the overlay's refs/layman/<name>/* refs from the
+        shared object cache, so git gc may drop objects only it used.'''
+        cache = path([base, '.git-objects'])
+        if not os.path.exists(cache):
+            return
+
+        with get_lock_manager(self.config).lock(GIT_OBJECTS_LOCK):
+            # git --git-dir=CACHE for-each-ref --format=%(refname)
+            #     refs/layman/NAME/
+            result, output = self.capture_command(self.command(),
+                ['--git-dir=' + cache, 'for-each-ref',
+                 '--format=%(refname)', 'refs/layman/%s/' % self.parent.name])
+            if result:
+                return
+            for ref in output.split():
+                # git --git-dir=CACHE update-ref -d REF
+                self.run_command(self.command(),
+                    ['--git-dir=' + cache, 'update-ref', '-d', ref],
+                    cmd=self.type)
+
     def add(self, base):
         '''Add overlay.'''
 
@@ -69,11 +173,22 @@ class GitOverlay(OverlaySource):
 
         cfg_opts = self.config["git_addopts"]
         target = path([base, self.parent.name])
+        mode = self.clone_mode()
 
-        # git clone [-q] SOURCE TARGET
+        # git clone [-q] [--depth 1|--filter=blob:none --single-branch]
+        #     SOURCE TARGET
         args = ['clone']
         if self.config['quiet']:
             args.append('-q')
+        if mode == 'shallow':
+            args.extend(['--depth', '1', '--single-branch'])
+        elif mode == 'partial':
+            args.extend(['--filter=blob:none', '--single-branch'])
+        else:
+            # borrow the objects instead of downloading them again
+            cache = self.shared_objects(base)
+            if cache:
+                args.extend(['--reference-if-able', cache])
         if len(cfg_opts):
             args.append(cfg_opts)
         args.append(self._fix_git_source(self.src))
@@ -86,11 +201,22 @@ class GitOverlay(OverlaySource):
         # adding cwd=base due to a new git bug in selinux due to
         # not having user_home_dir_t and portage_fetch_t permissions
         # but changing dir works around it.
-        success = self.run_command(self.command(), args, cmd=self.type, cwd=base)
+        success = self.run_command(self.command(), args, cmd=self.type, cwd=base,
+            env=self._ssh_env())
         self.output.debug("cloned git repo...success=%s" % str(success), 8)
+        if success:
+            return self.postsync(success, cwd=target)
         success = self.set_user(target)
+        if not success:
+            success = self.record_mode(target, mode)
         return self.postsync(success, cwd=target)
 
+    def delete(self, base):
+        '''Delete overlay.'''
+        result = super(GitOverlay, self).delete(base)
+        self.drop_shared_objects(base)
+        return result
+
     def set_user(self, target):
         '''Set dummy user.name and user.email to prevent possible errors'''
         user = '"%s"' % self.config['git_user']
@@ -127,8 +253,35 @@ class GitOverlay(OverlaySource):
         if not self.supported():
             return 1
 
-        cfg_opts = self.config["git_syncopts"]
         target = path([base, self.parent.name])
+        mode = self.clone_mode()
+        recorded = self.recorded_mode(target)
+
+        if mode == 'shallow':
+            result = self._sync_shallow(target)
+        else:
+            result = 0
+            if recorded == 'shallow':
+                # fetch the history the shallow checkout is missing
+                args = ['fetch', '--unshallow']
+                if self.config['quiet']:
+                    args.append('-q')
+                result = self.run_command(self.command(), args, cwd=target,
+                    cmd=self.type, env=self._ssh_env())
+            if not result:
+                result = self._sync_pull(target)
+
+        # an existing full clone stays full, it cannot be turned
+        # into a partial one without cloning again
+        if not result and mode != recorded and \
+                not (mode == 'partial' and recorded == 'full'):
+            result = self.record_mode(target, mode)
+
+        return self.postsync(result, cwd=target)
+
+    def _sync_pull(self, target):
+        '''Updates a full or partial clone.'''
+        cfg_opts = self.config["git_syncopts"]
 
         args = ['pull']
         if self.config['quiet']:
@@ -136,9 +289,64 @@ class GitOverlay(OverlaySource):
         if len(cfg_opts):
             args.append(cfg_opts)
 
-        return self.postsync(
-            self.run_command(self.command(), args, cwd=target, cmd=self.type),
-            cwd=target)
+        return self.run_command(self.command(), args, cwd=target,
+            cmd=self.type, env=self._ssh_env())
+
+    def _sync_shallow(self, target):
+        '''Replaces the tree of a shallow clone by upstream's latest
+        commit, without fetching any history.'''
+        cfg_opts = self.config["git_syncopts"]
+
+        # git fetch [-q] --depth 1 origin BRANCH
+        args = ['fetch']
+        if self.config['quiet']:
+            args.append('-q')
+        args.extend(['--depth', '1'])
+        if len(cfg_opts):
+            args.append(cfg_opts)
+        args.extend(['origin', self.branch or 'HEAD'])
+
+        result = self.run_command(self.command(), args, cwd=target,
+            cmd=self.type, env=self._ssh_env())
+        if result:
+            return result
+
+        # git reset [-q] --hard FETCH_HEAD
+        args = ['reset']
+        if self.config['quiet']:
+            args.append('-q')
+        args.extend(['--hard', 'FETCH_HEAD'])
+        return self.run_command(self.command(), args, cwd=target,
+            cmd=self.type)
+
+    def probe(self, base):
+        '''Returns the commit id upstream's branch points to.'''
+        if not self.supported():
+            return None
+
+        ref = 'HEAD'
+        if self.branch:
+            ref = 'refs/heads/%s' % self.branch
+
+        # git ls-remote SOURCE REF
+        args = ['ls-remote', self._fix_git_source(self.src), ref]
+        env = self._ssh_env(batch=True)
+        env['GIT_TERMINAL_PROMPT'] = '0'
+        result, output = self.capture_command(self.command(), args, env=env)
+        if result or not output.strip():
+            return None
+        return output.split()[0]
+
+    def _ssh_env(self, batch=False):
+        '''Environment letting git share ssh connections per host.'''
+        ssh = self.ssh_command()
+        if ssh and batch:
+            return {'GIT_SSH_COMMAND': ssh + ' -o BatchMode=yes'}
+        elif ssh:
+            return {'GIT_SSH_COMMAND': ssh}
+        elif batch:
+            return {}
+        return None
 
     def supported(self):
         '''Overlay type supported?'''
@@ -84,6 +84,8 @@ class MercurialOverlay(OverlaySource):
             args.append('-r')
             args.append(self.branch)
 
+        args = self._ssh_opts() + args
+
         return self.postsync(
             self.run_command(self.command(), args, cmd=self.type),
             cwd=target)
@@ -127,10 +129,33 @@ class MercurialOverlay(OverlaySource):
         else:
             args = ['pull', '-u', self.src]
 
+        args = self._ssh_opts() + args
+
         return self.postsync(
             self.run_command(self.command(), args, cwd=target, cmd=self.type),
             cwd=target)
 
+    def probe(self, base):
+        '''Returns the changeset id upstream's branch points to.'''
+        if not self.supported():
+            return None
+
+        # hg identify --id -r BRANCH SOURCE
+        args = self._ssh_opts() + ['--config', 'ui.interactive=False',
+            'identify', '--id', '-r', self.branch or 'default',
+            self._fix_mercurial_source(self.src)]
+        result, output = self.capture_command(self.command(), args)
+        if result or not output.strip():
+            return None
+        return output.strip()
+
+    def _ssh_opts(self):
+        '''Global options letting hg share ssh connections per host.'''
+        ssh = self.ssh_command()
+        if ssh:
+            return ['--config', 'ui.ssh=%s' % ssh]
+        return []
+
     def supported(self):
         '''Overlay type supported?'''
 
@@ -33,40 +33,65 @@ __version__ = "0.2"
 import sys, re, os, os.path
 import codecs
 import locale
+import importlib
 import xml.etree.ElementTree as ET # Python 2.5
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Python 2
+    from collections import Mapping
+
 from layman.utils import pad, terminal_width, get_encoding, encoder
 from layman.compatibility import encode
 
-from   layman.overlays.bzr       import BzrOverlay
-from   layman.overlays.darcs     import DarcsOverlay
-from   layman.overlays.git       import GitOverlay
-from   layman.overlays.g_common  import GCommonOverlay
-from   layman.overlays.g_sorcery import GSorceryOverlay
-from   layman.overlays.mercurial import MercurialOverlay
-from   layman.overlays.cvs       import CvsOverlay
-from   layman.overlays.svn       import SvnOverlay
-from   layman.overlays.rsync     import RsyncOverlay
-from   layman.overlays.tar       import TarOverlay
-
 #===============================================================================
 #
 # Constants
 #
 #-------------------------------------------------------------------------------
 
-OVERLAY_TYPES = dict((e.type_key, e) for e in (
-    GitOverlay,
-    GCommonOverlay,
-    GSorceryOverlay,
-    CvsOverlay,
-    SvnOverlay,
-    RsyncOverlay,
-    TarOverlay,
-    BzrOverlay,
-    MercurialOverlay,
-    DarcsOverlay
-))
+class _OverlayTypes(Mapping):
+    '''
+    Maps type keys to overlay source classes.  The module of a type
+    is only imported once an overlay of that type is created.
+
+    >>> 'git' in OVERLAY_TYPES
+    True
+    >>> OVERLAY_TYPES['rsync'].__name__
+    'RsyncOverlay'
+    '''
+
+    def __init__(self, modules):
+        self._modules = modules
+        self._classes = {}
+
+    def __getitem__(self, type_key):
+        if type_key not in self._classes:
+            module, name = self._modules[type_key]
+            self._classes[type_key] = getattr(
+                importlib.import_module(module), name)
+        return self._classes[type_key]
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def __len__(self):
+        return len(self._modules)
+
+
+OVERLAY_TYPES = _OverlayTypes({
+    'git':       ('layman.overlays.git',       'GitOverlay'),
+    'g-common':  ('layman.overlays.g_common',  'GCommonOverlay'),
+    'g-sorcery': ('layman.overlays.g_sorcery', 'GSorceryOverlay'),
+    'cvs':       ('layman.overlays.cvs',       'CvsOverlay'),
+    'svn':       ('layman.overlays.svn',       'SvnOverlay'),
+    'rsync':     ('layman.overlays.rsync',     'RsyncOverlay'),
+    'tar':       ('layman.overlays.tar',       'TarOverlay'),
+    'bzr':       ('layman.overlays.bzr',       'BzrOverlay'),
+    'mercurial': ('layman.overlays.mercurial', 'MercurialOverlay'),
+    'darcs':     ('layman.overlays.darcs',     'DarcsOverlay'),
+})
 
 QUALITY_LEVELS = 'core|stable|testing|experimental|graveyard'.split('|')
 
@@ -77,7 +102,7 @@ class Overlay(object):
     ''' Derive the real implementations from this.'''
 
     def __init__(self, config, xml=None, ovl_dict=None,
-        ignore = 0):
+        ignore = 0, cached=None):
         '''
         >>> here = os.path.dirname(os.path.realpath(__file__))
         >>> import xml.etree.ElementTree as ET # Python 2.5
@@ -105,11 +130,16 @@ class Overlay(object):
         self.config = config
         self.output = config['output']
         self._encoding_ = get_encoding(self.output)
+        # the SyncState of the DB checking out or syncing the overlay,
+        # set by the DB; without one nothing is recorded between syncs
+        self.state = None
 
         if xml is not None:
             self.from_xml(xml, ignore)
         elif ovl_dict is not None:
             self.from_dict(ovl_dict, ignore)
+        elif cached is not None:
+            self.from_cache(cached, ignore)
 
 
     def from_xml(self, xml, ignore):
@@ -354,6 +384,54 @@ class Overlay(object):
         # end of from_dict
 
 
+    CACHED_ATTRIBUTES = ('name', 'branch', 'owner_email', 'owner_name',
+        'description', 'status', 'quality', 'priority', 'homepage', 'feeds',
+        'irc')
+
+    def to_cache(self):
+        '''
+        Returns the overlay's definition as a plain dictionary that
+        can be pickled and handed to from_cache() later on.
+
+        >>> here = os.path.dirname(os.path.realpath(__file__))
+        >>> document =ET.parse(here + '/../tests/testfiles/global-overlays.xml')
+        >>> overlays = document.findall('overlay') + document.findall('repo')
+        >>> from layman.output import Message
+        >>> a = Overlay({'output': Message()}, overlays[0])
+        >>> b = Overlay({'output': Message()}, cached=a.to_cache())
+        >>> a == b
+        True
+        >>> b.sources[0].src
+        'https://overlays.gentoo.org/svn/dev/wrobel'
+        '''
+        cached = dict((i, getattr(self, i)) for i in self.CACHED_ATTRIBUTES)
+        # the sources picked up the overlay's branch when they were created
+        cached['sources'] = [(i.type_key, i.src, getattr(i, 'branch', None))
+            for i in self.sources]
+        return cached
+
+
+    def from_cache(self, cached, ignore):
+        """Restore an overlay definition stored by to_cache()
+        """
+        for i in self.CACHED_ATTRIBUTES:
+            setattr(self, i, cached[i])
+
+        def create_cached_overlay_source(source_):
+            _type, _location, self.branch = source_
+            try:
+                _class = OVERLAY_TYPES[_type]
+            except KeyError:
+                raise Exception('Overlay from_cache(), "' + self.name +
+                    'Unknown overlay type "%s"!' % _type)
+            return _class(parent=self, config=self.config,
+                _location=_location, ignore=ignore)
+
+        self.sources = [create_cached_overlay_source(e)
+            for e in cached['sources']]
+        self.branch = cached['branch']
+
+
     def __eq__(self, other):
         for i in ('description', 'homepage', 'name', 'owner_email',
                 'owner_name', 'priority', 'status'):
@@ -486,6 +564,13 @@ class Overlay(object):
         return self.sources[0].sync(base)
 
 
+    def probe(self, base):
+        '''Returns the current upstream revision, or None if the
+        source type cannot tell without syncing.'''
+        assert len(self.sources) == 1
+        return self.sources[0].probe(base)
+
+
     def delete(self, base):
         assert len(self.sources) == 1
         return self.sources[0].delete(base)
@@ -19,37 +19,125 @@ import os
 import copy
 import sys
 import shutil
+import threading
 import subprocess
-from layman.utils import path
-
-supported_cache = {}
-
-def _supported(key, check_supported=None):
-    """internal caching function that checks tracks any
-    un-supported/supported repo types."""
-    if key is None:
-        return False
-    if key not in supported_cache:
-        supported_cache[key] = check_supported()
-    return supported_cache[key]
-
-def _resolve_command(command, _output):
-    if os.path.isabs(command):
-        if not os.path.exists(command):
-            _output('Program "%s" not found' % command)
-            return ('File', None)
-        return ('File', command)
-    else:
-        kind = 'Command'
-        env_path = os.environ['PATH']
-        for d in env_path.split(os.pathsep):
+from layman.utils import path, is_ssh_source
+from layman.syncreport import phase
+
+try:
+    from shlex import quote
+except ImportError:
+    # Python 2
+    from pipes import quote
+
+class BinaryRegistry(object):
+    '''
+    Resolves the commands configured for the overlay types to the
+    binaries run for them, walking PATH only once per command (and
+    PATH setting) for the whole process.  Version probing is optional
+    and also done only once per binary.
+
+    >>> a = BinaryRegistry()
+    >>> a.resolve('/bin/sh')
+    ('File', '/bin/sh')
+    >>> a.resolve('no-such-command-here')
+    ('Command', None)
+    >>> a.resolve('sh') == a.resolve('sh')
+    True
+    >>> a.supported('sh', lambda: a.resolve('sh')[1] is not None)
+    True
+    '''
+
+    def __init__(self):
+        self._paths = {}
+        self._versions = {}
+        self._supported = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _lookup(command):
+        if os.path.isabs(command):
+            if not os.path.exists(command):
+                return ('File', None)
+            return ('File', command)
+        for d in os.environ['PATH'].split(os.pathsep):
             f = os.path.join(d, command)
             if os.path.exists(f):
                 return ('Command', f)
-        _output('Cound not resolve command ' +\
-            '"%s" based on PATH "%s"' % (command, env_path))
         return ('Command', None)
 
+    def resolve(self, command, _output=None):
+        '''Returns a (kind, path) tuple for command, path being None
+        if it cannot be found.  Misses are reported through _output
+        every time.'''
+        key = (command, os.environ.get('PATH'))
+        with self._lock:
+            result = self._paths.get(key)
+        if result is None:
+            result = self._lookup(command)
+            with self._lock:
+                self._paths[key] = result
+        if result[1] is None and _output:
+            if result[0] == 'File':
+                _output('Program "%s" not found' % command)
+            else:
+                _output('Cound not resolve command ' +\
+                    '"%s" based on PATH "%s"' % (command, key[1]))
+        return result
+
+    def version(self, command):
+        '''Returns the first line "command --version" prints, or None.'''
+        binary = self.resolve(command)[1]
+        if not binary:
+            return None
+        with self._lock:
+            if binary in self._versions:
+                return self._versions[binary]
+        try:
+            proc = subprocess.Popen([binary, '--version'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        except OSError:
+            output = b''
+        if hasattr(output, 'decode'):
+            output = output.decode('UTF-8', 'replace')
+        lines = [i.strip() for i in output.splitlines() if i.strip()]
+        version = lines[0] if lines else None
+        with self._lock:
+            self._versions[binary] = version
+        return version
+
+    def supported(self, type_key, check):
+        '''Returns whether the overlay type type_key is supported,
+        calling check() (and so warning about missing binaries) only
+        once per type.'''
+        if type_key is None:
+            return False
+        with self._lock:
+            if type_key in self._supported:
+                return self._supported[type_key]
+        result = check()
+        with self._lock:
+            self._supported[type_key] = result
+        return result
+
+    def clear(self):
+        '''Forgets everything resolved so far, e.g. after installing
+        a missing tool.'''
+        with self._lock:
+            self._paths.clear()
+            self._versions.clear()
+            self._supported.clear()
+
+
+# shared by all overlay sources and the API
+BINARIES = BinaryRegistry()
+
+
+def _resolve_command(command, _output):
+    return BINARIES.resolve(command, _output)
+
 
 def require_supported(binaries, _output):
     for command, mtype, package in binaries:
@@ -76,6 +164,11 @@ class OverlaySource(object):
 
         self.output = config['output']
 
+    @property
+    def state(self):
+        '''The SyncState of the DB driving this source, or None.'''
+        return getattr(self.parent, 'state', None)
+
     def __eq__(self, other):
         return self.src == other.src
 
@@ -126,7 +219,7 @@ class OverlaySource(object):
 
     def is_supported(self):
         '''Is the overlay type supported?'''
-        return _supported(self.get_type_key(), self.supported)
+        return BINARIES.supported(self.get_type_key(), self.supported)
 
     def get_type_key(self):
         return '%s' % self.__class__.type_key
@@ -134,6 +227,27 @@ class OverlaySource(object):
     def command(self):
         return self.config['%s_command' % self.__class__.type_key]
 
+    def ssh_command(self):
+        '''Returns an ssh command line sharing one master connection
+        per host between all commands run against it, or None if the
+        source is not reached over ssh or sharing is disabled.'''
+        if not is_ssh_source(self.src):
+            return None
+        persist = self.config['ssh_control_persist']
+        control_dir = self.config['ssh_control_dir']
+        if not persist or persist == '0' or not control_dir:
+            return None
+        if not os.path.isdir(control_dir):
+            try:
+                os.makedirs(control_dir, 0o700)
+            except OSError as error:
+                self.output.debug('OverlaySource.ssh_command(): could not '
+                    'create %s: %s' % (control_dir, str(error)), 4)
+                return None
+        return 'ssh -o ControlMaster=auto -o ControlPath=%s -o ' \
+            'ControlPersist=%s' % (quote(os.path.join(control_dir, '%C')),
+            quote(persist))
+
     def run_command(self, command, args, **kwargs):
         self.output.debug("OverlaySource.run_command(): " + command, 6)
         file_to_run = _resolve_command(command, self.output.error)[1]
@@ -144,7 +258,7 @@ class OverlaySource(object):
         cwd = kwargs.get('cwd', None)
         env = None
         env_updates = None
-        if 'env' in kwargs:
+        if kwargs.get('env'):
             # Build actual env from surrounding plus updates
             env_updates = kwargs['env']
             env = copy.copy(os.environ)
@@ -201,6 +315,42 @@ class OverlaySource(object):
 
         return result
 
+    def capture_command(self, command, args, **kwargs):
+        '''Runs a command detached from the terminal and returns its
+        exit status and standard output.  Meant for quick queries
+        like probe(), the output is not shown to the user.'''
+        file_to_run = _resolve_command(command, self.output.debug)[1]
+        if not file_to_run:
+            return (1, '')
+        args = [file_to_run] + args
+        env = None
+        if kwargs.get('env'):
+            env = copy.copy(os.environ)
+            env.update(kwargs['env'])
+        self.output.debug("OverlaySource.capture_command(): "
+            + ' '.join(args), 6)
+        try:
+            proc = subprocess.Popen(args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=kwargs.get('cwd', None),
+                env=env)
+            output, errors = proc.communicate()
+        except OSError as error:
+            self.output.debug("OverlaySource.capture_command(): failed: "
+                + str(error), 4)
+            return (1, '')
+        if hasattr(output, 'decode'):
+            output = output.decode('UTF-8', 'replace')
+        return (proc.returncode, output)
+
+    def probe(self, base):
+        '''Returns an identifier of the current upstream revision,
+        obtained without syncing, or None if that is not possible.
+        Overridden in subclasses that support it.'''
+        return None
+
     def postsync(self, failed_sync, **kwargs):
         """Runs any repo specific postsync operations
         """
@@ -215,8 +365,9 @@ class OverlaySource(object):
                 kwargs.get('cwd', '')).split()
             command = _opt[0]
             args = _opt[1:]
-            return self.run_command(command, args,
-                cmd='%s_postsync' % self.__class__.type_key)
+            with phase('postsync'):
+                return self.run_command(command, args,
+                    cmd='%s_postsync' % self.__class__.type_key)
         return failed_sync
 
     def to_xml_hook(self, repo_elem):
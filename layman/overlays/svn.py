@@ -22,7 +22,12 @@ __version__ = "$Id: svn.py 236 2006-09-05 20:39:37Z wrobel $"
 
 
 import os
-from subprocess import PIPE, Popen
+
+try:
+    import sqlite3
+except ImportError:
+    # the working copy format is then taken from the marker alone
+    sqlite3 = None
 
 #==============================================================================
 #
@@ -34,6 +39,10 @@ from layman.utils           import path
 from layman.overlays.source import (OverlaySource, require_supported,
     _resolve_command)
 
+# working copies written by subversion 1.6 and older keep their
+# format in .svn/entries, everything since uses .svn/wc.db
+WC_NG_FORMAT = 12
+
 #==============================================================================
 #
 # Class SvnOverlay
@@ -142,6 +151,19 @@ class SvnOverlay(OverlaySource):
             self.run_command(self.command(), args, cmd=self.type),
             cwd=self.target)
 
+    def probe(self, base):
+        '''Returns the last revision that changed the source.'''
+        if not self.supported():
+            return None
+
+        # svn info --non-interactive --show-item last-changed-revision SOURCE
+        args = ['info', '--non-interactive', '--show-item',
+            'last-changed-revision', self._fix_svn_source(self.src)]
+        result, output = self.capture_command(self.command(), args)
+        if result or not output.strip():
+            return None
+        return output.strip()
+
     def supported(self):
         '''Overlay type supported?'''
 
@@ -159,20 +181,73 @@ class SvnOverlay(OverlaySource):
         cleanup = self.run_command(self.command(), args, cmd="svn cleanup")
         return
 
+    @staticmethod
+    def wc_format(target):
+        '''
+        Returns the format number of the working copy at target, 0 if
+        it uses .svn/wc.db but cannot be read, or None if there is no
+        working copy.
+        '''
+        wc_db = os.path.join(target, '.svn', 'wc.db')
+        if os.path.exists(wc_db):
+            if sqlite3 is None:
+                return 0
+            try:
+                connection = sqlite3.connect(wc_db)
+                try:
+                    return connection.execute('PRAGMA user_version'
+                        ).fetchone()[0]
+                finally:
+                    connection.close()
+            except sqlite3.Error:
+                return 0
+        try:
+            with open(os.path.join(target, '.svn', 'entries')) as entries:
+                return int(entries.readline().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _client_id(self):
+        '''Identifies the installed svn client without running it.'''
+        file_to_run = _resolve_command(self.command(), self.output.debug)[1]
+        try:
+            info = os.stat(file_to_run)
+        except (OSError, TypeError):
+            return None
+        return '%s:%d:%d' % (file_to_run, int(info.st_mtime), info.st_size)
+
     def check_upgrade(self, target):
-        '''Code to run "svn upgrade" it only takes longer
-        than checking if it does need an upgrade if it is
-        actually needed.
         '''
-        file_to_run = _resolve_command(self.command(), self.output.error)[1]
-        args = " ".join([file_to_run, " upgrade", target])
-        pipe = Popen(args, shell=True, stdout=PIPE, stderr=PIPE)
-        if pipe:
-            self.output.debug("SVN: check_upgrade()... have a valid pipe, "
-                "running upgrade", 4)
-            upgrade_output = pipe.stdout.readline().strip('\n')
-            if upgrade_output:
-                self.output.debug("  output: %s" % upgrade_output, 4)
-            self.output.debug("SVN: check_upgrade()... svn upgrade done", 4)
-            pipe.terminate()
-        return
+        Runs "svn upgrade" on the working copy at target, but only if
+        it is in a pre 1.7 format, or if its format or the svn client
+        changed since the last check recorded in the sync state of the
+        driving DB.  Otherwise this costs two stat() calls and a read
+        of the wc.db header.
+        '''
+        wc_format = self.wc_format(target)
+        if wc_format is None:
+            self.output.debug("SVN: check_upgrade()... no working copy "
+                "at %s" % target, 4)
+            return
+        state = self.state
+        marker = {'format': wc_format, 'client': self._client_id()}
+        if wc_format >= WC_NG_FORMAT and state is not None and \
+                state.get(self.parent.name, 'svn') == marker:
+            self.output.debug("SVN: check_upgrade()... format %d is current"
+                % wc_format, 4)
+            return
+
+        self.output.debug("SVN: check_upgrade()... running svn upgrade, "
+            "format = %d" % wc_format, 4)
+        result, upgrade_output = self.capture_command(self.command(),
+            ['upgrade', target])
+        if upgrade_output.strip():
+            self.output.debug("  output: %s" % upgrade_output.strip(), 4)
+        if result:
+            # leave it to "svn up" to report the problem
+            return
+        if state is not None:
+            marker['format'] = self.wc_format(target)
+            state.set(self.parent.name, 'svn', marker)
+            state.write()
+        self.output.debug("SVN: check_upgrade()... svn upgrade done", 4)
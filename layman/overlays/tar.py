@@ -29,19 +29,76 @@ __version__ = "$Id: tar.py 310 2007-04-09 16:30:40Z wrobel $"
 import os
 import os.path
 import sys
+import stat
 import shutil
+import filecmp
+import hashlib
+import tarfile
 import tempfile
 
+from   contextlib               import closing
+
 import xml.etree.ElementTree as ET # Python 2.5
 
 from   layman.compatibility     import fileopen
 from   layman.overlays.source   import OverlaySource, require_supported
+from   layman.syncreport        import add_bytes
 from   layman.utils             import path
 from   layman.version           import VERSION
-from   sslfetch.connections     import Connector
 
 USERAGENT = "Layman" + VERSION
 
+# seconds to wait for a tar package server to respond
+HTTP_TIMEOUT = 30
+
+# size of the blocks tar packages are checksummed in
+READ_SIZE = 64 * 1024
+
+TAR_EXTENSIONS = [('tar.%s' % e) for e in ('bz2', 'gz', 'lzma', 'xz', 'Z')] \
+    + ['tgz', 'tbz', 'taz', 'tlz', 'txz']
+
+# compressions the tarfile module cannot stream, the tar command
+# is used for them
+if 'xz' in tarfile.TarFile.OPEN_METH:
+    COMMAND_ONLY_EXTENSIONS = ('.tar.Z', '.taz')
+else:
+    # Python 2 has no lzma support
+    COMMAND_ONLY_EXTENSIONS = ('.tar.Z', '.taz', '.tar.lzma', '.tlz',
+        '.tar.xz', '.txz')
+
+# refuse links and devices pointing outside the overlay, where the
+# tarfile module can do so itself (Python 3.12 and the backports)
+if hasattr(tarfile, 'data_filter'):
+    EXTRACT_OPTIONS = {'filter': 'data'}
+else:
+    EXTRACT_OPTIONS = {}
+
+def _urllib2():
+    '''Imports the http machinery only once a package is fetched.'''
+    if sys.hexversion >= 0x30200f0:
+        import urllib.request as urllib2
+    else:
+        import urllib2
+    return urllib2
+
+
+class _HashingReader(object):
+    '''Passes reads through to a file object, checksumming the data.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
 #===============================================================================
 #
 # Class TarOverlay
@@ -97,17 +154,135 @@ class TarOverlay(OverlaySource):
         self.branch = self.parent.branch
 
 
-    def _extract(self, base, tar_url, dest_dir):
-        ext = '.tar.noidea'
-        clean_tar = self.config['clean_tar']
-        for i in [('tar.%s' % e) for e in ('bz2', 'gz', 'lzma', 'xz', 'Z')] \
-                + ['tgz', 'tbz', 'taz', 'tlz', 'txz']:
+    def _extension(self):
+        '''Returns the file extension of the tar package.'''
+        for i in TAR_EXTENSIONS:
             candidate_ext = '.%s' % i
             if self.src.endswith(candidate_ext):
-                ext = candidate_ext
-                break
+                return candidate_ext
+        return '.tar.noidea'
+
+    def native(self):
+        '''Whether the package is extracted with the tarfile module
+        instead of the tar command.'''
+        return (self.config.get_option('tar_native') and
+            self._extension() not in COMMAND_ONLY_EXTENSIONS)
+
+    def _open_url(self, request):
+        urllib2 = _urllib2()
+        handlers = []
+        if self.proxies:
+            handlers.append(urllib2.ProxyHandler(self.proxies))
+        opener = urllib2.build_opener(*handlers)
+        return opener.open(request, timeout=HTTP_TIMEOUT)
+
+    def _safe_members(self, archive, dest_dir):
+        '''Yields the members of archive that stay inside dest_dir.'''
+        dest_dir = os.path.realpath(dest_dir)
+
+        def inside(name):
+            name = os.path.realpath(name)
+            return name == dest_dir or name.startswith(dest_dir + os.sep)
+
+        for member in archive:
+            target = os.path.join(dest_dir, member.name)
+            if member.issym():
+                link = os.path.join(os.path.dirname(target), member.linkname)
+            elif member.islnk():
+                link = os.path.join(dest_dir, member.linkname)
+            else:
+                link = target
+            if member.isdev() or not (inside(target) and inside(link)):
+                self.output.warn('Skipping unsafe tar member "%s" of %s'
+                    % (member.name, self.parent.name), 2)
+                continue
+            self.output.debug('TarOverlay: extracting %s' % member.name, 8)
+            yield member
+
+    def _recorded(self):
+        '''Returns the validators of the package extracted last, as
+        stored by _record(), or an empty dict.'''
+        if self.state is None:
+            return {}
+        recorded = self.state.get(self.parent.name, 'tar')
+        if not recorded or recorded.get('source') != self.src:
+            return {}
+        return recorded
+
+    def _record(self, validators):
+        state = self.state
+        if state is None:
+            return
+        validators = dict(validators, source=self.src)
+        if state.get(self.parent.name, 'tar') != validators:
+            state.set(self.parent.name, 'tar', validators)
+            state.write()
+
+    @staticmethod
+    def _file_sha256(filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as package:
+            for block in iter(lambda: package.read(READ_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _extract_native(self, tar_url, dest_dir, recorded):
+        '''Extracts the tar package while it is being downloaded.'''
+        urllib2 = _urllib2()
+        headers = {'User-Agent': USERAGENT}
+        if recorded.get('etag'):
+            headers['If-None-Match'] = recorded['etag']
+        if recorded.get('last_modified'):
+            headers['If-Modified-Since'] = recorded['last_modified']
+        info = {}
+        try:
+            if 'file://' in tar_url:
+                stream = open(tar_url.replace('file://', ''), 'rb')
+            else:
+                stream = self._open_url(urllib2.Request(tar_url,
+                    headers=headers))
+                info = stream.info()
+        except urllib2.HTTPError as error:
+            if error.code == 304:
+                return 0, recorded, False
+            raise Exception('Failed to fetch tar package ' + tar_url +
+                            '\nError was:' + str(error))
+        except Exception as error:
+            raise Exception('Failed to fetch tar package ' + tar_url +
+                            '\nError was:' + str(error))
+
+        reader = _HashingReader(stream)
+        try:
+            with closing(reader):
+                # "r|*" decompresses on the fly and never seeks back
+                with closing(tarfile.open(fileobj=reader, mode='r|*')) \
+                        as archive:
+                    archive.extractall(dest_dir,
+                        members=self._safe_members(archive, dest_dir),
+                        **EXTRACT_OPTIONS)
+                # the checksum covers the padding tarfile did not need
+                while reader.read(READ_SIZE):
+                    pass
+        except (tarfile.TarError, EOFError, IOError, OSError) as error:
+            self.output.error('Failed to extract tar package ' + tar_url +
+                              '\nError was: ' + str(error))
+            return 1, None, True
+        finally:
+            add_bytes(reader.size)
+
+        validators = {'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'sha256': reader.sha256.hexdigest()}
+        return 0, validators, validators['sha256'] != recorded.get('sha256')
+
+    def _extract_command(self, base, tar_url, dest_dir, recorded):
+        '''Extracts the tar package by running tar on it.'''
+        ext = self._extension()
+        clean_tar = self.config['clean_tar']
 
         if 'file://' not in tar_url:
+            from sslfetch.connections import Connector
+
             # setup the ssl-fetch output map
             connector_output = {
                 'info':  self.output.debug,
@@ -119,6 +294,12 @@ class TarOverlay(OverlaySource):
             fetcher = Connector(connector_output, self.proxies, USERAGENT)
 
             success, tar, timestamp = fetcher.fetch_content(tar_url)
+            if not success:
+                raise Exception('Failed to fetch tar package ' + tar_url)
+            add_bytes(len(tar))
+            validators = {'sha256': hashlib.sha256(tar).hexdigest()}
+            if validators['sha256'] == recorded.get('sha256'):
+                return 0, validators, False
 
             pkg = path([base, self.parent.name + ext])
 
@@ -132,6 +313,7 @@ class TarOverlay(OverlaySource):
         else:
             clean_tar = False
             pkg = tar_url.replace('file://', '')
+            validators = {'sha256': self._file_sha256(pkg)}
 
         # tar -v -x -f SOURCE -C TARGET
         args = ['-v', '-x', '-f', pkg, '-C', dest_dir]
@@ -139,9 +321,115 @@ class TarOverlay(OverlaySource):
 
         if clean_tar:
             os.unlink(pkg)
-        return result
-
-    def _add_unchecked(self, base):
+        return result, validators, True
+
+    def _extract(self, base, tar_url, dest_dir, conditional=False):
+        '''
+        Extracts the tar package into dest_dir.  Returns the result,
+        the validators (ETag, Last-Modified and sha256) of the package
+        and whether it changed.  Only when conditional is set, an
+        unchanged package may be left unextracted.
+        '''
+        recorded = self._recorded() if conditional else {}
+
+        stamp = None
+        if 'file://' in tar_url:
+            # only probe() trusts the stamp, a package rewritten within
+            # the file system's timestamp resolution keeps it
+            stamp = self._stamp(tar_url.replace('file://', ''))
+        if stamp and recorded.get('sha256'):
+            try:
+                sha256 = self._file_sha256(tar_url.replace('file://', ''))
+            except (IOError, OSError):
+                sha256 = None
+            if sha256 == recorded['sha256']:
+                return 0, dict(recorded, stamp=stamp), False
+
+        if self.native():
+            result, validators, changed = self._extract_native(tar_url,
+                dest_dir, recorded)
+        else:
+            result, validators, changed = self._extract_command(base,
+                tar_url, dest_dir, recorded)
+        if stamp and validators:
+            validators = dict(validators, stamp=stamp)
+        return result, validators, changed
+
+    @staticmethod
+    def _stamp(filename):
+        '''Returns "mtime:size" of a local tar package, or None.'''
+        try:
+            info = os.stat(filename)
+        except OSError:
+            return None
+        mtime = getattr(info, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(info.st_mtime * 1000000000)
+        return '%d:%d' % (mtime, info.st_size)
+
+    @staticmethod
+    def _revision(validators):
+        '''Returns the revision probe() reports for a package with
+        the given validators, as recorded by _record().'''
+        if validators.get('stamp'):
+            return validators['stamp']
+        for header, key in (('ETag', 'etag'),
+                ('Last-Modified', 'last_modified')):
+            if validators.get(key):
+                return '%s:%s' % (header, validators[key])
+        return None
+
+    @staticmethod
+    def _same_file(source, target):
+        if os.path.islink(source) or os.path.islink(target):
+            return (os.path.islink(source) and os.path.islink(target) and
+                os.readlink(source) == os.readlink(target))
+        if not os.path.isfile(source) or not os.path.isfile(target):
+            return False
+        source_info, target_info = os.stat(source), os.stat(target)
+        return (source_info.st_size == target_info.st_size and
+            stat.S_IMODE(source_info.st_mode) ==
+                stat.S_IMODE(target_info.st_mode) and
+            filecmp.cmp(source, target, shallow=False))
+
+    @staticmethod
+    def _remove(name):
+        if os.path.isdir(name) and not os.path.islink(name):
+            shutil.rmtree(name)
+        else:
+            os.unlink(name)
+
+    def _merge_tree(self, source, target):
+        '''
+        Makes target look like source, moving over only the files whose
+        contents differ, so unchanged files keep their modification time.
+        Returns the number of entries changed.
+        '''
+        changed = 0
+        names = set(os.listdir(source))
+        for name in os.listdir(target):
+            if name not in names:
+                self._remove(os.path.join(target, name))
+                changed += 1
+
+        for name in sorted(names):
+            new, old = os.path.join(source, name), os.path.join(target, name)
+            if os.path.isdir(new) and not os.path.islink(new):
+                if os.path.lexists(old) and (os.path.islink(old) or
+                        not os.path.isdir(old)):
+                    self._remove(old)
+                if os.path.isdir(old):
+                    changed += self._merge_tree(new, old)
+                    continue
+            elif self._same_file(new, old):
+                continue
+            elif os.path.isdir(old) and not os.path.islink(old):
+                shutil.rmtree(old)
+            os.rename(new, old)
+            changed += 1
+        return changed
+
+    def _add_unchecked(self, base, update=False):
         def try_to_wipe(folder):
             if not os.path.exists(folder):
                 return
@@ -154,31 +442,48 @@ class TarOverlay(OverlaySource):
                                 + folder + '"\nError was:' + str(error))
 
         final_path = path([base, self.parent.name])
+        # only touch what changed in an existing checkout
+        update = update and os.path.isdir(final_path)
         temp_path = tempfile.mkdtemp(dir=base)
         try:
-            result = self._extract(base=base, tar_url=self.src,
-                dest_dir=temp_path)
+            result, validators, changed = self._extract(base=base,
+                tar_url=self.src, dest_dir=temp_path, conditional=update)
         except Exception as error:
             try_to_wipe(temp_path)
             raise error
 
-        if result == 0:
+        if result == 0 and not changed:
+            self.output.info('The tar package of overlay "%s" did not change'
+                % self.parent.name, 2)
+            self._record(validators)
+        elif result == 0:
             if self.branch:
                 source = temp_path + '/' + self.branch
             else:
                 source = temp_path
 
             if os.path.exists(source):
-                if os.path.exists(final_path):
-                    self.delete(base)
-
-                try:
-                    os.rename(source, final_path)
-                except Exception as error:
-                    raise Exception('Failed to rename tar subdirectory ' +
-                                    source + ' to ' + final_path +
-                                    '\nError was:' + str(error))
+                if update:
+                    try:
+                        changed = self._merge_tree(source, final_path)
+                    except Exception as error:
+                        raise Exception('Failed to update ' + final_path +
+                                        ' from ' + source +
+                                        '\nError was:' + str(error))
+                    self.output.info('Updated %d entries of overlay "%s"'
+                        % (changed, self.parent.name), 2)
+                else:
+                    if os.path.exists(final_path):
+                        self.delete(base)
+
+                    try:
+                        os.rename(source, final_path)
+                    except Exception as error:
+                        raise Exception('Failed to rename tar subdirectory ' +
+                                        source + ' to ' + final_path +
+                                        '\nError was:' + str(error))
                 os.chmod(final_path, 0o755)
+                self._record(validators)
             else:
                 raise Exception('The given path (branch setting in the xml)\n' + \
                     '"%(source)s" does not exist in the tar package!' % ({'source': source}))
@@ -211,12 +516,50 @@ class TarOverlay(OverlaySource):
         target = path([base, self.parent.name])
 
         return self.postsync(
-            self._add_unchecked(base),
+            self._add_unchecked(base, update=True),
             cwd=target)
 
+    def probe(self, base):
+        '''Returns a tag identifying the current tar package, taken from
+        the file's mtime and size or from the http ETag/Last-Modified
+        headers.  The check is made against the validators recorded
+        when the package was last extracted, so an unchanged package
+        always reports the revision of that extraction.'''
+        if 'file://' in self.src:
+            return self._stamp(self.src.replace('file://', ''))
+        recorded = self._recorded()
+
+        class HeadRequest(_urllib2().Request):
+            def get_method(self):
+                return 'HEAD'
+
+        headers = {'User-Agent': USERAGENT}
+        if recorded.get('etag'):
+            headers['If-None-Match'] = recorded['etag']
+        if recorded.get('last_modified'):
+            headers['If-Modified-Since'] = recorded['last_modified']
+        try:
+            response = self._open_url(HeadRequest(self.src, headers=headers))
+            info = response.info()
+            response.close()
+        except _urllib2().HTTPError as error:
+            if error.code == 304:
+                return self._revision(recorded)
+            self.output.debug('TarOverlay.probe(): HEAD request for "%s" '
+                'failed: %s' % (self.src, str(error)), 4)
+            return None
+        except Exception as error:
+            self.output.debug('TarOverlay.probe(): HEAD request for "%s" '
+                'failed: %s' % (self.src, str(error)), 4)
+            return None
+        return self._revision({'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified')})
+
     def supported(self):
         '''Overlay type supported?'''
 
+        if self.native():
+            return True
         return require_supported(
             [(self.command(),  'tar', 'app-arch/tar'), ],
             self.output.warn)
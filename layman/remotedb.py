@@ -28,28 +28,42 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 
 import os, os.path
 import sys
+import time
 import hashlib
 
-GPG_ENABLED = False
-try:
-    from pygpg.config import GPGConfig
-    from pygpg.gpg import GPG
-    GPG_ENABLED = True
-except ImportError:
-    pass
+def _gpg_available():
+    '''Checks for pyGPG without importing it, that only happens once
+    a signed list is fetched.'''
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python 2
+        import imp
+        try:
+            imp.find_module('pygpg')
+        except ImportError:
+            return False
+        return True
+    return find_spec('pygpg') is not None
+
+GPG_ENABLED = _gpg_available()
 
 
-from   layman.utils             import encoder
+from   layman.utils             import encoder, run_jobs
 from   layman.dbbase            import DbBase
 from   layman.version           import VERSION
 from   layman.compatibility     import fileopen
-from   sslfetch.connections     import Connector
+from   layman.lock              import CACHE_LOCK
 
 USERAGENT = "Layman-" + VERSION
 
 class RemoteDB(DbBase):
     '''Handles fetching the remote overlay list.'''
 
+    compile_cache = True
+
+    lock_name = CACHE_LOCK
+
     def __init__(self, config, ignore_init_read_errors=False):
 
         self.config = config
@@ -57,6 +71,10 @@ class RemoteDB(DbBase):
         self.detached_urls = []
         self.signed_urls = []
         self.proxies = config.proxies
+        # list url -> {'duration', 'path' and, once parsed, 'entries'}
+        # of the lists downloaded by the last cache(), signatures
+        # are not included
+        self.fetch_stats = {}
         
         self.urls  = [i.strip()
             for i in config['overlays'].split('\n') if len(i)]
@@ -120,6 +138,8 @@ class RemoteDB(DbBase):
         >>> a = RemoteDB(config)
         >>> a.cache()
         (True, True)
+        >>> a.cache()
+        (False, True)
         >>> b = fileopen(a.filepath(config['overlays'])+'.xml')
         >>> b.readlines()[24]
         '      A collection of ebuilds from Gunnar Wrobel [wrobel@gentoo.org].\\n'
@@ -127,26 +147,62 @@ class RemoteDB(DbBase):
         >>> b.close()
         >>> os.unlink(a.filepath(config['overlays'])+'.xml')
 
-        >>> a.overlays.keys()
+        >>> sorted(a.overlays.keys())
         ['wrobel', 'wrobel-stable']
 
+        >>> os.path.exists(a.filepath(config['overlays']) + '.pickle')
+        True
+
         >>> import shutil
         >>> shutil.rmtree(tmpdir)
         '''
+        # (temp file, cache file) pairs, filled by _cache()
+        replacements = []
+        try:
+            return self._cache(replacements)
+        finally:
+            # other layman processes read the lists under a shared
+            # lock, it is only held while the new files are moved in;
+            # lists done before a failure are kept like before
+            with self.locks.lock(CACHE_LOCK):
+                for temp_path, path in replacements:
+                    os.rename(temp_path, path)
+
+
+    @staticmethod
+    def _temp_path(path):
+        '''Returns where the new version of a cache file is written
+        before it replaces the old one.'''
+        return '%s.%d.tmp' % (path, os.getpid())
+
+
+    def _cache(self, replacements):
+        '''Downloads, verifies and parses the lists into temp files,
+        adding them and the cache files they replace to replacements.'''
         has_updates = False
+        self.fetch_stats = {}
         self._create_storage(self.config['storage'])
         # succeeded reset when a failure is detected
         succeeded = True
         url_lists = [self.urls, self.detached_urls, self.signed_urls]
         need_gpg = [False, True, True]
-        # setup the ssl-fetch output map
-        connector_output = {
-            'info':  self.output.debug,
-            'error': self.output.error,
-            'kwargs-info': {'level': 2},
-            'kwargs-error':{'level': None},
-        }
-        fetcher = Connector(connector_output, self.proxies, USERAGENT)
+
+        # download all lists and detached signatures at once,
+        # they are verified and parsed one after the other below
+        downloads = []
+        for urls in url_lists:
+            for url in urls:
+                filepath, mpath, tpath, sig = self._paths(url)
+                if sig:
+                    downloads.append((url[0], mpath, tpath))
+                    downloads.append((url[1], sig, None))
+                else:
+                    downloads.append((url, mpath, tpath))
+        jobs = self._fetch_jobs()
+        self.output.debug("RemoteDB.cache() fetching %d files, jobs = %d"
+            % (len(downloads), jobs), 2)
+        fetched = dict(zip(downloads,
+            run_jobs(self._download, downloads, jobs)))
 
         for index in range(0, 3):
             self.output.debug("RemoteDB.cache() index = %s" %str(index), 2)
@@ -160,15 +216,10 @@ class RemoteDB(DbBase):
                 self.output.debug("RemoteDB.cache() url = %s is a tuple=%s"
                     %(str(url), str(isinstance(url, tuple))), 2)
                 filepath, mpath, tpath, sig = self._paths(url)
-                if 'file://' in url:
-                    success, olist, timestamp = self._fetch_file(
-                        url, mpath, tpath)
-                elif sig:
-                    success, olist, timestamp = fetcher.fetch_content(
-                        url[0], tpath)
+                if sig:
+                    success, olist, timestamp = fetched[(url[0], mpath, tpath)]
                 else:
-                    success, olist, timestamp = fetcher.fetch_content(
-                        url, tpath)
+                    success, olist, timestamp = fetched[(url, mpath, tpath)]
                 if not success:
                     #succeeded = False
                     continue
@@ -177,7 +228,14 @@ class RemoteDB(DbBase):
                     % str(len(olist)), 2)
                 # GPG handling
                 if need_gpg[index]:
-                    olist, verified = self.verify_gpg(url, sig, olist)
+                    if sig:
+                        sig_success, sigtext, sig_timestamp = \
+                            fetched[(url[1], sig, None)]
+                        if sig_success:
+                            self.write_cache(sigtext, self._temp_path(sig))
+                            replacements.append((self._temp_path(sig), sig))
+                    olist, verified = self.verify_gpg(url,
+                        sig and self._temp_path(sig), olist)
                     if not verified:
                         self.output.debug("RemoteDB.cache() gpg returned "
                             "verified = %s" %str(verified), 2)
@@ -190,19 +248,76 @@ class RemoteDB(DbBase):
                 # Before we overwrite the old cache, check that the downloaded
                 # file is intact and can be parsed
                 if isinstance(url, tuple):
-                    olist = self._check_download(olist, url[0])
+                    olist, overlays = self._check_download(olist, url[0])
                 else:
-                    olist = self._check_download(olist, url)
+                    olist, overlays = self._check_download(olist, url)
 
-                # Ok, now we can overwrite the old cache
+                # Ok, now we can replace the old cache
                 has_updates = max(has_updates,
-                    self.write_cache(olist, mpath, tpath, timestamp))
+                    self.write_cache(olist, self._temp_path(mpath),
+                        self._temp_path(tpath), timestamp))
+                replacements.append((self._temp_path(mpath), mpath))
+                if timestamp is not None:
+                    replacements.append((self._temp_path(tpath), tpath))
+                self.fetch_stats[url[0] if isinstance(url, tuple) else url][
+                    'entries'] = len(overlays)
+                # and store the parsed list for the next startup, the
+                # rename keeps what identifies the list it was made from
+                cpath = self.compiled_path(mpath)
+                if self.write_compiled(self._temp_path(mpath),
+                        [ovl.name for ovl in overlays],
+                        self._temp_path(cpath)):
+                    replacements.append((self._temp_path(cpath), cpath))
 
             self.output.debug("RemoteDB.cache() self.urls:  has_updates, "
                 "succeeded %s, %s" % (str(has_updates), str(succeeded)), 4)
         return has_updates, succeeded
 
 
+    def _fetch_jobs(self):
+        try:
+            return max(int(self.config['fetch_jobs']), 1)
+        except (TypeError, ValueError):
+            self.output.warn('Invalid fetch_jobs setting "%s", fetching one '
+                'list at a time' % self.config['fetch_jobs'], 2)
+            return 1
+
+
+    def _download(self, download):
+        '''Fetches one (url, mpath, tpath) download, safe to run from
+        several threads at once.'''
+        url, mpath, tpath = download
+        started = time.time()
+        try:
+            if 'file://' in url:
+                return self._fetch_file(url, mpath, tpath)
+            return self._fetch_url(url, tpath)
+        finally:
+            # only lists keep a timestamp, detached signatures do not
+            if tpath is not None:
+                self.fetch_stats[url] = {'duration': time.time() - started,
+                    'path': mpath}
+
+
+    def _fetch_url(self, url, tpath=None):
+        '''Fetches url, unless it is unchanged since the timestamp
+        recorded in tpath.'''
+        # setup the ssl-fetch output map
+        connector_output = {
+            'info':  self.output.debug,
+            'error': self.output.error,
+            'kwargs-info': {'level': 2},
+            'kwargs-error':{'level': None},
+        }
+        from sslfetch.connections import Connector
+
+        # one connector per download, they are not shared between threads
+        fetcher = Connector(connector_output, self.proxies, USERAGENT)
+        if tpath:
+            return fetcher.fetch_content(url, tpath)
+        return fetcher.fetch_content(url)
+
+
     def _paths(self, url):
         self.output.debug("RemoteDB._paths(), url is tuple %s" % str(url), 2)
         if isinstance(url, tuple):
@@ -239,49 +354,56 @@ class RemoteDB(DbBase):
 
         return base + '_' + hashlib.md5(url_encoded).hexdigest()
 
+    @staticmethod
+    def _file_signature(filepath):
+        '''Returns a string that changes whenever the file is modified
+        or replaced: its mtime (in ns where available), size and inode.'''
+        info = os.stat(filepath)
+        mtime = getattr(info, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(info.st_mtime * 1000000000)
+        return '%d %d %d' % (mtime, info.st_size, info.st_ino)
+
     def _fetch_file(self, url, mpath, tpath=None):
         self.output.debug('RemoteDB._fetch_file() url = %s' % url, 2)
         # check when the cache was last updated
         # and don't re-fetch it unless it has changed
 
         filepath = url.replace('file://','')
-        url_timestamp = None
         timestamp = ''
 
-        if tpath and os.path.exists(tpath):
+        if tpath and os.path.exists(tpath) and os.path.exists(mpath):
             with fileopen(tpath,'r') as previous:
-                timestamp = previous.read()
+                timestamp = previous.read().strip()
 
         if not self.check_path([mpath]):
             return (False, '', '')
 
         try:
-            url_timestamp = os.stat(filepath).st_mtime
-            if url_timestamp != timestamp:
-                self.output.debug('RemoteDB._fetch_file() opening file', 2)
-                # Fetch the remote list
-                with fileopen(filepath) as connection:
-                    olist = connection.read()
-
-            else:
+            url_timestamp = self._file_signature(filepath)
+            if url_timestamp == timestamp:
                 self.output.info('Remote list already up to date: %s'
                     % url, 4)
-                self.output.info('Last-modified: %s' % timestamp, 4)
-        except IOError as error:
+                return (False, '', '')
+
+            self.output.debug('RemoteDB._fetch_file() opening file', 2)
+            # Fetch the remote list
+            with fileopen(filepath) as connection:
+                olist = connection.read()
+        except (IOError, OSError) as error:
             self.output.error('RemoteDB._fetch_file(); Failed to update the '
                 'overlay list from: %s\nIOError was:%s\n'
                 % (url, str(error)))
             return (False, '', '')
-        else:
-            quieter = 1
-            self.output.info('Fetching new list... %s' % url, 4 + quieter)
-            if url_timestamp is not None:
-                self.output.info('Last-modified: %s' % url_timestamp,
-                    4 + quieter)
-            self.output.debug('RemoteDB._fetch_url(), olist type = %s'
-                % str(type(olist)),2)
 
-            return (True, olist, url_timestamp)
+        quieter = 1
+        self.output.info('Fetching new list... %s' % url, 4 + quieter)
+        self.output.debug('RemoteDB._fetch_file(), signature: %s'
+            % url_timestamp, 4)
+        self.output.debug('RemoteDB._fetch_file(), olist type = %s'
+            % str(type(olist)),2)
+
+        return (True, olist, url_timestamp)
 
     def check_path(self, paths, hint=True):
         '''Check for sufficient privileges'''
@@ -303,7 +425,10 @@ class RemoteDB(DbBase):
     def _check_download(self, olist, url):
 
         try:
-            self.read(olist, origin=url)
+            # create every Overlay now, so broken entries are found
+            # before the old cache is overwritten
+            overlays = [self.overlays[name]
+                for name in self.read(olist, origin=url)]
         except Exception as error:
             self.output.debug("RemoteDB._check_download(), url=%s \nolist:\n"
                 % url,2)
@@ -317,7 +442,7 @@ class RemoteDB(DbBase):
         # the folowing is neded for py3 only
         if sys.hexversion >= 0x3000000 and hasattr(olist, 'decode'):
             olist = olist.decode("UTF-8")
-        return olist
+        return olist, overlays
 
 
     @staticmethod
@@ -344,10 +469,9 @@ class RemoteDB(DbBase):
             " %s, type(olist)=%s" % (str(url),str(type(olist))), 2)
         #self.output.debug(olist, 2)
 
-        # detached sig
+        # detached sig, downloaded to sig by cache() or dl_sig()
         if sig:
             self.output.debug("RemoteDB.verify_gpg(), detached sig", 2)
-            self.dl_sig(url[1], sig)
             gpg_result = self.gpg.verify(
                 inputtxt=olist,
                 inputfile=sig)
@@ -372,7 +496,10 @@ class RemoteDB(DbBase):
 
     def dl_sig(self, url, sig):
         self.output.debug("RemoteDB.dl_sig() url=%s, sig=%s" % (url, sig), 2)
-        success, newsig, timestamp = self._fetch_url(url, sig)
+        if 'file://' in url:
+            success, newsig, timestamp = self._fetch_file(url, sig)
+        else:
+            success, newsig, timestamp = self._fetch_url(url)
         if success:
             success = self.write_cache(newsig, sig)
         return success
@@ -380,6 +507,9 @@ class RemoteDB(DbBase):
 
     def init_gpg(self):
         self.output.debug("RemoteDB.init_gpg(), initializing", 2)
+        from pygpg.config import GPGConfig
+        from pygpg.gpg import GPG
+
         if not self.gpg_config:
             self.gpg_config = GPGConfig()
 
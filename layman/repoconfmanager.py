@@ -15,6 +15,7 @@
 #             Devan Franchini <twitch153@gentoo.org>
 #
 
+import os
 import re
 
 import layman.reposconf as reposconf
@@ -35,6 +36,11 @@ class RepoConfManager:
         'repos.conf': (reposconf, 'ConfigHandler')
         }
 
+        # config type -> (handler, signature of its file)
+        self._handlers = {}
+        # config types with changes not written yet
+        self._dirty = set()
+
         if isinstance(self.conf_types, str):
             self.conf_types = re.split(',\s+', self.conf_types)
 
@@ -43,48 +49,119 @@ class RepoConfManager:
                 + '\nis required in order to continue...')
 
 
-    def add(self, overlay):
+    def _signature(self, conf):
+        '''Identifies the state of a handler's config file on disk.'''
+        try:
+            info = os.stat(conf.path)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size, info.st_ino)
+
+
+    def _handler(self, types):
+        '''
+        Returns the handler for a config type, reusing the one created
+        before unless its file was changed by someone else since.
+        '''
+        if types in self._handlers:
+            conf, signature = self._handlers[types]
+            if types in self._dirty or self._signature(conf) == signature:
+                return conf
+            self.output.debug('RepoConfManager: %s changed on disk, '
+                're-reading it' % conf.path, 4)
+        conf = getattr(self.modules[types][0],
+            self.modules[types][1])(self.config, self.overlays)
+        self._handlers[types] = (conf, self._signature(conf))
+        return conf
+
+
+    def flush(self):
+        '''
+        Writes every config file changed since the last flush().
+
+        @return boolean: represents success or failure.
+        '''
+        conf_ok = True
+        for types in self.conf_types:
+            if types not in self._dirty:
+                continue
+            conf = self._handlers[types][0]
+            ok = conf.write()
+            self._dirty.discard(types)
+            if ok is False:
+                conf_ok = False
+                # re-read the file next time, it may be half written
+                del self._handlers[types]
+            else:
+                self._handlers[types] = (conf, self._signature(conf))
+        return conf_ok
+
+
+    def _change(self, action, overlays, write):
+        if not self.config['require_repoconfig']:
+            return True
+        for types in self.conf_types:
+            conf = self._handler(types)
+            for overlay in overlays:
+                getattr(conf, action)(overlay, write=False)
+            self._dirty.add(types)
+        if write:
+            return self.flush()
+        return True
+
+
+    def add(self, overlay, write=True):
         '''
         Adds overlay information to the specified config type(s).
 
         @param overlay: layman.overlay.Overlay instance.
+        @param write: boolean, False defers writing to flush().
         @return boolean: represents success or failure.
         '''
-        if self.config['require_repoconfig']:
-            for types in self.conf_types:
-                conf = getattr(self.modules[types][0],
-                    self.modules[types][1])(self.config, self.overlays)
-                conf_ok = conf.add(overlay)
-            return conf_ok
-        return True
+        return self._change('add', [overlay], write)
 
-    def delete(self, overlay):
+
+    def add_all(self, overlays, write=True):
+        '''
+        Adds several overlays to the specified config type(s),
+        writing each config file only once.
+
+        @param overlays: list of layman.overlay.Overlay instances.
+        @param write: boolean, False defers writing to flush().
+        @return boolean: represents success or failure.
+        '''
+        return self._change('add', overlays, write)
+
+
+    def delete(self, overlay, write=True):
         '''
         Deletes overlay information from the specified config type(s).
 
         @param overlay: layman.overlay.Overlay instance.
+        @param write: boolean, False defers writing to flush().
         @return boolean: represents success or failure.
         '''
-        if self.config['require_repoconfig']:
-            for types in self.conf_types:
-                conf = getattr(self.modules[types][0],
-                    self.modules[types][1])(self.config, self.overlays)
-                conf_ok = conf.delete(overlay)
-            return conf_ok
-        return True
+        return self._change('delete', [overlay], write)
 
 
-    def update(self, overlay):
+    def delete_all(self, overlays, write=True):
+        '''
+        Deletes several overlays from the specified config type(s),
+        writing each config file only once.
+
+        @param overlays: list of layman.overlay.Overlay instances.
+        @param write: boolean, False defers writing to flush().
+        @return boolean: represents success or failure.
+        '''
+        return self._change('delete', overlays, write)
+
+
+    def update(self, overlay, write=True):
         '''
         Updates the source URL for the specified config type(s).
-    
+
         @param overlay: layman.overlay.Overlay instance.
+        @param write: boolean, False defers writing to flush().
         @return boolean: represents success or failure.
         '''
-        if self.config['require_repoconfig']:
-            for types in self.conf_types:
-                conf = getattr(self.modules[types][0],
-                    self.modules[types][1])(self.config, self.overlays)
-                conf_ok = conf.update(overlay)
-            return conf_ok
-        return True
+        return self._change('update', [overlay], write)
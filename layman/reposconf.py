@@ -71,11 +71,12 @@ class ConfigHandler:
                 '%(path)s".\nFile not found.' % ({'path': self.path}))
 
 
-    def add(self, overlay):
+    def add(self, overlay, write=True):
         '''
         Adds overlay information to the specified config file.
 
         @param overlay: layman.overlay.Overlay instance.
+        @param write: boolean, False leaves writing the file to the caller.
         @return boolean: reflects a successful/failed write to the config file.
         '''
         self.repo_conf.add_section(overlay.name)
@@ -84,30 +85,38 @@ class ConfigHandler:
         self.repo_conf.set(overlay.name, 'sync-uri', overlay.sources[0].src)
         self.repo_conf.set(overlay.name, 'auto-sync', self.config['auto_sync'])
 
+        if not write:
+            return True
         return self.write()
 
 
-    def delete(self, overlay):
+    def delete(self, overlay, write=True):
         '''
         Deletes overlay information from the specified config file.
 
         @param overlay: layman.overlay.Overlay instance.
+        @param write: boolean, False leaves writing the file to the caller.
         @return boolean: reflects a successful/failed write to the config file.
         '''
         self.repo_conf.remove_section(overlay.name)
 
+        if not write:
+            return True
         return self.write()
 
 
-    def update(self, overlay):
+    def update(self, overlay, write=True):
         '''
         Updates the source URL for the specified config file.
 
         @param overlay: layman.overlay.Overlay instance.
+        @param write: boolean, False leaves writing the file to the caller.
         @return boolean: reflects a successful/failed write to the config file.
         '''
         self.repo_conf.set(overlay.name, 'sync-uri', overlay.sources[0].src)
 
+        if not write:
+            return True
         return self.write()
 
 
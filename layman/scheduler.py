@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SYNC SCHEDULER
+#################################################################################
+# File:       scheduler.py
+#
+#             Dispatches overlay syncs to a bounded pool of workers
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''Schedules overlay syncs across hosts and repository types.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import sys
+import threading
+
+from layman.utils import source_host
+
+#===============================================================================
+#
+# Class SyncScheduler
+#
+#-------------------------------------------------------------------------------
+
+class SyncScheduler(object):
+    '''
+    Runs jobs in a bounded pool of worker threads while capping
+    the number of jobs running at once against the same source
+    host and of the same repository type.
+
+    >>> from layman.config import OptionConfig
+    >>> config = OptionConfig({'sync_host_jobs': '1',
+    ...                        'sync_type_limits': 'rsync 1'})
+    >>> s = SyncScheduler(config, jobs=4)
+    >>> keys = {'a': ('github.com', 'git'), 'b': ('github.com', 'git'),
+    ...         'c': ('example.org', 'rsync'), 'd': ('', 'tar')}
+    >>> s.order(['a', 'b', 'c', 'd'], keys.get)
+    ['a', 'c', 'd', 'b']
+    >>> s.run(lambda x: x.upper(), ['a', 'b', 'c', 'd'], keys.get)
+    ['A', 'B', 'C', 'D']
+
+    Without a config nothing is capped but the number of workers:
+
+    >>> SyncScheduler(jobs=2).run(lambda x: x * 2, [1, 2, 3])
+    [2, 4, 6]
+    '''
+
+    def __init__(self, config=None, jobs=1):
+
+        self.config = config
+        self.jobs = jobs
+
+        if config is None:
+            self.output = None
+            self.host_jobs = 0
+            self.host_limits = {}
+            self.type_limits = {}
+        else:
+            self.output = config['output']
+            self.host_jobs = self._limit('sync_host_jobs',
+                config['sync_host_jobs'])
+            self.host_limits = self._read_limits('sync_host_limits')
+            self.type_limits = self._read_limits('sync_type_limits')
+
+        self._running = {}
+        self._cond = threading.Condition()
+
+
+    def _limit(self, option, value):
+        '''Converts a limit setting to an int, 0 meaning unlimited.'''
+        try:
+            return max(int(value or 0), 0)
+        except ValueError:
+            self.output.warn('Invalid %s setting "%s", ignoring it'
+                % (option, value), 2)
+            return 0
+
+
+    def _read_limits(self, option):
+        '''Reads "key limit" pairs, one per line, from the config.'''
+        limits = {}
+        value = self.config[option] or ''
+        for line in [i.strip() for i in value.split('\n') if len(i.strip())]:
+            try:
+                key, limit = line.split()
+            except ValueError:
+                self.output.warn('Invalid %s entry "%s", ignoring it'
+                    % (option, line), 2)
+                continue
+            limits[key.lower()] = self._limit(option, limit)
+        return limits
+
+
+    def host_limit(self, host):
+        '''Returns the cap for jobs against host, 0 meaning unlimited.'''
+        if not host:
+            # local sources never hit a server
+            return 0
+        return self.host_limits.get(host, self.host_jobs)
+
+
+    def type_limit(self, type_key):
+        '''Returns the cap for jobs of type_key, 0 meaning unlimited.'''
+        if not type_key:
+            return 0
+        return self.type_limits.get(type_key.lower(), 0)
+
+
+    def order(self, items, keyfunc):
+        '''
+        Interleaves items so consecutive jobs hit different hosts,
+        starting with the hosts that have the most work queued.
+        '''
+        groups = {}
+        hosts = []
+        for item in items:
+            host = keyfunc(item)[0]
+            if host not in groups:
+                groups[host] = []
+                hosts.append(host)
+            groups[host].append(item)
+        hosts.sort(key=lambda h: -len(groups[h]))
+
+        ordered = []
+        while hosts:
+            for host in hosts:
+                ordered.append(groups[host].pop(0))
+            hosts = [h for h in hosts if groups[h]]
+        return ordered
+
+
+    def _can_start(self, key):
+        host, type_key = key
+        for (kind, name), limit in ((('host', host), self.host_limit(host)),
+                (('type', type_key), self.type_limit(type_key))):
+            if limit and self._running.get((kind, name), 0) >= limit:
+                return False
+        return True
+
+
+    def _update_running(self, key, step):
+        host, type_key = key
+        for slot in (('host', host), ('type', type_key)):
+            self._running[slot] = self._running.get(slot, 0) + step
+
+
+    def run(self, func, items, keyfunc=None):
+        '''
+        Calls func for every item and returns the results in the order
+        of items.  keyfunc(item) must return a (host, type_key) tuple,
+        without it all items share one unlimited slot.
+        '''
+        items = list(items)
+        if keyfunc is None:
+            keyfunc = lambda item: ('', None)
+        jobs = min(self.jobs, len(items))
+
+        if jobs <= 1:
+            return [func(item) for item in items]
+
+        keys = [keyfunc(item) for item in items]
+        results = [None] * len(items)
+        pending = self.order(range(len(items)), lambda index: keys[index])
+        errors = []
+
+        def next_index():
+            with self._cond:
+                while pending:
+                    for position, index in enumerate(pending):
+                        if self._can_start(keys[index]):
+                            del pending[position]
+                            self._update_running(keys[index], 1)
+                            return index
+                    self._cond.wait()
+            return None
+
+        def worker():
+            while True:
+                index = next_index()
+                if index is None:
+                    return
+                if self.output:
+                    self.output.debug('SyncScheduler: starting %s, '
+                        'host/type = %s' % (items[index], str(keys[index])), 6)
+                try:
+                    results[index] = func(items[index])
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    with self._cond:
+                        self._update_running(keys[index], -1)
+                        self._cond.notify_all()
+
+        workers = [threading.Thread(target=worker) for i in range(jobs)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            # join() in a loop so a KeyboardInterrupt still reaches us
+            while thread.is_alive():
+                thread.join(0.2)
+
+        if errors:
+            raise errors[0]
+        return results
+
+
+def source_key(source):
+    '''Returns the (host, type_key) the scheduler groups jobs for an
+    overlay source by.'''
+    return (source_host(source.src), source.get_type_key())
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SYNC REPORT
+#################################################################################
+# File:       syncreport.py
+#
+#             Records how long the phases of an overlay sync took
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''Per overlay timing of sync runs, for finding slow overlays and mirrors.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import sys
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+from layman.compatibility import encode, fileopen
+from layman.version import VERSION
+
+# the most precise clock available, time.time() on python 2
+clock = getattr(time, 'perf_counter', time.time)
+
+# in the order they happen during a sync
+PHASES = ('remote_lookup', 'verify', 'vcs', 'postsync')
+
+# bump whenever the layout of the json report changes
+REPORT_FORMAT = 1
+
+_current = threading.local()
+
+#===============================================================================
+#
+# Class OverlayTiming
+#
+#-------------------------------------------------------------------------------
+
+class OverlayTiming(object):
+    '''
+    Collects the timing of one overlay's sync.  Time spent in a
+    phase nested into another only counts for the inner phase.
+
+    >>> a = OverlayTiming('wrobel')
+    >>> a.start()
+    >>> with a.phase('vcs'):
+    ...     with a.phase('postsync'):
+    ...         time.sleep(0.01)
+    >>> a.phases['postsync'] >= 0.01, a.phases['vcs'] < 0.01
+    (True, True)
+    >>> a.finish([('wrobel', 'ok')], [], [])
+    >>> a.to_dict()['status']
+    'success'
+    '''
+
+    def __init__(self, name, host=None, type_key=None):
+        self.name = name
+        self.host = host
+        self.type_key = type_key
+        self.phases = dict((phase, 0.0) for phase in PHASES)
+        self.exit_code = None
+        self.bytes = None
+        self.readd = False
+        self.status = None
+        # set by start(), the timing may be created long before
+        # the overlay's turn comes
+        self._started = None
+        self.duration = None
+        # [start, time spent in nested phases] of the open phases
+        self._open = []
+
+
+    def start(self):
+        '''Starts the clock, when the sync of the overlay begins.'''
+        self._started = clock()
+
+
+    @contextmanager
+    def phase(self, name):
+        '''Adds the time spent in the with block to phase name.'''
+        entry = [clock(), 0.0]
+        self._open.append(entry)
+        try:
+            yield
+        finally:
+            self._open.pop()
+            elapsed = clock() - entry[0]
+            self.phases[name] = self.phases.get(name, 0.0) + \
+                elapsed - entry[1]
+            if self._open:
+                self._open[-1][1] += elapsed
+
+
+    def add_bytes(self, count):
+        self.bytes = (self.bytes or 0) + count
+
+
+    def finish(self, success, warnings, fatals):
+        '''Stops the clock, the status follows from the results of
+        LaymanAPI._sync_repo().'''
+        if self._started is not None:
+            self.duration = clock() - self._started
+        if fatals:
+            self.status = 'failed'
+        elif warnings:
+            self.status = 'warning'
+        elif self.status is None:
+            # 'current' when there was nothing to sync
+            self.status = 'success'
+
+
+    def to_dict(self):
+        return {'overlay': self.name,
+            'host': self.host,
+            'type': self.type_key,
+            'status': self.status,
+            'duration': self.duration,
+            'phases': dict(self.phases),
+            'exit_code': self.exit_code,
+            'bytes': self.bytes,
+            'readd': self.readd,
+            }
+
+
+#===============================================================================
+#
+# Helper functions
+#
+#-------------------------------------------------------------------------------
+
+@contextmanager
+def recording(timing):
+    '''Makes timing the one phase() and friends report to in this
+    thread for the duration of a with block.'''
+    previous = getattr(_current, 'timing', None)
+    _current.timing = timing
+    try:
+        yield timing
+    finally:
+        _current.timing = previous
+
+
+def current():
+    '''Returns the OverlayTiming recorded to in this thread, or None.'''
+    return getattr(_current, 'timing', None)
+
+
+@contextmanager
+def phase(name):
+    '''Times a with block as phase name of the overlay currently
+    being synced in this thread, if any.'''
+    timing = current()
+    if timing is None:
+        yield
+    else:
+        with timing.phase(name):
+            yield
+
+
+def set_exit_code(code):
+    timing = current()
+    if timing is not None:
+        timing.exit_code = code
+
+
+def add_bytes(count):
+    timing = current()
+    if timing is not None:
+        timing.add_bytes(count)
+
+#===============================================================================
+#
+# Class SyncResults
+#
+#-------------------------------------------------------------------------------
+
+class SyncResults(tuple):
+    '''
+    The (success, warnings, fatals) lists of a LaymanAPI.sync() run,
+    with the timing of every overlay synced in the report attribute.
+
+    >>> a = SyncResults([('wrobel', 'ok')], [], [],
+    ...     [OverlayTiming('wrobel')])
+    >>> success, warnings, fatals = a
+    >>> success
+    [('wrobel', 'ok')]
+    >>> [overlay['overlay'] for overlay in a.report]
+    ['wrobel']
+    >>> sorted(a.to_json()['overlays'][0]['phases'])
+    ['postsync', 'remote_lookup', 'vcs', 'verify']
+    '''
+
+    def __new__(cls, success, warnings, fatals, timings=(), duration=None,
+            jobs=1):
+        results = tuple.__new__(cls, (success, warnings, fatals))
+        results.report = [timing.to_dict() for timing in timings]
+        results.duration = duration
+        results.jobs = jobs
+        results.finished = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        return results
+
+
+    def to_json(self):
+        '''Returns the report as a json serializable dict.'''
+        return {'format': REPORT_FORMAT,
+            'layman_version': VERSION,
+            'finished': self.finished,
+            'duration': self.duration,
+            'jobs': self.jobs,
+            'overlays': self.report,
+            }
+
+
+    def write_json(self, path):
+        '''Writes the report to a json file at path.'''
+        with fileopen(path, 'w') as report:
+            report.write(encode(json.dumps(self.to_json(), indent=1,
+                sort_keys=True)) + '\n')
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SYNC STATE
+#################################################################################
+# File:       syncstate.py
+#
+#             Keeps track of per overlay sync information
+#
+# Distributed under the terms of the GNU General Public License v2
+#
+'''Stores per overlay sync state in a json file beside installed.xml.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import threading
+
+from contextlib import contextmanager
+
+from layman.compatibility import encode, fileopen
+from layman.lock import STATE_LOCK, get_lock_manager
+
+#===============================================================================
+#
+# Class SyncState
+#
+#-------------------------------------------------------------------------------
+
+class SyncState(object):
+    '''
+    Per overlay key/value store for information that changes on
+    every sync (last synced revision, download validators, ...)
+    and does not belong into installed.xml.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+    >>> from layman.output import Message
+    >>> config = {'output': Message(),
+    ...           'sync_state': os.path.join(tmpdir, 'sync-state.json')}
+    >>> a = SyncState(config)
+    >>> a.get('wrobel', 'revision') is None
+    True
+    >>> a.set('wrobel', 'revision', 'abc')
+    >>> a.write()
+    True
+    >>> b = SyncState(config)
+    >>> b.get('wrobel', 'revision')
+    'abc'
+    >>> b.forget('wrobel')
+    >>> b.get('wrobel', 'revision', 'none')
+    'none'
+
+    Inside batch() write() only saves once the block ends:
+
+    >>> with b.batch():
+    ...     b.set('wrobel', 'revision', 'def')
+    ...     b.write()
+    ...     SyncState(config).get('wrobel', 'revision')
+    True
+    'abc'
+    >>> SyncState(config).get('wrobel', 'revision')
+    'def'
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    '''
+
+    def __init__(self, config):
+
+        self.output = config['output']
+        try:
+            self.path = config['sync_state']
+        except KeyError:
+            self.path = None
+
+        self._data = None
+        # names changed since the last write()
+        self._changed = set()
+        # open batch() blocks
+        self._batches = 0
+        self._lock = threading.RLock()
+        self.locks = get_lock_manager(config)
+
+
+    def _read(self):
+        '''Returns the state stored on disk.'''
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with fileopen(self.path, 'r') as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError) as error:
+            self.output.warn('Ignoring unreadable sync state file "%s".'
+                '\nError was: %s' % (self.path, str(error)), 2)
+        return {}
+
+
+    def _load(self):
+        if self._data is None:
+            self._data = self._read()
+        return self._data
+
+
+    def get(self, name, key, default=None):
+        '''Returns the value recorded for overlay name.'''
+        with self._lock:
+            return self._load().get(name, {}).get(key, default)
+
+
+    def set(self, name, key, value):
+        '''Records value for overlay name.  Call write() to save it.'''
+        with self._lock:
+            self._load().setdefault(name, {})[key] = value
+            self._changed.add(name)
+
+
+    def forget(self, name, key=None):
+        '''Drops everything (or only key) recorded for overlay name.'''
+        with self._lock:
+            data = self._load()
+            if key is None:
+                data.pop(name, None)
+            elif name in data:
+                data[name].pop(key, None)
+            self._changed.add(name)
+
+
+    @contextmanager
+    def batch(self):
+        '''Defers every write() in the with block to one at its end.'''
+        with self._lock:
+            self._batches += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batches -= 1
+                pending = not self._batches and self._changed
+            if pending:
+                self.write()
+
+
+    def write(self):
+        '''
+        Saves the state, replacing the old file in one step.  Overlays
+        not changed here keep what other layman processes recorded
+        for them in the meantime.
+        '''
+        if not self.path:
+            return False
+        with self._lock:
+            if self._batches:
+                # batch() writes when it ends
+                return True
+            with self.locks.lock(STATE_LOCK):
+                data = self._load()
+                merged = self._read()
+                for name in self._changed:
+                    if name in data:
+                        merged[name] = data[name]
+                    else:
+                        merged.pop(name, None)
+                temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+                try:
+                    with fileopen(temp_path, 'w') as state_file:
+                        state_file.write(encode(json.dumps(merged, indent=1,
+                            sort_keys=True)))
+                    os.rename(temp_path, self.path)
+                except (IOError, OSError) as error:
+                    self.output.warn('Failed to write the sync state file '
+                        '"%s".\nError was: %s' % (self.path, str(error)), 2)
+                    return False
+                self._data = merged
+                self._changed = set()
+        return True
+
+
+_STATES = {}
+_STATES_LOCK = threading.Lock()
+
+def get_sync_state(config):
+    '''Returns the SyncState shared by everything using the
+    same state file as config.'''
+    try:
+        key = config['sync_state']
+    except KeyError:
+        key = None
+    with _STATES_LOCK:
+        if key not in _STATES:
+            _STATES[key] = SyncState(config)
+        return _STATES[key]
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -55,8 +55,15 @@ import layman.cli                #CT
 import layman.config             #CT
 import layman.db                 #CT
 import layman.dbbase             #CT
+import layman.remotedb           #CT
+import layman.scheduler          #CT
+import layman.syncstate          #CT
+import layman.syncreport         #CT
+import layman.metrics            #CT
+import layman.lock               #CT
 import layman.utils              #CT
 import layman.overlays.overlay   #CT
+import layman.overlays.source    #CT
 import layman.overlays.tar       #CT
 
 #===============================================================================
@@ -72,8 +79,15 @@ def test_suite():
         doctest.DocTestSuite(layman.argsparser),
         doctest.DocTestSuite(layman.db),
         doctest.DocTestSuite(layman.dbbase),
+        doctest.DocTestSuite(layman.remotedb),
+        doctest.DocTestSuite(layman.scheduler),
+        doctest.DocTestSuite(layman.syncstate),
+        doctest.DocTestSuite(layman.syncreport),
+        doctest.DocTestSuite(layman.metrics),
+        doctest.DocTestSuite(layman.lock),
         doctest.DocTestSuite(layman.utils),
         doctest.DocTestSuite(layman.overlays.overlay),
+        doctest.DocTestSuite(layman.overlays.source),
         doctest.DocTestSuite(layman.overlays.tar),
         ))
 
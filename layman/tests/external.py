@@ -16,7 +16,11 @@
 '''Runs external (non-doctest) test cases.'''
 
 import os
+import sys
+import json
 import shutil
+import subprocess
+import tarfile
 import tempfile
 import unittest
 #Py3
@@ -112,6 +116,9 @@ class TarAddRemoveSync(unittest.TestCase):
         # Make DB from it
         #config = {'output': Message(), 'tar_command':'/bin/tar'}
         config = BareConfig()
+        config.set_option('lock_dir', os.path.join(temp_dir_path, '.locks'))
+        config.set_option('sync_state',
+            os.path.join(temp_dir_path, 'sync-state.json'))
         db = DbBase(config, [temp_collection_path])
 
         specific_overlay_path = os.path.join(temp_dir_path, repo_name)
@@ -138,6 +145,926 @@ class TarAddRemoveSync(unittest.TestCase):
         os.rmdir(temp_dir_path)
 
 
+class GitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = BareConfig()
+        if not os.path.exists(self.config['git_command']):
+            self.skipTest('git is not installed')
+        self.config.set_option('quiet', True)
+        self.temp_dir_path = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.temp_dir_path, 'upstream')
+        self._git('init', '-q', self.upstream)
+        self._commit('one')
+        self._commit('two')
+
+        xml_text = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<repositories xmlns="" version="1.0">
+  <repo quality="experimental" status="unofficial">
+    <name>git-test-overlay</name>
+    <description>XXXXXXXXXXX</description>
+    <owner>
+      <email>foo@exmaple.org</email>
+    </owner>
+    <source type="git">file://%s</source>
+  </repo>
+</repositories>
+""" % self.upstream
+        collection_path = os.path.join(self.temp_dir_path, 'repositories.xml')
+        with open(collection_path, 'w') as f:
+            f.write(xml_text)
+
+        self.storage = os.path.join(self.temp_dir_path, 'storage')
+        os.mkdir(self.storage)
+        self.db = DbBase(self.config, [collection_path])
+        self.checkout = os.path.join(self.storage, 'git-test-overlay')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir_path)
+
+    def _git(self, *args):
+        subprocess.check_call(['git', '-c', 'user.name=layman',
+            '-c', 'user.email=layman@localhost'] + list(args))
+
+    def _commit(self, name):
+        with open(os.path.join(self.upstream, name), 'w') as f:
+            f.write(name)
+        self._git('-C', self.upstream, 'add', name)
+        self._git('-C', self.upstream, 'commit', '-q', '-m', name)
+
+    def _depth(self, path):
+        return int(subprocess.check_output(['git', '-C', path,
+            'rev-list', '--count', 'HEAD']).decode().strip())
+
+
+class GitShallowAddSync(GitTestCase):
+    def test(self):
+        self.config.set_option('git_clone_mode', 'shallow')
+        o = self.db.select('git-test-overlay')
+
+        # Shallow clone only has the latest commit
+        self.assertEqual(o.add(self.storage), 0)
+        self.assertEqual(self._depth(self.checkout), 1)
+        self.assertEqual(o.sources[0].recorded_mode(self.checkout),
+            'shallow')
+
+        # Shallow sync picks up the new commit without its history
+        self._commit('three')
+        self.assertEqual(o.sync(self.storage), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.checkout, 'three')))
+        self.assertEqual(self._depth(self.checkout), 1)
+
+        # Switching back to full mode completes the history
+        self.config.set_option('git_clone_mode', 'full')
+        self.assertEqual(o.sync(self.storage), 0)
+        self.assertEqual(self._depth(self.checkout), 3)
+        self.assertEqual(o.sources[0].recorded_mode(self.checkout), 'full')
+
+
+class GitSharedObjects(GitTestCase):
+    def test(self):
+        self.config.set_option('git_shared_objects', 'yes')
+        o = self.db.select('git-test-overlay')
+        alternates = os.path.join(self.checkout, '.git', 'objects', 'info',
+            'alternates')
+
+        self.assertEqual(o.add(self.storage), 0)
+        self.assertTrue(os.path.exists(alternates))
+
+        def refs():
+            return subprocess.check_output(['git', '--git-dir',
+                os.path.join(self.storage, '.git-objects'), 'for-each-ref',
+                '--format=%(refname)', 'refs/layman/git-test-overlay/'
+                ]).decode().split()
+
+        # Deleting the overlay drops its refs from the cache
+        self.assertTrue(refs())
+        o.delete(self.storage)
+        self.assertEqual(refs(), [])
+
+        self.assertEqual(o.add(self.storage), 0)
+        self.assertTrue(os.path.exists(alternates))
+        self.assertEqual(self._depth(self.checkout), 2)
+
+class RepoConfCache(unittest.TestCase):
+    class FakeOverlay(object):
+        class FakeSource(object):
+            src = 'https://example.org/overlay.git'
+        def __init__(self, name):
+            self.name = name
+            self.priority = 50
+            self.sources = [self.FakeSource()]
+
+    def test(self):
+        from layman.repoconfmanager import RepoConfManager
+        temp_dir_path = tempfile.mkdtemp()
+        repos_conf = os.path.join(temp_dir_path, 'layman.conf')
+        open(repos_conf, 'w').close()
+        config = BareConfig(read_configfile=False)
+        config.set_option('conf_type', 'repos.conf')
+        config.set_option('repos_conf', repos_conf)
+        config.set_option('storage', temp_dir_path)
+        manager = RepoConfManager(config, {})
+
+        def sections():
+            with open(repos_conf) as f:
+                return [line.strip() for line in f if line.startswith('[')]
+
+        # Deferred changes only hit the disk on flush()
+        manager.add(self.FakeOverlay('one'), write=False)
+        manager.add(self.FakeOverlay('two'), write=False)
+        self.assertEqual(sections(), [])
+        self.assertTrue(manager.flush())
+        self.assertEqual(sections(), ['[one]', '[two]'])
+
+        # The handler is reused while the file is unchanged ...
+        handler = manager._handler('repos.conf')
+        manager.delete(self.FakeOverlay('two'))
+        self.assertTrue(manager._handler('repos.conf') is handler)
+        self.assertEqual(sections(), ['[one]'])
+
+        # ... and re-read once somebody else edited it
+        with open(repos_conf, 'a') as f:
+            f.write('[manual]\nlocation = /usr/local/manual\n')
+        self.assertTrue(manager.add(self.FakeOverlay('three')))
+        self.assertFalse(manager._handler('repos.conf') is handler)
+        self.assertEqual(sections(), ['[one]', '[manual]', '[three]'])
+
+        shutil.rmtree(temp_dir_path)
+
+
+class IncrementalWrite(unittest.TestCase):
+    def test(self):
+        temp_dir_path = tempfile.mkdtemp()
+        write = os.path.join(temp_dir_path, 'installed.xml')
+        config = BareConfig()
+        db = DbBase(config, [os.path.join(HERE, 'testfiles',
+            'global-overlays.xml')])
+
+        db.write(write)
+        self.assertEqual(os.listdir(temp_dir_path), ['installed.xml'])
+        fragments = dict(db._fragments)
+
+        # Only the overlay stored again is serialized again
+        wrobel = db.overlays['wrobel']
+        wrobel.priority = 7
+        db.overlays['wrobel'] = wrobel
+        db.write(write)
+        self.assertTrue(db._fragments['wrobel-stable']
+            is fragments['wrobel-stable'])
+        self.assertFalse(db._fragments['wrobel'] is fragments['wrobel'])
+
+        other = DbBase(config, [write])
+        self.assertEqual(sorted(other.overlays.keys()),
+            ['wrobel', 'wrobel-stable'])
+        self.assertEqual(other.select('wrobel').priority, 7)
+
+        # Overlays loaded from the compiled copy are written without
+        # ever being created
+        db.write_compiled(write, list(db.overlays))
+        other = DbBase(config, [write])
+        other.overlays['wrobel'] = other.overlays['wrobel']
+        # Replacing the file keeps its permissions
+        os.chmod(write, 0o640)
+        other.write(write)
+        self.assertFalse(other.overlays.is_loaded('wrobel-stable'))
+        self.assertEqual(os.stat(write).st_mode & 0o777, 0o640)
+        with open(write) as f:
+            text = f.read()
+        self.assertTrue(fragments['wrobel-stable'] in text)
+
+        del other.overlays['wrobel']
+        other.write(write)
+        self.assertEqual(list(other._fragments), ['wrobel-stable'])
+        self.assertEqual(list(DbBase(config, [write]).overlays.keys()),
+            ['wrobel-stable'])
+
+        shutil.rmtree(temp_dir_path)
+
+
+class TarTestCase(unittest.TestCase):
+    '''
+    Runs in a temp dir holding the layman storage, the lock, state and
+    cache files and a remote list of tar overlays.
+    '''
+    def setUp(self):
+        self.temp_dir_path = tempfile.mkdtemp()
+        self.storage = os.path.join(self.temp_dir_path, 'storage')
+        os.mkdir(self.storage)
+        self.catalog = os.path.join(self.temp_dir_path, 'catalog.xml')
+        self.repos_conf = os.path.join(self.temp_dir_path, 'layman.conf')
+        open(self.repos_conf, 'w').close()
+
+        self.config = BareConfig(read_configfile=False)
+        self.config.set_option('quiet', True)
+        self.config.set_option('storage', self.storage)
+        self.config.set_option('installed',
+            os.path.join(self.storage, 'installed.xml'))
+        self.config.set_option('overlays', ['file://' + self.catalog])
+        for key, name in (('cache', 'cache'), ('lock_dir', '.locks'),
+                ('sync_state', 'sync-state.json'),
+                ('metrics_state', 'metrics.json')):
+            self.config.set_option(key,
+                os.path.join(self.temp_dir_path, name))
+        self.config.set_option('conf_type', 'repos.conf')
+        self.config.set_option('repos_conf', self.repos_conf)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir_path)
+
+    def _pack(self, name, files):
+        '''Packs files, a dict of member name: text, into the tar
+        package name in the temp dir and returns its path.'''
+        tarball = os.path.join(self.temp_dir_path, name)
+        payload = os.path.join(self.temp_dir_path, 'payload')
+        archive = tarfile.open(tarball, 'w:bz2')
+        for member, text in sorted(files.items()):
+            with open(payload, 'w') as f:
+                f.write(text)
+            archive.add(payload, member)
+        archive.close()
+        os.unlink(payload)
+        return tarball
+
+    def _catalog(self, sources):
+        '''Writes the remote list with a tar overlay for each name:
+        source in sources, a source may be the path of a package.'''
+        repos = ''
+        for name, source in sorted(sources.items()):
+            if '://' not in source:
+                source = 'file://' + urllib.pathname2url(source)
+            repos += """\
+  <repo quality="experimental" status="unofficial">
+    <name>%s</name>
+    <description>Test</description>
+    <owner><email>foo@example.org</email></owner>
+    <source type="tar">%s</source>
+  </repo>
+""" % (name, source)
+        with open(self.catalog, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<repositories xmlns="" version="1.0">\n%s</repositories>\n'
+                % repos)
+
+    def _overlay(self, name):
+        '''Returns overlay name from the remote list, given a sync
+        state like the DB does before checking it out.'''
+        from layman.syncstate import SyncState
+        overlay = DbBase(self.config, [self.catalog]).select(name)
+        overlay.state = SyncState(self.config)
+        return overlay
+
+    def _repos_conf(self):
+        '''Returns the sections of repos.conf and their locations.'''
+        try:
+            from configparser import ConfigParser
+        except ImportError:
+            from ConfigParser import ConfigParser
+        parser = ConfigParser()
+        parser.read(self.repos_conf)
+        return dict((name, parser.get(name, 'location'))
+            for name in parser.sections())
+
+    def _api(self):
+        '''Returns a LaymanAPI that fetched the remote list.'''
+        from layman.api import LaymanAPI
+        api = LaymanAPI(self.config)
+        self.assertTrue(api.fetch_remote_list())
+        return api
+
+
+class ConcurrentDB(TarTestCase):
+    # one layman process adding or deleting one overlay; it reads the
+    # installed db, then waits for the go file so all start together
+    WRITER = """
+import json, os, sys, time
+from layman.config import BareConfig
+from layman.db import DB
+from layman.dbbase import DbBase
+options, catalog, action, name, go = sys.argv[1:]
+config = BareConfig(read_configfile=False)
+for key, value in json.loads(options).items():
+    config.set_option(key, value)
+db = DB(config)
+while not os.path.exists(go):
+    time.sleep(0.01)
+if action == 'add':
+    sys.exit(not db.add(DbBase(config, [catalog]).select(name)))
+sys.exit(not db.delete(db.select(name)))
+"""
+
+    def _run_writers(self, action, names):
+        """Runs one writer process per name at the same time."""
+        options = json.dumps(dict((key, self.config[key]) for key in
+            ('storage', 'installed', 'lock_dir', 'sync_state', 'cache',
+             'conf_type', 'repos_conf', 'quiet')))
+        go = os.path.join(self.temp_dir_path, 'go')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(
+            os.path.dirname(HERE))] + [p for p in
+            env.get('PYTHONPATH', '').split(os.pathsep) if p])
+        writers = [subprocess.Popen([sys.executable, '-c', self.WRITER,
+            options, self.catalog, action, name, go], env=env)
+            for name in names]
+        open(go, 'w').close()
+        codes = [writer.wait() for writer in writers]
+        os.unlink(go)
+        return codes
+
+    def test(self):
+        from layman.db import DB
+        from layman.lock import get_lock_manager
+        from layman.syncstate import SyncState
+        tarball = os.path.join(HERE, 'testfiles', 'layman-test.tar.bz2')
+        names = ['one', 'two', 'three', 'four']
+        self._catalog(dict((name, tarball) for name in names))
+
+        # Processes started at the same time, each committing on top of
+        # what it read before the others wrote; none may drop what
+        # another one added
+        self.assertEqual(self._run_writers('add', names), [0] * 4)
+        self.assertEqual(sorted(DB(self.config).overlays.keys()),
+            sorted(names))
+        self.assertEqual(self._repos_conf(), dict((name,
+            os.path.join(self.storage, name)) for name in names))
+
+        # nor bring back what another one deleted
+        self.assertEqual(self._run_writers('delete', ['one', 'three']),
+            [0] * 2)
+        self.assertEqual(sorted(DB(self.config).overlays.keys()),
+            ['four', 'two'])
+        self.assertEqual(sorted(self._repos_conf()), ['four', 'two'])
+        self.assertEqual(sorted(os.listdir(self.storage)),
+            ['four', 'installed.pickle', 'installed.xml', 'two'])
+        self.assertTrue(os.path.exists(os.path.join(self.config['lock_dir'],
+            'installed.lock')))
+
+        # The same goes for the sync state
+        a, b = SyncState(self.config), SyncState(self.config)
+        a.set('one', 'revision', '1')
+        b.set('two', 'revision', '2')
+        self.assertTrue(a.write() and b.write())
+        self.assertEqual(SyncState(self.config).get('one', 'revision'), '1')
+
+        # A lock held exclusive keeps out other threads until released
+        import threading
+        locks = get_lock_manager(self.config)
+        events = []
+        def other():
+            with locks.lock('installed', shared=True):
+                events.append('other')
+        with locks.lock('installed'):
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join(0.5)
+            events.append('owner')
+        thread.join()
+        self.assertEqual(events, ['owner', 'other'])
+
+
+class DeleteMany(TarTestCase):
+    def test(self):
+        from layman.db import DB
+        tarball = os.path.join(HERE, 'testfiles', 'layman-test.tar.bz2')
+        names = ['one', 'two', 'three', 'four']
+        self._catalog(dict((name, tarball) for name in names))
+        remote = DbBase(self.config, [self.catalog])
+        db = DB(self.config)
+        self.assertEqual(db.add_many([remote.select(name)
+            for name in names], jobs=2), [True] * 4)
+
+        writes = []
+        write = db.write
+        def counting_write(path):
+            writes.append(path)
+            return write(path)
+        db.write = counting_write
+
+        self.config.set_option('delete_jobs', '3')
+        self.assertEqual(db.delete_many([db.select(name)
+            for name in ('one', 'two', 'four')]), [True] * 3)
+        # The checkouts are gone, the lists written once for all
+        self.assertEqual(sorted(os.listdir(self.storage)),
+            ['installed.pickle', 'installed.xml', 'three'])
+        self.assertEqual(writes, [self.config['installed']])
+        self.assertEqual(sorted(DB(self.config).overlays.keys()), ['three'])
+        self.assertEqual(self._repos_conf(),
+            {'three': os.path.join(self.storage, 'three')})
+
+
+class TarNativeExtract(TarTestCase):
+    def _tree(self, top):
+        return sorted(os.path.relpath(os.path.join(root, name), top)
+            for root, dirs, files in os.walk(top) for name in dirs + files)
+
+    def test(self):
+        tarball = os.path.join(HERE, 'testfiles', 'layman-test.tar.bz2')
+        self._catalog({'tar-test': tarball})
+
+        # Same result as running tar
+        trees = []
+        for native in (True, False):
+            self.config.set_option('tar_native', native)
+            base = os.path.join(self.temp_dir_path, str(native))
+            os.mkdir(base)
+            self.assertEqual(self._overlay('tar-test').add(base), 0)
+            trees.append(self._tree(os.path.join(base, 'tar-test')))
+        self.assertEqual(trees[0], trees[1])
+        self.assertTrue('layman-test/app-admin/layman/layman-0.8.ebuild'
+            in trees[0])
+
+        # Members escaping the overlay directory are left out
+        self.config.set_option('tar_native', True)
+        evil = os.path.join(self.temp_dir_path, 'evil.tar.gz')
+        payload = os.path.join(self.temp_dir_path, 'payload')
+        with open(payload, 'w') as f:
+            f.write('x')
+        archive = tarfile.open(evil, 'w:gz')
+        archive.add(payload, 'good/file')
+        archive.add(payload, '../escaped')
+        link = tarfile.TarInfo('good/link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = '/etc/passwd'
+        archive.addfile(link)
+        archive.close()
+        self._catalog({'tar-test': evil})
+        base = os.path.join(self.temp_dir_path, 'evil')
+        os.mkdir(base)
+        self.assertEqual(self._overlay('tar-test').add(base), 0)
+        self.assertEqual(self._tree(os.path.join(base, 'tar-test')),
+            ['good', 'good/file'])
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir_path,
+            'escaped')))
+
+
+class TarUnchangedSync(TarTestCase):
+    def test(self):
+        files = {'cat/a/a-1.ebuild': 'a', 'cat/b/b-1.ebuild': 'b',
+            'cat/c/c-1.ebuild': 'c'}
+        self._catalog({'tar-test': self._pack('overlay.tar.bz2', files)})
+        overlay = self._overlay('tar-test')
+        target = os.path.join(self.storage, 'tar-test')
+
+        def inode(name):
+            return os.stat(os.path.join(target, name)).st_ino
+
+        self.assertEqual(overlay.add(self.storage), 0)
+        inodes = dict((i, inode(i)) for i in
+            ('cat/a/a-1.ebuild', 'cat/b/b-1.ebuild'))
+
+        # An unchanged package is not extracted again
+        self.assertEqual(overlay.sync(self.storage), 0)
+        self.assertEqual(os.listdir(self.storage), ['tar-test'])
+        self.assertEqual(inode('cat/a/a-1.ebuild'), inodes['cat/a/a-1.ebuild'])
+
+        # Otherwise only what differs is replaced
+        self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'a',
+            'cat/b/b-1.ebuild': 'B', 'cat/d/d-1.ebuild': 'd'})
+        self.assertEqual(overlay.sync(self.storage), 0)
+        self.assertEqual(inode('cat/a/a-1.ebuild'), inodes['cat/a/a-1.ebuild'])
+        self.assertNotEqual(inode('cat/b/b-1.ebuild'),
+            inodes['cat/b/b-1.ebuild'])
+        with open(os.path.join(target, 'cat/b/b-1.ebuild')) as f:
+            self.assertEqual(f.read(), 'B')
+        self.assertEqual(sorted(os.listdir(os.path.join(target, 'cat'))),
+            ['a', 'b', 'd'])
+
+
+class SvnUpgradeCheck(unittest.TestCase):
+    def test(self):
+        import sqlite3
+        from layman.overlays.overlay import Overlay
+        from layman.syncstate import SyncState
+        temp_dir_path = tempfile.mkdtemp()
+        # stands in for svn, logs its arguments and "upgrades" to 31
+        log = os.path.join(temp_dir_path, 'svn.log')
+        fake_svn = os.path.join(temp_dir_path, 'svn')
+        with open(fake_svn, 'w') as f:
+            f.write('#!/bin/sh\necho "$1" >> %s\n'
+                '%s -c "import sqlite3; sqlite3.connect(\'$2/.svn/wc.db\')'
+                '.execute(\'PRAGMA user_version = 31\')"\n'
+                % (log, sys.executable))
+        os.chmod(fake_svn, 0o755)
+
+        config = BareConfig()
+        config.set_option('svn_command', fake_svn)
+        config.set_option('lock_dir', os.path.join(temp_dir_path, '.locks'))
+        config.set_option('sync_state',
+            os.path.join(temp_dir_path, 'sync-state.json'))
+        overlay = Overlay(config, ovl_dict={'name': 'svn-test',
+            'description': 'Test', 'owner_email': 'foo@example.org',
+            'sources': [('https://svn.example.org/svn-test', 'svn', None)]})
+        # stands in for the DB that would drive the syncs
+        overlay.state = SyncState(config)
+        source = overlay.sources[0]
+        target = os.path.join(temp_dir_path, 'svn-test')
+        os.makedirs(os.path.join(target, '.svn'))
+
+        def upgrades():
+            if not os.path.exists(log):
+                return 0
+            with open(log) as f:
+                return f.read().split().count('upgrade')
+
+        connection = sqlite3.connect(os.path.join(target, '.svn', 'wc.db'))
+        connection.execute('PRAGMA user_version = 29')
+        connection.close()
+        self.assertEqual(source.wc_format(target), 29)
+
+        # Upgraded once, then the recorded format is trusted
+        source.check_upgrade(target)
+        self.assertEqual(source.wc_format(target), 31)
+        source.check_upgrade(target)
+        source.check_upgrade(target)
+        self.assertEqual(upgrades(), 1)
+
+        # A working copy of another format is checked again
+        connection = sqlite3.connect(os.path.join(target, '.svn', 'wc.db'))
+        connection.execute('PRAGMA user_version = 30')
+        connection.close()
+        source.check_upgrade(target)
+        self.assertEqual(upgrades(), 2)
+
+        shutil.rmtree(temp_dir_path)
+
+
+class LocalQueries(unittest.TestCase):
+    def test(self):
+        from layman.api import LaymanAPI
+        from layman.db import DB
+        temp_dir_path = tempfile.mkdtemp()
+        installed = os.path.join(temp_dir_path, 'installed.xml')
+        shutil.copy(os.path.join(HERE, 'testfiles', 'global-overlays.xml'),
+            installed)
+
+        config = BareConfig(read_configfile=False)
+        config.set_option('storage', temp_dir_path)
+        config.set_option('installed', installed)
+        config.set_option('cache', os.path.join(temp_dir_path, 'cache'))
+        config.set_option('lock_dir', os.path.join(temp_dir_path, '.locks'))
+        config.set_option('sync_state',
+            os.path.join(temp_dir_path, 'sync-state.json'))
+
+        # Reading installed.xml leaves a pre-parsed index behind
+        DB(config)
+        self.assertTrue(os.path.exists(DB.compiled_path(installed)))
+
+        api = LaymanAPI(config)
+        self.assertEqual(sorted(api.get_installed()),
+            ['wrobel', 'wrobel-stable'])
+        info = api.get_info_str(['wrobel', 'missing'], local=True)
+        self.assertTrue(info['wrobel'][0])
+        self.assertEqual(info['missing'], ('', False, False))
+        self.assertEqual(sorted(api.get_all_info('wrobel-stable',
+            local=True)), ['wrobel-stable'])
+        self.assertEqual(len(api.get_info_list(local=True)), 2)
+        # The remote lists were never loaded
+        self.assertTrue(api._available_db is None)
+
+        shutil.rmtree(temp_dir_path)
+
+
+class SyncReport(TarTestCase):
+    def test(self):
+        import json
+        tarball = self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'a'})
+        self._catalog({'tar-test': tarball})
+        self.config.set_option('tar_postsync', sys.executable + ' -c pass')
+        api = self._api()
+        self.assertTrue(api.add_repos('tar-test'))
+        self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'b'})
+
+        self.assertTrue(api.sync('tar-test', output_results=False))
+        # Still unpacks like the plain tuple it used to be
+        success, warnings, fatals = api.sync_results
+        self.assertEqual([ovl for ovl, message in success], ['tar-test'])
+        self.assertEqual(len(api.sync_results.report), 1)
+        report = api.sync_results.report[0]
+        self.assertEqual((report['overlay'], report['status'],
+            report['exit_code'], report['readd']),
+            ('tar-test', 'success', 0, False))
+        self.assertEqual(report['bytes'], os.path.getsize(tarball))
+        self.assertEqual(sorted(report['phases']),
+            ['postsync', 'remote_lookup', 'vcs', 'verify'])
+        self.assertTrue(report['phases']['postsync'] > 0)
+        self.assertTrue(report['duration'] >= sum(report['phases'].values()))
+
+        path = os.path.join(self.temp_dir_path, 'report.json')
+        api.sync_results.write_json(path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)['overlays'], [report])
+
+
+class MetricsTextfile(TarTestCase):
+    def test(self):
+        tarball = self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'a'})
+        self._catalog({'tar-test': tarball})
+        textfile = os.path.join(self.temp_dir_path, 'layman.prom')
+        self.config.set_option('metrics_textfile', textfile)
+        api = self._api()
+        with open(textfile) as f:
+            lines = f.read().splitlines()
+        url = 'file://' + self.catalog
+        self.assertTrue('layman_catalog_entries{url="%s"} 1' % url in lines)
+        self.assertTrue('layman_catalog_size_bytes{url="%s"} %d'
+            % (url, os.path.getsize(self.catalog)) in lines)
+        self.assertTrue([line for line in lines if line.startswith(
+            'layman_catalog_fetch_duration_seconds{url="%s"} ' % url)])
+
+        self.assertTrue(api.add_repos('tar-test'))
+        self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'b'})
+        self.assertTrue(api.sync('tar-test', output_results=False))
+        os.unlink(tarball)
+        self.assertFalse(api.sync('tar-test', output_results=False))
+
+        with open(textfile) as f:
+            lines = f.read().splitlines()
+        label = '{overlay="tar-test"}'
+        self.assertTrue('layman_overlay_sync_failures_total%s 1' % label
+            in lines)
+        self.assertTrue('layman_overlay_sync_duration_seconds_count%s 2'
+            % label in lines)
+        self.assertTrue('# TYPE layman_overlay_sync_duration_seconds '
+            'histogram' in lines)
+        successes = [line for line in lines if line.startswith(
+            'layman_overlay_last_success_timestamp_seconds' + label)]
+        syncs = [line for line in lines if line.startswith(
+            'layman_overlay_last_sync_timestamp_seconds' + label)]
+        self.assertTrue(float(successes[0].split()[1]) <=
+            float(syncs[0].split()[1]))
+        # the catalog survives a sync untouched
+        self.assertTrue('layman_catalog_entries{url="%s"} 1' % url in lines)
+        self.assertFalse(os.path.exists(textfile + '.%d.tmp' % os.getpid()))
+
+
+class ProbeSkipsPostsync(TarTestCase):
+    def test(self):
+        tarball = self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'a'})
+        self._catalog({'tar-test': tarball})
+        # the hook leaves one line in calls per run
+        calls = os.path.join(self.temp_dir_path, 'calls')
+        hook = os.path.join(self.temp_dir_path, 'hook.py')
+        with open(hook, 'w') as f:
+            f.write('open(%r, "a").write("x\\n")\n' % calls)
+        self.config.set_option('tar_postsync', sys.executable + ' ' + hook)
+        api = self._api()
+        self.assertTrue(api.add_repos('tar-test'))
+
+        def hook_runs():
+            with open(calls) as f:
+                return len(f.readlines())
+
+        # The package did not change since it was added, neither the
+        # sync nor the hook run
+        runs = hook_runs()
+        self.assertTrue(api.sync('tar-test', output_results=False))
+        self.assertEqual(api.sync_results.report[0]['status'], 'current')
+        self.assertEqual(hook_runs(), runs)
+
+        self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'b'})
+        self.assertTrue(api.sync('tar-test', output_results=False))
+        self.assertEqual(api.sync_results.report[0]['status'], 'success')
+        self.assertEqual(hook_runs(), runs + 1)
+        self.assertTrue(api.sync('tar-test', output_results=False))
+        self.assertEqual(api.sync_results.report[0]['status'], 'current')
+        self.assertEqual(hook_runs(), runs + 1)
+
+
+class TarProbeValidators(TarTestCase):
+    def test(self):
+        import threading
+        try:
+            from http.server import HTTPServer, SimpleHTTPRequestHandler
+        except ImportError:
+            from BaseHTTPServer import HTTPServer
+            from SimpleHTTPServer import SimpleHTTPRequestHandler
+        tarball = self._pack('overlay.tar.bz2', {'cat/a/a-1.ebuild': 'a'})
+        os.utime(tarball, (1000000000, 1000000000))
+
+        temp_dir_path = self.temp_dir_path
+        requests = []
+        class Handler(SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(temp_dir_path, os.path.basename(path))
+            def log_request(self, code='-', size='-'):
+                requests.append((self.command, str(code)))
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self._catalog({'tar-test': 'http://127.0.0.1:%d/overlay.tar.bz2'
+            % server.server_port})
+        overlay = self._overlay('tar-test')
+        try:
+            self.assertEqual(overlay.add(self.storage), 0)
+            recorded = overlay.state.get('tar-test', 'tar')
+            self.assertTrue(recorded['last_modified'])
+
+            # The probe asks with the validators of the extracted package
+            del requests[:]
+            revision = overlay.probe(self.storage)
+            self.assertEqual(revision,
+                'Last-Modified:' + recorded['last_modified'])
+            self.assertEqual(requests, [('HEAD', '304')])
+
+            os.utime(tarball, (1000000100, 1000000100))
+            self.assertNotEqual(overlay.probe(self.storage), revision)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TarCommandFetchFailure(TarTestCase):
+    def test(self):
+        import types
+        class Connector(object):
+            def __init__(self, *args):
+                pass
+            def fetch_content(self, url):
+                return False, '', None
+        connections = types.ModuleType(str('sslfetch.connections'))
+        connections.Connector = Connector
+        saved = sys.modules.get('sslfetch.connections')
+        sys.modules['sslfetch.connections'] = connections
+
+        self._catalog({'tar-test': 'http://127.0.0.1:9/overlay.tar.bz2'})
+        self.config.set_option('tar_native', False)
+        overlay = self._overlay('tar-test')
+        try:
+            # A failed download is reported as such, not as a TypeError
+            try:
+                overlay.sources[0]._add_unchecked(self.storage)
+            except Exception as error:
+                self.assertTrue(str(error).startswith(
+                    'Failed to fetch tar package'))
+            else:
+                self.fail('the tar package was extracted without one')
+            self.assertEqual(os.listdir(self.storage), [])
+        finally:
+            if saved is None:
+                del sys.modules['sslfetch.connections']
+            else:
+                sys.modules['sslfetch.connections'] = saved
+
+
+class RemoteCacheLock(TarTestCase):
+    def test(self):
+        from layman.lock import CACHE_LOCK
+        from layman.remotedb import RemoteDB
+        self._catalog({'tar-test': os.path.join(HERE, 'testfiles',
+            'layman-test.tar.bz2')})
+        self.config.set_option('fetch_jobs', '1')
+        db = RemoteDB(self.config)
+        held = []
+        download = db._download
+        def recording_download(item):
+            held.append(db.locks.held(CACHE_LOCK))
+            return download(item)
+        db._download = recording_download
+
+        self.assertEqual(db.cache(), (True, True))
+        # Readers are not kept waiting while the list is downloaded
+        self.assertEqual(held, [None])
+        # The new files were moved in, the compiled copy still matches
+        self.assertEqual([name for name in os.listdir(self.temp_dir_path)
+            if name.endswith('.tmp')], [])
+        mpath = db.filepath('file://' + self.catalog) + '.xml'
+        other = RemoteDB(self.config)
+        self.assertTrue(other.read_compiled(mpath))
+        self.assertEqual(list(other.overlays.keys()), ['tar-test'])
+
+
+class SchedulerLimits(unittest.TestCase):
+    def test(self):
+        import threading
+        import time
+        from layman.scheduler import SyncScheduler
+        config = BareConfig(read_configfile=False)
+        config.set_option('sync_host_jobs', '2')
+        config.set_option('sync_host_limits', 'slow.example.org 1')
+        config.set_option('sync_type_limits', 'svn 1')
+        keys = dict([('git%d' % i, ('github.com', 'git')) for i in range(4)]
+            + [('slow%d' % i, ('slow.example.org', 'git')) for i in range(3)]
+            + [('svn%d' % i, ('svn%d.example.org' % i, 'svn'))
+                for i in range(3)]
+            + [('tar%d' % i, ('', 'tar')) for i in range(4)])
+
+        # records the most jobs ever running at once per host and type
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+        def job(item):
+            slots = [('host', keys[item][0]), ('type', keys[item][1])]
+            with lock:
+                for slot in slots:
+                    running[slot] = running.get(slot, 0) + 1
+                    peak[slot] = max(peak.get(slot, 0), running[slot])
+            time.sleep(0.05)
+            with lock:
+                for slot in slots:
+                    running[slot] -= 1
+            return item
+
+        items = sorted(keys)
+        self.assertEqual(SyncScheduler(config, jobs=8).run(job, items,
+            keys.get), items)
+        # The caps are reached but never exceeded
+        self.assertEqual(peak[('host', 'github.com')], 2)
+        self.assertEqual(peak[('host', 'slow.example.org')], 1)
+        self.assertEqual(peak[('type', 'svn')], 1)
+        # local sources and other types are not capped
+        self.assertTrue(peak[('host', '')] > 2)
+        self.assertTrue(peak[('type', 'git')] > 2)
+
+
+class SyncTestCase(TarTestCase):
+    def setUp(self):
+        TarTestCase.setUp(self)
+        self.names = ['tar-test-%d' % index for index in range(3)]
+        self._catalog(dict((name, self._pack(name + '.tar.bz2',
+            {'cat/a/a-1.ebuild': 'a'})) for name in self.names))
+        # every sync takes at least a quarter of a second
+        hook = os.path.join(self.temp_dir_path, 'hook.py')
+        with open(hook, 'w') as f:
+            f.write('import time\ntime.sleep(0.25)\n')
+
+        self.config.set_option('sync_probe', False)
+        self.api = self._api()
+        self.assertTrue(self.api.add_repos(self.names))
+        self.config.set_option('tar_postsync', sys.executable + ' ' + hook)
+
+
+class SyncReportSerial(SyncTestCase):
+    def test(self):
+        self.assertTrue(self.api.sync(self.names, output_results=False,
+            jobs=1))
+        durations = [report['duration']
+            for report in self.api.sync_results.report]
+        self.assertEqual(len(durations), 3)
+        # Each overlay is charged for its own sync only, not for
+        # the ones synced before it
+        for duration in durations:
+            self.assertTrue(0.25 <= duration < 0.5, durations)
+        self.assertTrue(self.api.sync_results.duration >= sum(durations))
+
+
+class ParallelSync(SyncTestCase):
+    def test(self):
+        # the second overlay cannot be synced, the others are not held
+        # up by it
+        os.unlink(os.path.join(self.temp_dir_path, 'tar-test-1.tar.bz2'))
+        self.assertFalse(self.api.sync(self.names, output_results=False,
+            jobs=3))
+        success, warnings, fatals = self.api.sync_results
+        self.assertEqual(sorted(ovl for ovl, message in success),
+            ['tar-test-0', 'tar-test-2'])
+        self.assertEqual([ovl for ovl, message in fatals], ['tar-test-1'])
+
+        # The report keeps the order the overlays were asked for
+        report = self.api.sync_results.report
+        self.assertEqual([(r['overlay'], r['status']) for r in report],
+            [('tar-test-0', 'success'), ('tar-test-1', 'failed'),
+             ('tar-test-2', 'success')])
+        self.assertEqual(self.api.sync_results.jobs, 3)
+        # and the two hooks ran side by side
+        self.assertTrue(self.api.sync_results.duration <
+            report[0]['duration'] + report[2]['duration'])
+
+
+class SyncTypeLimit(SyncTestCase):
+    def test(self):
+        self.config.set_option('sync_type_limits', 'tar 1')
+        self.assertTrue(self.api.sync(self.names, output_results=False,
+            jobs=3))
+        durations = [report['duration']
+            for report in self.api.sync_results.report]
+        # Three workers, but only one tar sync at a time
+        self.assertTrue(self.api.sync_results.duration >= sum(durations),
+            durations)
+
+
+class MetricsSyncHistogram(SyncTestCase):
+    def test(self):
+        textfile = os.path.join(self.temp_dir_path, 'layman.prom')
+        self.config.set_option('metrics_textfile', textfile)
+        self.assertTrue(self.api.sync(self.names, output_results=False,
+            jobs=1))
+
+        with open(textfile) as f:
+            samples = dict(line.rsplit(' ', 1) for line in f.read().splitlines()
+                if not line.startswith('#'))
+        # The histogram holds the time of every overlay's own sync,
+        # not its position in the queue
+        for name in self.names:
+            key = 'layman_overlay_sync_duration_seconds%s{overlay="%s"%s}'
+            self.assertEqual(samples[key % ('_count', name, '')], '1')
+            self.assertTrue(0.25 <= float(samples[key % ('_sum', name, '')])
+                < 0.5)
+            self.assertEqual(samples[key % ('_bucket', name, ',le="1"')],
+                '1')
+
+
 if __name__ == '__main__':
     filterwarnings('ignore')
     unittest.main()
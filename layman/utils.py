@@ -186,6 +186,57 @@ def verify_overlay_src(current_src, remote_srcs):
         return remote_srcs, False
     return current_src, True
 
+SCP_LIKE_REGEX = re.compile('^(?:[^@/:]+@)?([^@/:]+):(?!//)')
+
+def source_host(src):
+    '''
+    Returns the host name a source URL points to, or an empty
+    string for local sources.
+
+    >>> source_host('https://github.com/gentoo/foo.git')
+    'github.com'
+    >>> source_host('git+ssh://git@gitlab.com:22/foo/bar.git')
+    'gitlab.com'
+    >>> source_host('git@github.com:gentoo/foo.git')
+    'github.com'
+    >>> source_host('rsync://gunnarwrobel.de/wrobel-stable')
+    'gunnarwrobel.de'
+    >>> source_host('file:///var/lib/foo.tar.bz2')
+    ''
+    >>> source_host('/usr/local/overlay')
+    ''
+    '''
+    src = src.strip()
+    if '://' in src:
+        netloc = src.split('://', 1)[1].split('/', 1)[0]
+        netloc = netloc.rsplit('@', 1)[-1]
+        if netloc.startswith('['):
+            return netloc[1:].split(']', 1)[0].lower()
+        return netloc.split(':', 1)[0].lower()
+    match = SCP_LIKE_REGEX.match(src)
+    if match:
+        return match.group(1).lower()
+    return ''
+
+
+def is_ssh_source(src):
+    '''
+    Checks whether a source URL is reached over ssh.
+
+    >>> is_ssh_source('git@github.com:gentoo/foo.git')
+    True
+    >>> is_ssh_source('ssh://hg@bitbucket.org/foo')
+    True
+    >>> is_ssh_source('https://github.com/gentoo/foo.git')
+    False
+    '''
+    src = src.strip()
+    if '://' in src:
+        scheme = src.split('://', 1)[0].lower()
+        return 'ssh' in scheme.split('+')
+    return SCP_LIKE_REGEX.match(src) is not None
+
+
 def delete_empty_directory(mdir, output=None):
     # test for a usable output parameter,
     # and make it usable if not
@@ -206,6 +257,25 @@ def delete_empty_directory(mdir, output=None):
                 output.warn('Hint: You are not root.')
 
 
+def run_jobs(func, items, jobs=1):
+    '''
+    Calls func for every item using at most "jobs" worker threads
+    and returns the results in the order of items.
+
+    >>> run_jobs(lambda x: x * 2, [1, 2, 3], jobs=2)
+    [2, 4, 6]
+    >>> run_jobs(len, ['a', 'bc'])
+    [1, 2]
+    '''
+    # imported here, layman.scheduler itself imports this module
+    from layman.scheduler import SyncScheduler
+    try:
+        jobs = int(jobs)
+    except (TypeError, ValueError):
+        jobs = 1
+    return SyncScheduler(jobs=jobs).run(func, items)
+
+
 def create_overlay_dict(**kwargs):
     """Creates a complete empty reository definition.
     Then fills it with values passed in